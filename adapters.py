@@ -2,8 +2,16 @@ import base64
 import requests
 import json
 
+def strip_data_url(image: str) -> str:
+    """去除 `data:image/...;base64,` 前綴；純 base64 字串原樣回傳，不產生任何複本。"""
+    if not image.startswith("data:"):
+        return image
+    return image[image.find(",") + 1:]
+
 class BaseAdapter:
     name = "base"
+    # 客戶端期望的串流格式："ollama" (NDJSON) 或 "openai" (SSE)
+    stream_format = "ollama"
     def __init__(self, request_json):
         self.request_json = request_json
 
@@ -47,7 +55,7 @@ class LobeChatAdapter(BaseAdapter):
         for message in messages:
             if message.get("role") == "user" and "images" in message:
                 images_list = message.get("images", [])
-                if images_list: image_base64 = images_list[0].split(',')[-1]
+                if images_list: image_base64 = strip_data_url(images_list[0])
                 break
         core_question = self._extract_core_question(user_prompt)
         return user_prompt, core_question, image_base64
@@ -56,6 +64,7 @@ class LobeChatAdapter(BaseAdapter):
 
 class CherryStudioAdapter(BaseAdapter):
     name = "cherry_studio"
+    stream_format = "openai"
 
     def parse(self):
         user_prompt, image_base64 = "", ""
@@ -71,7 +80,7 @@ class CherryStudioAdapter(BaseAdapter):
                         if part.get("type") == "text":
                             user_prompt = part.get("text", "")
                         if part.get("type") == "image_url":
-                            image_base64 = part.get("image_url", {}).get("url", "").split(',')[-1]
+                            image_base64 = strip_data_url(part.get("image_url", {}).get("url", ""))
                 if user_prompt:
                     break
         
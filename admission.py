@@ -0,0 +1,176 @@
+import asyncio
+import collections
+import json
+import logging
+import threading
+import time
+
+import requests
+
+from metrics import ADMISSION_REJECTED, ADMISSION_WAIT
+
+logger = logging.getLogger(__name__)
+
+# 由高到低的優先順序：短小的內部調用優先於深度瀏覽摘要/視覺，最後才是長時間的最終串流
+LANES = ("internal", "background", "stream")
+
+
+class AdmissionRejected(requests.exceptions.RequestException):
+    def __init__(self, message: str, status_code: int, retry_after: float):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    """排隊中的調用；`loop` 不為 None 時為非同步等待者，由任何執行緒經 call_soon_threadsafe 喚醒。"""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop | None = None):
+        self.loop = loop
+        self.event = asyncio.Event() if loop is not None else threading.Event()
+        self.granted = False
+
+    def wake(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.event.set)
+        else:
+            self.event.set()
+
+
+class _ModelGate:
+    def __init__(self, limit: int | None, internal_reserve: int):
+        # None 表示不限制並行數，只統計使用量
+        self.limit = limit
+        # 保留給 internal 通道的名額，避免長串流佔滿模型後內部短調用只能排隊
+        self.shared_limit = max(1, limit - internal_reserve) if limit is not None else None
+        self.active = {lane: 0 for lane in LANES}
+        self.queues = {lane: collections.deque() for lane in LANES}
+        self.admitted = 0
+
+    def can_admit(self, lane: str) -> bool:
+        if self.limit is None:
+            return True
+        total = sum(self.active.values())
+        if total >= self.limit:
+            return False
+        return lane == "internal" or total - self.active["internal"] < self.shared_limit
+
+    def ahead_of(self, lane: str) -> bool:
+        """是否有同等或更高優先順序的呼叫正在排隊。"""
+        return any(self.queues[other] for other in LANES[:LANES.index(lane) + 1])
+
+
+class ModelScheduler:
+    """每個模型的並行上限與優先佇列：額滿時依 LANES 順序放行等待者，佇列滿或等待逾時即拒絕。
+
+    上限為 0 (預設) 表示不限制；只有在 `default_limit` 或 `limits` 指定了正數的模型才會排隊。
+    """
+
+    def __init__(self, default_limit: int = 0, limits: dict | None = None, max_queue: int = 64,
+                 wait_timeout: float = 30.0, retry_after: float = 5.0, internal_reserve: int = 1):
+        self.default_limit = max(0, default_limit)
+        self.internal_reserve = max(0, internal_reserve)
+        self.limits = limits or {}
+        self.max_queue = max_queue
+        self.wait_timeout = wait_timeout
+        self.retry_after = retry_after
+        self._gates = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def parse_limits(config: str | None) -> dict:
+        """`config` 為 JSON 物件，例如 {"gpt-oss:20b": 2, "nomic-embed-text": 16}。"""
+        if not config:
+            return {}
+        return {model: int(limit) for model, limit in json.loads(config).items()}
+
+    def _gate(self, model: str) -> _ModelGate:
+        gate = self._gates.get(model)
+        if gate is None:
+            limit = self.limits.get(model, self.default_limit)
+            gate = self._gates[model] = _ModelGate(limit if limit > 0 else None, self.internal_reserve)
+        return gate
+
+    def _reject(self, model: str, lane: str, reason: str, status_code: int) -> AdmissionRejected:
+        ADMISSION_REJECTED.inc(lane=lane, reason=reason)
+        logger.warning(f"模型 '{model}' 已飽和 ({reason})，拒絕 {lane} 通道的調用。")
+        return AdmissionRejected(f"模型 '{model}' 目前過載 ({reason})，請稍後重試。",
+                                 status_code, self.retry_after)
+
+    def check_capacity(self, model: str, lane: str):
+        """在開始昂貴的前置流程之前快速判斷：若該通道佇列已滿則立即拒絕。"""
+        with self._lock:
+            gate = self._gate(model)
+            if len(gate.queues[lane]) >= self.max_queue:
+                raise self._reject(model, lane, "queue_full", 429)
+
+    def _enqueue(self, model: str, lane: str, loop: asyncio.AbstractEventLoop | None = None) -> _Waiter | None:
+        """有空位時直接佔用並回傳 None，否則加入佇列並回傳等待者。"""
+        with self._lock:
+            gate = self._gate(model)
+            if gate.can_admit(lane) and not gate.ahead_of(lane):
+                gate.active[lane] += 1
+                gate.admitted += 1
+                ADMISSION_WAIT.observe(0.0, lane=lane)
+                return None
+            queue = gate.queues[lane]
+            if len(queue) >= self.max_queue:
+                raise self._reject(model, lane, "queue_full", 429)
+            waiter = _Waiter(loop)
+            queue.append(waiter)
+            return waiter
+
+    def _finish_wait(self, model: str, lane: str, waiter: _Waiter, started: float):
+        with self._lock:
+            if not waiter.granted:
+                self._gate(model).queues[lane].remove(waiter)
+                ADMISSION_WAIT.observe(time.monotonic() - started, lane=lane)
+                raise self._reject(model, lane, "wait_timeout", 503)
+        ADMISSION_WAIT.observe(time.monotonic() - started, lane=lane)
+
+    def acquire(self, model: str, lane: str):
+        started = time.monotonic()
+        waiter = self._enqueue(model, lane)
+        if waiter is not None:
+            waiter.event.wait(self.wait_timeout)
+            self._finish_wait(model, lane, waiter, started)
+
+    async def acquire_async(self, model: str, lane: str):
+        """ASGI 模式使用：在事件迴圈上等待，排隊中的請求不佔用執行緒池。"""
+        started = time.monotonic()
+        waiter = self._enqueue(model, lane, asyncio.get_running_loop())
+        if waiter is None:
+            return
+        try:
+            await asyncio.wait_for(waiter.event.wait(), self.wait_timeout)
+        except asyncio.TimeoutError:
+            pass
+        except BaseException:
+            # 客戶端斷線而取消：歸還已分配的名額，或退出佇列
+            with self._lock:
+                if not waiter.granted:
+                    self._gate(model).queues[lane].remove(waiter)
+            if waiter.granted:
+                self.release(model, lane)
+            raise
+        self._finish_wait(model, lane, waiter, started)
+
+    def release(self, model: str, lane: str):
+        with self._lock:
+            gate = self._gate(model)
+            gate.active[lane] -= 1
+            for candidate in LANES:
+                queue = gate.queues[candidate]
+                while queue and gate.can_admit(candidate):
+                    waiter = queue.popleft()
+                    waiter.granted = True
+                    gate.active[candidate] += 1
+                    gate.admitted += 1
+                    waiter.wake()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {model: {"limit": gate.limit, "active": sum(gate.active.values()),
+                            "active_by_lane": dict(gate.active), "admitted": gate.admitted,
+                            "queued": {lane: len(queue) for lane, queue in gate.queues.items()}}
+                    for model, gate in self._gates.items()}
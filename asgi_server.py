@@ -0,0 +1,452 @@
+import asyncio
+import contextlib
+import json
+import logging
+import math
+import os
+
+import anyio
+import httpx
+import requests
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route
+
+from admission import AdmissionRejected
+from backend_pool import OllamaNode
+from ollama_client import DEFAULT_PROFILES
+from metrics import REGISTRY, UPSTREAM_ERRORS, StreamMeter, current_trace, set_route, stage, start_trace
+from embed_batcher import EmbedUpstreamError
+from progress_stream import ProgressChannel
+from stream_translation import CONTENT_TYPES, StreamTranslator, error_event
+from proxy_server import (BACKEND_POOL, MAX_JSON_BODY_BYTES, PROGRESS_GRACE, PROGRESS_KEEPALIVE_INTERVAL, RESPONSE_CACHE,
+                          RESPONSE_CACHE_HEADER, SCHEDULER, THINKING_MODEL, VISION_MODEL, USAGE_STORE, PipelineError,
+                          build_error_payload, collect_stats, build_stream_translator, cache_stream_answer,
+                          deferred_headers_event, encode_progress, generate_apology_stream, generate_cached_stream,
+                          is_chat_request, is_embed_request, parse_json_body, prepare_chat_request, progress_format,
+                          purge_cache_entries, response_cache_lookup, serve_embed_request, wants_fresh_response)
+
+logger = logging.getLogger(__name__)
+
+# 非同步模式下每條串流只佔用一個 socket 而非一條執行緒，因此上游連線數可以設得很高。
+ASYNC_CLIENT = httpx.AsyncClient(
+    limits=httpx.Limits(
+        max_connections=int(os.getenv("ASGI_MAX_UPSTREAM_CONNECTIONS", "4096")),
+        max_keepalive_connections=int(os.getenv("ASGI_MAX_KEEPALIVE_CONNECTIONS", "256"))),
+    timeout=httpx.Timeout(connect=5, read=None, write=30, pool=30))
+
+HOP_BY_HOP_HEADERS = {"host", "connection", "keep-alive", "transfer-encoding",
+                      "te", "trailer", "upgrade", "proxy-authorization", "proxy-connection"}
+
+
+class UpstreamStreamingResponse(StreamingResponse):
+    """串流結束、出錯或客戶端斷線時，一律中止對 Ollama 的上游請求。"""
+
+    def __init__(self, upstream: httpx.Response, node: OllamaNode, model: str | None = None,
+                 meter: StreamMeter | None = None, lane: str | None = None,
+                 translator: StreamTranslator | None = None, media_type: str | None = None):
+        body = self._translate(upstream, translator) if translator is not None else self._relay(upstream, meter)
+        super().__init__(body, status_code=upstream.status_code,
+                         media_type=media_type or upstream.headers.get('content-type'))
+        self.upstream = upstream
+        self.node = node
+        self.model = model
+        # 佔用的准入通道；None 表示未經准入控制
+        self.lane = lane
+        self._released = False
+
+    @staticmethod
+    async def _relay(upstream: httpx.Response, meter: StreamMeter | None):
+        async for chunk in upstream.aiter_raw():
+            if meter is not None:
+                meter.observe(chunk)
+            yield chunk
+
+    @staticmethod
+    async def _translate(upstream: httpx.Response, translator: StreamTranslator):
+        async for chunk in upstream.aiter_raw():
+            data = translator.feed(chunk)
+            if data:
+                yield data
+        data = translator.finish()
+        if data:
+            yield data
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.release()
+
+    async def release(self):
+        """關閉上游連線並歸還節點與並行名額；接在進度事件之後轉送時由外層產生器呼叫，重複呼叫無害。"""
+        if self._released:
+            return
+        self._released = True
+        if not self.upstream.is_closed:
+            logger.info("串流已結束或客戶端已斷線，關閉上游 Ollama 連線。")
+        with anyio.CancelScope(shield=True):
+            await self.upstream.aclose()
+        BACKEND_POOL.release(self.node, self.upstream.status_code < 500, self.model)
+        release_admission(self.model, self.lane)
+
+
+async def admit(model: str | None, profile: str) -> str | None:
+    """與 OllamaClient.request 相同的准入規則：沒有模型的請求不經准入控制，通道取自調用類型的設定。
+
+    回傳佔用的通道 (未佔用時為 None)，交給 `release_admission` 歸還。
+    """
+    if model is None:
+        return None
+    lane = DEFAULT_PROFILES[profile].lane
+    await SCHEDULER.acquire_async(model, lane)
+    return lane
+
+
+def release_admission(model: str | None, lane: str | None):
+    if lane is not None:
+        SCHEDULER.release(model, lane)
+
+
+def error_response(message: str, error_type: str = "api_error", status_code: int = 500,
+                   retry_after: float | None = None) -> Response:
+    headers = {'Retry-After': str(math.ceil(retry_after))} if retry_after is not None else None
+    return Response(build_error_payload(message, error_type, status_code),
+                    status_code=status_code, media_type='application/json', headers=headers)
+
+
+def forward_headers(request: Request) -> dict:
+    return {k: v for k, v in request.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS}
+
+
+async def read_json_body(request: Request) -> tuple[bytes, dict]:
+    """與 Flask 版相同：限制本文大小，且不經 Starlette 的 request.json() 同時快取原始位元組與解析結果。"""
+    chunks, size = [], 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > MAX_JSON_BODY_BYTES:
+            raise PipelineError(f"請求本文超過 {MAX_JSON_BODY_BYTES} 位元組上限。", "request_too_large", 413)
+        chunks.append(chunk)
+    raw = b"".join(chunks)
+    del chunks
+    return raw, parse_json_body(raw)
+
+
+async def send_upstream(method: str, path: str, stream: bool, model: str | None = None,
+                        retryable: bool = True, **kwargs) -> tuple[httpx.Response, OllamaNode]:
+    tried = []
+    while True:
+        node = BACKEND_POOL.acquire(model, exclude=tried)
+        tried.append(node)
+        upstream_request = ASYNC_CLIENT.build_request(
+            method, f"{node.url}/{path.lstrip('/')}", **kwargs)
+        try:
+            return await ASYNC_CLIENT.send(upstream_request, stream=stream), node
+        except httpx.ConnectError as e:
+            BACKEND_POOL.release(node, False)
+            UPSTREAM_ERRORS.inc(profile="asgi", kind="connection")
+            if not retryable or not BACKEND_POOL.has_alternative(model, tried):
+                raise
+            logger.warning(f"Ollama 節點 {node.url} 連線失敗 ({e})，改由其他節點重試。")
+        except BaseException as e:
+            BACKEND_POOL.release(node, False)
+            if isinstance(e, httpx.HTTPError):
+                UPSTREAM_ERRORS.inc(profile="asgi", kind=type(e).__name__)
+            raise
+
+
+async def proxy_stats(request: Request) -> Response:
+    stats = await run_in_threadpool(collect_stats)
+    return Response(json.dumps(stats), media_type='application/json')
+
+
+async def purge_response_cache(request: Request) -> Response:
+    if RESPONSE_CACHE is None:
+        return error_response("回應快取未啟用。", "not_found", 404)
+    return Response(json.dumps({"purged": purge_cache_entries(request.query_params)}), media_type='application/json')
+
+
+async def metrics_endpoint(request: Request) -> Response:
+    return Response(REGISTRY.render(), media_type='text/plain; version=0.0.4')
+
+
+async def proxy_usage(request: Request) -> Response:
+    usage = await run_in_threadpool(USAGE_STORE.snapshot)
+    return Response(json.dumps(usage), media_type='application/json')
+
+
+async def intelligent_proxy(request: Request) -> Response:
+    trace = start_trace()
+    response = await handle_proxy_request(request)
+    response.headers['Server-Timing'] = trace.server_timing()
+    return response
+
+
+async def handle_proxy_request(request: Request) -> Response:
+    subpath = request.path_params["subpath"]
+    if request.method == 'OPTIONS':
+        return Response(status_code=200)
+
+    if is_embed_request(request.method, subpath):
+        return await handle_embed_request(request, subpath)
+
+    if not is_chat_request(request.method, subpath):
+        logger.info(f"進入通用轉發器處理 {request.method} /{subpath}...")
+        set_route("passthrough")
+        try:
+            upstream, node = await send_upstream(
+                request.method, subpath, stream=True, retryable=False, headers=forward_headers(request),
+                content=request.stream(), params=request.query_params)
+        except httpx.HTTPError as e:
+            return error_response(f"通用轉發失敗: {e}", "forwarding_error", 502)
+        return UpstreamStreamingResponse(upstream, node)
+
+    try:
+        raw_body, client_request_json = await read_json_body(request)
+    except PipelineError as e:
+        set_route("error")
+        return error_response(e.message, e.error_type, e.status_code)
+    if not client_request_json.get("stream", False):
+        logger.info("檢測到非流式請求，進入通用轉發器...")
+        set_route("non_stream")
+        cache_key, cached, cache_status = response_cache_lookup(
+            "response", client_request_json, client_request_json, wants_fresh_response(request.headers), subpath)
+        if cached is not None:
+            return Response(cached["body"], media_type=cached["content_type"],
+                            headers={RESPONSE_CACHE_HEADER: cache_status})
+        model = client_request_json.get("model")
+        try:
+            lane = await admit(model, "passthrough")
+        except AdmissionRejected as e:
+            return error_response(str(e), "overloaded", e.status_code, e.retry_after)
+        try:
+            resp, node = await send_upstream(
+                "POST", subpath, stream=False, model=model, headers=forward_headers(request),
+                content=raw_body, timeout=httpx.Timeout(5, read=600))
+        except httpx.HTTPError as e:
+            return error_response(f"非流式轉發失敗: {e}", "forwarding_error", 502)
+        finally:
+            release_admission(model, lane)
+        BACKEND_POOL.release(node, resp.status_code < 500, model)
+        if cache_key is not None and resp.status_code == 200:
+            RESPONSE_CACHE.put(cache_key, {"body": resp.content, "content_type": resp.headers.get('content-type')})
+        response = Response(resp.content, status_code=resp.status_code, media_type=resp.headers.get('content-type'))
+        if cache_status:
+            response.headers[RESPONSE_CACHE_HEADER] = cache_status
+        return response
+
+    raw_body = None
+    no_cache = wants_fresh_response(request.headers)
+    client_format = progress_format(subpath)
+    try:
+        SCHEDULER.check_capacity(THINKING_MODEL, "stream")
+        if client_format is None:
+            prepared = await run_in_threadpool(prepare_chat_request, subpath, client_request_json)
+        else:
+            loop = asyncio.get_running_loop()
+            wakeup = asyncio.Event()
+            channel = ProgressChannel(wakeup=lambda: loop.call_soon_threadsafe(wakeup.set))
+            current_trace().progress_listener = channel
+            task = asyncio.ensure_future(run_in_threadpool(prepare_chat_request, subpath, client_request_json))
+            task.add_done_callback(channel.close)
+            done, _ = await asyncio.wait({task}, timeout=PROGRESS_GRACE)
+            if not done:
+                logger.info(f"前置階段超過 {PROGRESS_GRACE}s，提早開啟串流並送出進度事件。")
+                return StreamingResponse(
+                    progress_then_stream(task, channel, wakeup, client_format, client_request_json, no_cache,
+                                         current_trace()),
+                    media_type=CONTENT_TYPES[client_format])
+            prepared = task.result()
+    except AdmissionRejected as e:
+        set_route("rejected")
+        return error_response(str(e), "overloaded", e.status_code, e.retry_after)
+    except PipelineError as e:
+        set_route("error")
+        return error_response(e.message, e.error_type, e.status_code, e.retry_after)
+    set_route(prepared.route)
+    try:
+        return await open_final_stream(prepared, client_request_json, no_cache)
+    except PipelineError as e:
+        return error_response(e.message, e.error_type, e.status_code, e.retry_after)
+
+
+async def open_final_stream(prepared, client_request_json: dict, no_cache: bool) -> Response:
+    """與 Flask 版相同：回傳最終串流回應，連線上游失敗時拋出 PipelineError。"""
+    if prepared.apology_text is not None:
+        return StreamingResponse(generate_apology_stream(prepared.apology_text, prepared.adapter),
+                                 media_type=prepared.content_type)
+    cache_key, cached, cache_status = response_cache_lookup("stream", prepared.payload, client_request_json, no_cache)
+    if cached is not None:
+        return StreamingResponse(generate_cached_stream(cached, prepared, client_request_json),
+                                 media_type=prepared.content_type, headers={RESPONSE_CACHE_HEADER: cache_status})
+
+    model = prepared.payload.get("model")
+    try:
+        lane = await admit(model, "stream")
+    except AdmissionRejected as e:
+        raise PipelineError(str(e), "overloaded", e.status_code, e.retry_after)
+    try:
+        with stage("upstream_connect"):
+            upstream, node = await send_upstream(
+                "POST", prepared.endpoint, stream=True, model=model, json=prepared.payload)
+    except BaseException as e:
+        release_admission(model, lane)
+        if isinstance(e, httpx.HTTPError):
+            raise PipelineError(f"{prepared.failure_message}: {e}", prepared.failure_type, 502)
+        raise
+    if upstream.is_error:
+        await upstream.aread()
+        await upstream.aclose()
+        BACKEND_POOL.release(node, upstream.status_code < 500, model)
+        release_admission(model, lane)
+        raise PipelineError(f"{prepared.failure_message}: HTTP {upstream.status_code} {upstream.text[:200]}",
+                            prepared.failure_type, 502)
+    logger.info("==> [STEP 8] 成功轉發請求，開始流式傳輸回應。")
+    meter = StreamMeter(prepared.route, current_trace())
+    translator = build_stream_translator(prepared, client_request_json, meter, cache_stream_answer(cache_key))
+    response = UpstreamStreamingResponse(upstream, node, model, meter, lane=lane, translator=translator,
+                                         media_type=prepared.content_type if translator is not None else None)
+    if cache_status:
+        response.headers[RESPONSE_CACHE_HEADER] = cache_status
+    return response
+
+
+async def progress_then_stream(task: asyncio.Future, channel: ProgressChannel, wakeup: asyncio.Event,
+                               client_format: str, client_request_json: dict, no_cache: bool, trace):
+    """非同步版的進度串流：等待 `wakeup` 而不佔用執行緒，前置階段完成後接上最終串流。"""
+    try:
+        items, closed = channel.wait(0)
+        trace.mark_first_byte("progress")
+        yield encode_progress(items, client_format)
+        while not closed:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(wakeup.wait(), PROGRESS_KEEPALIVE_INTERVAL)
+            wakeup.clear()
+            items, closed = channel.wait(0)
+            if items or not closed:
+                yield encode_progress(items, client_format)
+        trace.progress_listener = None
+        # 狀態碼已經送出，之後的失敗只能以客戶端格式的錯誤事件結束串流
+        try:
+            prepared = task.result()
+        except AdmissionRejected as e:
+            set_route("rejected")
+            yield error_event(str(e), client_format, THINKING_MODEL)
+            return
+        except PipelineError as e:
+            set_route("error")
+            logger.error(f"提早開啟的串流在前置階段失敗: {e.message}")
+            yield error_event(e.message, client_format, THINKING_MODEL)
+            return
+        except Exception as e:
+            # 前置階段的非預期錯誤：不能讓例外中斷已開始的回應，否則客戶端只會收到沒有結尾的串流
+            set_route("error")
+            logger.error(f"提早開啟的串流在前置階段發生未預期的錯誤: {e}", exc_info=True)
+            yield error_event(f"處理請求時發生內部錯誤: {e}", client_format, THINKING_MODEL)
+            return
+        set_route(prepared.route)
+        try:
+            response = await open_final_stream(prepared, client_request_json, no_cache)
+        except PipelineError as e:
+            yield error_event(e.message, client_format, THINKING_MODEL)
+            return
+        try:
+            yield deferred_headers_event(response.headers, client_format, trace)
+            async for chunk in response.body_iterator:
+                yield chunk
+        finally:
+            if isinstance(response, UpstreamStreamingResponse):
+                await response.release()
+    finally:
+        if not task.done():
+            # 客戶端在前置階段中途斷線：執行緒中的工作無法中止，只需避免未取得的例外被記錄為錯誤
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+
+async def handle_embed_request(request: Request, subpath: str) -> Response:
+    set_route("embed")
+    try:
+        raw_body, payload = await read_json_body(request)
+        # 合併等待在執行緒中進行，與 Flask 版共用同一個 EmbedBatcher
+        body = await run_in_threadpool(serve_embed_request, subpath, payload)
+    except PipelineError as e:
+        return error_response(e.message, e.error_type, e.status_code)
+    except EmbedUpstreamError as e:
+        return Response(e.body, status_code=e.status_code, media_type=e.content_type)
+    except AdmissionRejected as e:
+        return error_response(str(e), "overloaded", e.status_code, e.retry_after)
+    except requests.exceptions.RequestException as e:
+        return error_response(f"嵌入請求轉發失敗: {e}", "forwarding_error", 502)
+    if body is not None:
+        return Response(json.dumps(body), media_type='application/json')
+    model = payload.get("model")
+    try:
+        lane = await admit(model, "passthrough")
+    except AdmissionRejected as e:
+        return error_response(str(e), "overloaded", e.status_code, e.retry_after)
+    try:
+        resp, node = await send_upstream(
+            "POST", subpath, stream=False, model=model, headers=forward_headers(request),
+            content=raw_body, timeout=httpx.Timeout(5, read=600))
+    except httpx.HTTPError as e:
+        return error_response(f"嵌入請求轉發失敗: {e}", "forwarding_error", 502)
+    finally:
+        release_admission(model, lane)
+    BACKEND_POOL.release(node, resp.status_code < 500, model)
+    return Response(resp.content, status_code=resp.status_code, media_type=resp.headers.get('content-type'))
+
+
+class CORSHeadersMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        origin = dict(scope["headers"]).get(b"origin")
+        if not origin:
+            return await self.app(scope, receive, send)
+
+        async def send_with_cors(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"access-control-allow-origin", origin),
+                    (b"access-control-allow-credentials", b"true"),
+                    (b"access-control-allow-headers", b"Content-Type,Authorization"),
+                    (b"access-control-allow-methods", b"GET,PUT,POST,DELETE,OPTIONS")]
+            await send(message)
+        await self.app(scope, receive, send_with_cors)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    yield
+    await ASYNC_CLIENT.aclose()
+
+
+app = Starlette(routes=[
+    Route('/proxy/stats', proxy_stats, methods=['GET']),
+    Route('/proxy/usage', proxy_usage, methods=['GET']),
+    Route('/proxy/cache', purge_response_cache, methods=['DELETE']),
+    Route('/metrics', metrics_endpoint, methods=['GET']),
+    Route('/{subpath:path}', intelligent_proxy, methods=['POST', 'OPTIONS']),
+], lifespan=lifespan)
+app = CORSHeadersMiddleware(app)
+
+
+if __name__ == '__main__':
+    port = int(os.getenv("PROXY_PORT", "5000"))
+    logger.info("="*60)
+    logger.info("  Universal Adapter Proxy Started - Async (ASGI) Mode")
+    logger.info(f"  Thinking Model: {THINKING_MODEL}")
+    logger.info(f"  Vision Model: {VISION_MODEL}")
+    logger.info(f"  Listening on: http://localhost:{port}")
+    logger.info("="*60)
+    try:
+        import uvicorn
+    except ImportError:
+        logger.error("uvicorn not found. Install it with 'pip install uvicorn' or run 'python proxy_server.py'.")
+        raise SystemExit(1)
+    uvicorn.run(app, host='0.0.0.0', port=port, log_level="info")
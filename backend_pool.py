@@ -0,0 +1,141 @@
+import itertools
+import json
+import logging
+import threading
+import time
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+class NoBackendAvailable(requests.exceptions.RequestException):
+    pass
+
+
+class OllamaNode:
+    def __init__(self, url: str, models=None):
+        self.url = url.rstrip("/")
+        self.models = set(models) if models else None
+        self.outstanding = 0
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.loaded_models = set()
+        self.requests = 0
+        self.failures = 0
+
+    def serves(self, model: str | None) -> bool:
+        return model is None or self.models is None or model in self.models
+
+    def available(self, now: float) -> bool:
+        return self.healthy and self.ejected_until <= now
+
+    def stats(self) -> dict:
+        return {"url": self.url, "models": sorted(self.models) if self.models else "*",
+                "healthy": self.healthy, "ejected": self.ejected_until > time.monotonic(),
+                "outstanding": self.outstanding, "loaded_models": sorted(self.loaded_models),
+                "requests": self.requests, "failures": self.failures}
+
+
+class BackendPool:
+    """多個 Ollama 節點的負載平衡：依模型篩選、優先已載入模型的節點、再取未完成請求數最少者。"""
+
+    def __init__(self, nodes: list[OllamaNode], health_interval: float = 10.0,
+                 failure_threshold: int = 3, ejection_seconds: float = 30.0, load_penalty: int = 2):
+        if not nodes:
+            raise ValueError("BackendPool 至少需要一個節點。")
+        self.nodes = nodes
+        self.health_interval = health_interval
+        self.failure_threshold = failure_threshold
+        self.ejection_seconds = ejection_seconds
+        # 尚未載入模型的節點視同多出 `load_penalty` 個未完成請求，已載入的節點過載時才分流過去
+        self.load_penalty = load_penalty
+        self._lock = threading.Lock()
+        self._tiebreak = itertools.count()
+        self._health_session = requests.Session()
+        self._health_thread = None
+
+    @classmethod
+    def from_config(cls, nodes_config: str | None, default_url: str, **kwargs) -> "BackendPool":
+        """`nodes_config` 可為逗號分隔的 URL，或 JSON 陣列: [{"url": "...", "models": ["..."]}]。"""
+        if not nodes_config:
+            return cls([OllamaNode(default_url)], **kwargs)
+        nodes_config = nodes_config.strip()
+        if nodes_config.startswith("["):
+            nodes = [OllamaNode(entry["url"], entry.get("models"))
+                     for entry in json.loads(nodes_config)]
+        else:
+            nodes = [OllamaNode(url.strip())
+                     for url in nodes_config.split(",") if url.strip()]
+        return cls(nodes, **kwargs)
+
+    def acquire(self, model: str | None = None, exclude=()) -> OllamaNode:
+        now = time.monotonic()
+        with self._lock:
+            capable = [n for n in self.nodes if n.serves(model) and n not in exclude]
+            if not capable:
+                raise NoBackendAvailable(f"沒有可服務模型 '{model}' 的 Ollama 節點。")
+            candidates = [n for n in capable if n.available(now)] or capable
+            # 平手時從每次遞增的起點輪替，避免循序請求總是落在同一個節點
+            start = next(self._tiebreak) % len(candidates)
+            _, node = min(enumerate(candidates), key=lambda item: (
+                item[1].outstanding + (self.load_penalty if model and model not in item[1].loaded_models else 0),
+                (item[0] - start) % len(candidates)))
+            node.outstanding += 1
+            node.requests += 1
+            return node
+
+    def has_alternative(self, model: str | None, exclude) -> bool:
+        with self._lock:
+            return any(n.serves(model) and n not in exclude for n in self.nodes)
+
+    def release(self, node: OllamaNode, ok: bool, model: str | None = None):
+        with self._lock:
+            node.outstanding -= 1
+            if ok:
+                node.consecutive_failures = 0
+                if model:
+                    node.loaded_models.add(model)
+                return
+            node.failures += 1
+            node.consecutive_failures += 1
+            if node.consecutive_failures >= self.failure_threshold:
+                node.ejected_until = time.monotonic() + self.ejection_seconds
+                logger.warning(
+                    f"Ollama 節點 {node.url} 連續失敗 {node.consecutive_failures} 次，暫時剔除 {self.ejection_seconds}s。")
+
+    def check_health(self):
+        for node in self.nodes:
+            try:
+                response = self._health_session.get(f"{node.url}/api/ps", timeout=(2, 5))
+                response.raise_for_status()
+                loaded = {m.get("name") or m.get("model") for m in response.json().get("models", [])}
+            except (requests.exceptions.RequestException, ValueError) as e:
+                if node.healthy:
+                    logger.warning(f"Ollama 節點 {node.url} 健康檢查失敗: {e}")
+                with self._lock:
+                    node.healthy = False
+                continue
+            with self._lock:
+                if not node.healthy:
+                    logger.info(f"Ollama 節點 {node.url} 已恢復。")
+                node.healthy = True
+                node.consecutive_failures = 0
+                node.loaded_models = {name for name in loaded if name}
+
+    def start_health_checks(self):
+        if self._health_thread is not None:
+            return
+
+        def loop():
+            while True:
+                self.check_health()
+                time.sleep(self.health_interval)
+        self._health_thread = threading.Thread(
+            target=loop, name="ollama-health", daemon=True)
+        self._health_thread.start()
+
+    def stats(self) -> list[dict]:
+        with self._lock:
+            return [node.stats() for node in self.nodes]
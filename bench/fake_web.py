@@ -0,0 +1,91 @@
+"""離線壓測用的假搜尋服務與網頁：相容 Google Custom Search JSON API，結果連結指回本服務的文章頁。
+
+代理端設定 GOOGLE_SEARCH_ENDPOINT=http://127.0.0.1:<port>/ 後，搜尋與深度瀏覽都不會連外。
+"""
+import argparse
+import hashlib
+import json
+import threading
+import time
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+@dataclass
+class WebSettings:
+    search_ms: float = 150.0
+    page_ms: float = 300.0
+    paragraphs: int = 12
+
+
+class FakeWebHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    settings = WebSettings()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, body: bytes, content_type: str, status: int = 200, headers: dict | None = None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path.endswith("/customsearch/v1"):
+            self._search(parse_qs(url.query))
+        elif url.path.startswith("/page/"):
+            self._page(url.path)
+        else:
+            self._send(b"not found", "text/plain", 404)
+
+    def _search(self, query: dict):
+        time.sleep(self.settings.search_ms / 1000)
+        q = query.get("q", [""])[0]
+        num = int(query.get("num", ["5"])[0])
+        digest = hashlib.sha256(q.encode("utf-8")).hexdigest()[:12]
+        host = self.headers.get("Host", f"127.0.0.1:{self.server.server_address[1]}")
+        items = [{"title": f"Benchmark article {i + 1} for {q}",
+                  "link": f"http://{host}/page/{digest}/{i}",
+                  "snippet": f"Snippet {i + 1} describing {q} with a few relevant facts."}
+                 for i in range(num)]
+        self._send(json.dumps({"items": items}).encode("utf-8"), "application/json")
+
+    def _page(self, path: str):
+        etag = f'"{hashlib.sha256(path.encode("utf-8")).hexdigest()[:16]}"'
+        if self.headers.get("If-None-Match") == etag:
+            self._send(b"", "text/html", 304, {"ETag": etag})
+            return
+        time.sleep(self.settings.page_ms / 1000)
+        paragraphs = "".join(
+            f"<p>Paragraph {i} of {path}: the benchmark article discusses measured results, "
+            f"methodology and conclusions in enough detail for the extractor to keep it as main text.</p>"
+            for i in range(self.settings.paragraphs))
+        html = (f"<html><head><title>{path}</title></head><body><nav>Home | About</nav>"
+                f"<article><h1>{path}</h1>{paragraphs}</article><footer>Footer</footer></body></html>")
+        self._send(html.encode("utf-8"), "text/html; charset=utf-8", headers={"ETag": etag})
+
+
+def start_fake_web(port: int, settings: WebSettings) -> ThreadingHTTPServer:
+    handler = type("ConfiguredFakeWebHandler", (FakeWebHandler,), {"settings": settings})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fake-web", daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake search provider and page server for offline benchmarks.")
+    parser.add_argument("--port", type=int, default=18480)
+    parser.add_argument("--search-ms", type=float, default=WebSettings.search_ms)
+    parser.add_argument("--page-ms", type=float, default=WebSettings.page_ms)
+    args = parser.parse_args()
+    start_fake_web(args.port, WebSettings(args.search_ms, args.page_ms))
+    print(f"Fake web listening on http://127.0.0.1:{args.port}")
+    threading.Event().wait()
@@ -0,0 +1,204 @@
+"""離線壓測用的假 Ollama 伺服器：模擬 prefill 延遲與固定的 token 產生速率。
+
+    python bench/mock_ollama.py --port 18434 --prefill-ms 200 --tokens-per-second 50
+"""
+import argparse
+import hashlib
+import json
+import threading
+import time
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+@dataclass
+class MockSettings:
+    prefill_ms: float = 200.0
+    tokens_per_second: float = 50.0
+    stream_tokens: int = 64
+    internal_tokens: int = 16
+    embed_ms: float = 5.0
+    # 每次 /api/embed 調用的固定開銷為 embed_ms，每多一個輸入再加 embed_per_input_ms；
+    # 同時只執行 embed_parallel 個調用，模擬單張 GPU 依序處理嵌入請求
+    embed_per_input_ms: float = 0.5
+    embed_parallel: int = 1
+
+
+def _digest(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:12]
+
+
+def _embedding(text: str, dims: int = 32) -> list[float]:
+    seed = hashlib.sha256(text.encode("utf-8")).digest()
+    return [(seed[i % len(seed)] - 128) / 128.0 for i in range(dims)]
+
+
+def _generate_reply(payload: dict) -> str:
+    """依據代理送出的內部提示詞類型，回傳代理能正確解析的內容。"""
+    prompt = payload.get("prompt", "")
+    if payload.get("format"):
+        return json.dumps({"needs_search": True, "search_query": f"bench {_digest(prompt)}",
+                           "experts": [{"name": "Assistant", "influence": "High"}]})
+    if payload.get("images"):
+        return "A synthetic benchmark image showing a chart with several labelled bars."
+    if "Chief of Staff" in prompt:
+        return "Assistant (High)"
+    if "fact-checker" in prompt:
+        return "Yes"
+    return f"bench query {_digest(prompt)}"
+
+
+class MockOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    settings = MockSettings()
+    embed_slots = threading.BoundedSemaphore(1)
+    # 每個伺服器各自的狀態：收到的 POST 數，以及 failing=True 時對所有請求回應 503 (模擬節點故障)
+    state = {"requests": 0, "failing": False}
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, body: dict, status: int = 200):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _start_chunked(self, content_type: str):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def _write_chunk(self, data: bytes):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def _end_chunked(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def _token_stream(self, count: int):
+        time.sleep(self.settings.prefill_ms / 1000)
+        interval = 1 / self.settings.tokens_per_second if self.settings.tokens_per_second > 0 else 0
+        for i in range(count):
+            if interval:
+                time.sleep(interval)
+            yield f"tok{i} "
+
+    def _blocking_delay(self, tokens: int):
+        time.sleep(self.settings.prefill_ms / 1000)
+        if self.settings.tokens_per_second > 0:
+            time.sleep(tokens / self.settings.tokens_per_second)
+
+    def do_GET(self):
+        if self.state["failing"]:
+            self._send_json({"error": "mock node down"}, 503)
+        elif self.path in ("/api/ps", "/api/tags"):
+            self._send_json({"models": []})
+        else:
+            self._send_json({"error": "not found"}, 404)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            payload = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self._send_json({"error": "invalid json"}, 400)
+            return
+        model = payload.get("model", "mock")
+        self.state["requests"] += 1
+        if self.state["failing"]:
+            self._send_json({"error": "mock node down"}, 503)
+            return
+        try:
+            if self.path == "/api/embed":
+                inputs = payload.get("input", "")
+                inputs = [inputs] if isinstance(inputs, str) else inputs
+                with self.embed_slots:
+                    time.sleep((self.settings.embed_ms + self.settings.embed_per_input_ms * len(inputs)) / 1000)
+                self._send_json({"model": model, "embeddings": [_embedding(text) for text in inputs]})
+            elif self.path == "/api/generate":
+                self._generate(payload, model)
+            elif self.path == "/api/chat":
+                self._chat(payload, model)
+            elif self.path == "/v1/chat/completions":
+                self._openai_chat(payload, model)
+            else:
+                self._send_json({"error": "not found"}, 404)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def _generate(self, payload: dict, model: str):
+        reply = _generate_reply(payload)
+        if not payload.get("stream", True):
+            self._blocking_delay(self.settings.internal_tokens)
+            self._send_json({"model": model, "response": reply, "done": True})
+            return
+        self._start_chunked("application/x-ndjson")
+        for token in self._token_stream(self.settings.stream_tokens):
+            self._write_chunk((json.dumps({"model": model, "response": token, "done": False}) + "\n").encode())
+        self._write_chunk((json.dumps({"model": model, "response": "", "done": True}) + "\n").encode())
+        self._end_chunked()
+
+    def _chat(self, payload: dict, model: str):
+        if not payload.get("stream", True):
+            self._blocking_delay(self.settings.internal_tokens)
+            content = " ".join(f"key point {i}" for i in range(self.settings.internal_tokens))
+            self._send_json({"model": model, "message": {"role": "assistant", "content": content}, "done": True})
+            return
+        self._start_chunked("application/x-ndjson")
+        for token in self._token_stream(self.settings.stream_tokens):
+            chunk = {"model": model, "message": {"role": "assistant", "content": token}, "done": False}
+            self._write_chunk((json.dumps(chunk) + "\n").encode())
+        done = {"model": model, "message": {"role": "assistant", "content": ""}, "done": True,
+                "eval_count": self.settings.stream_tokens}
+        self._write_chunk((json.dumps(done) + "\n").encode())
+        self._end_chunked()
+
+    def _openai_chat(self, payload: dict, model: str):
+        created = int(time.time())
+        if not payload.get("stream", False):
+            self._blocking_delay(self.settings.stream_tokens)
+            content = "".join(f"tok{i} " for i in range(self.settings.stream_tokens))
+            self._send_json({"id": "chatcmpl-mock", "object": "chat.completion", "created": created, "model": model,
+                             "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                                          "finish_reason": "stop"}]})
+            return
+        self._start_chunked("text/event-stream")
+        for token in self._token_stream(self.settings.stream_tokens):
+            chunk = {"id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": created, "model": model,
+                     "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]}
+            self._write_chunk(f"data: {json.dumps(chunk)}\n\n".encode())
+        self._write_chunk(b"data: [DONE]\n\n")
+        self._end_chunked()
+
+
+def start_mock_ollama(port: int, settings: MockSettings) -> ThreadingHTTPServer:
+    """回傳的伺服器帶有 `state` 屬性，可讀取請求數或設定 failing 來模擬故障。"""
+    state = {"requests": 0, "failing": False}
+    handler = type("ConfiguredMockOllamaHandler", (MockOllamaHandler,), {
+        "settings": settings, "embed_slots": threading.BoundedSemaphore(max(1, settings.embed_parallel)),
+        "state": state})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.state = state
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="mock-ollama", daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Ollama server for offline benchmarks.")
+    parser.add_argument("--port", type=int, default=18434)
+    parser.add_argument("--prefill-ms", type=float, default=MockSettings.prefill_ms)
+    parser.add_argument("--tokens-per-second", type=float, default=MockSettings.tokens_per_second)
+    parser.add_argument("--stream-tokens", type=int, default=MockSettings.stream_tokens)
+    parser.add_argument("--internal-tokens", type=int, default=MockSettings.internal_tokens)
+    args = parser.parse_args()
+    settings = MockSettings(args.prefill_ms, args.tokens_per_second, args.stream_tokens, args.internal_tokens)
+    start_mock_ollama(args.port, settings)
+    print(f"Mock Ollama listening on http://127.0.0.1:{args.port}")
+    threading.Event().wait()
@@ -0,0 +1,106 @@
+"""對多個假 Ollama 節點驗證 BackendPool 與 OllamaClient 的分流行為，任一項檢查失敗即以非零狀態結束。
+
+    python bench/pool_check.py
+    python -m pytest tests/test_backend_pool.py
+
+檢查項目：依模型篩選節點、未完成請求數最少者優先、連續失敗的節點被剔除，以及 5xx 時改由其他節點重試。
+"""
+import argparse
+import os
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from backend_pool import BackendPool, OllamaNode  # noqa: E402
+from mock_ollama import MockSettings, start_mock_ollama  # noqa: E402
+from ollama_client import OllamaClient  # noqa: E402
+
+
+def _generate(client: OllamaClient, model: str):
+    return client.post("query", "/api/generate", json={"model": model, "prompt": "pool check", "stream": False})
+
+
+def check_model_routing(servers: dict) -> list[str]:
+    urls = list(servers)
+    pool = BackendPool([OllamaNode(urls[0], ["a"]), OllamaNode(urls[1], ["b"]), OllamaNode(urls[2])])
+    client = OllamaClient(backend_pool=pool)
+    before = {url: server.state["requests"] for url, server in servers.items()}
+    for _ in range(6):
+        _generate(client, "b").raise_for_status()
+    client.close()
+    received = {url: servers[url].state["requests"] - before[url] for url in urls}
+    if received[urls[0]]:
+        return [f"model routing: node restricted to 'a' received {received[urls[0]]} requests for 'b'"]
+    return []
+
+
+def check_least_outstanding(servers: dict) -> list[str]:
+    pool = BackendPool([OllamaNode(url) for url in servers])
+    client = OllamaClient(backend_pool=pool)
+    # 串流在讀完前持續占用節點，依序開啟 2N 個串流後每個節點應各有 2 個未完成請求
+    responses = [client.post("stream", "/api/chat", stream=True,
+                             json={"model": "m", "messages": [{"role": "user", "content": "hi"}]})
+                 for _ in range(2 * len(servers))]
+    outstanding = [node["outstanding"] for node in pool.stats()]
+    for response in responses:
+        response.close()
+    client.close()
+    if max(outstanding) - min(outstanding) > 1:
+        return [f"least outstanding: uneven spread {outstanding}"]
+    return []
+
+
+def check_ejection_and_retry(servers: dict) -> list[str]:
+    urls = list(servers)
+    # load_penalty=0 讓故障節點不會因為尚未載入模型而被避開，確保它被選中直到剔除
+    pool = BackendPool([OllamaNode(url) for url in urls], failure_threshold=3, ejection_seconds=60, load_penalty=0)
+    client = OllamaClient(backend_pool=pool)
+    failing = servers[urls[0]]
+    failing.state["failing"] = True
+    errors = []
+    try:
+        for _ in range(30):
+            response = _generate(client, "m")
+            if response.status_code != 200:
+                errors.append(f"retry: request failed with HTTP {response.status_code} despite healthy nodes")
+                break
+            if pool.stats()[0]["ejected"]:
+                break
+        if not pool.stats()[0]["ejected"]:
+            errors.append("ejection: failing node was never ejected")
+        seen = failing.state["requests"]
+        for _ in range(6):
+            _generate(client, "m")
+        if failing.state["requests"] != seen:
+            errors.append("ejection: ejected node still received requests")
+    finally:
+        failing.state["failing"] = False
+        client.close()
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check multi-node routing against local mock Ollama servers.")
+    parser.add_argument("--port", type=int, default=0,
+                        help="first of three consecutive ports (default: ephemeral ports)")
+    args = parser.parse_args()
+
+    settings = MockSettings(prefill_ms=10, tokens_per_second=1000, stream_tokens=4, internal_tokens=4)
+    ports = range(args.port, args.port + 3) if args.port else [0] * 3
+    servers = {f"http://127.0.0.1:{server.server_address[1]}": server
+               for server in (start_mock_ollama(port, settings) for port in ports)}
+    failures = []
+    for check in (check_model_routing, check_least_outstanding, check_ejection_and_retry):
+        errors = check(servers)
+        print(f"{check.__name__:<28}{'FAIL' if errors else 'ok'}")
+        failures.extend(errors)
+    for server in servers.values():
+        server.shutdown()
+    if failures:
+        print("\n".join(failures))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
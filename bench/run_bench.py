@@ -0,0 +1,328 @@
+"""可重現的離線壓測：啟動假 Ollama 與假搜尋服務，以子行程啟動代理，並以指定並行度驅動各個路由。
+
+    python bench/run_bench.py --concurrency 1,4,16 --requests 32 --json bench_result.json
+    python bench/run_bench.py --baseline bench_result.json --max-regression 0.2
+    python bench/run_bench.py --routes vision,passthrough --payload-kb 8192
+    python bench/run_bench.py --ollama-nodes 3 --concurrency 16
+
+回報首個 token 延遲 (TTFT)、整體延遲的 p50/p95/p99、每個請求的 tokens/s，
+以及相對於直接呼叫假 Ollama 的代理額外開銷與代理行程的 RSS 峰值。指定 --baseline 時，p95 退步超過門檻即以非零狀態結束。
+--ollama-nodes 大於 1 時在連續的埠上啟動多個假 Ollama 並以 OLLAMA_NODES 交給代理，結束時列出各節點收到的請求數。
+"""
+import argparse
+import base64
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from fake_web import WebSettings, start_fake_web
+from mock_ollama import MockSettings, start_mock_ollama
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ROUTES = ("standard", "search", "vision", "passthrough")
+# 低於此值的差異視為量測雜訊，不判定為退步
+NOISE_FLOOR_MS = 10.0
+
+
+def percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+def build_request(route: str, index: int, model: str, payload_kb: int = 0) -> tuple[str, dict, bool]:
+    """回傳 (路徑, JSON 內容, 是否為串流)；每個請求的問題都不同，避免命中代理的各層快取。
+
+    `payload_kb` > 0 時把圖片與 passthrough 的輸入放大到約該大小，用於觀察大型本文的記憶體用量。
+    """
+    if route == "standard":
+        content = f"Benchmark question {index}: explain how connection pooling reduces latency."
+        return "/api/chat", {"model": model, "stream": True,
+                             "messages": [{"role": "user", "content": content}]}, True
+    if route == "search":
+        content = f"@網路搜尋 benchmark topic {index} latest results"
+        return "/api/chat", {"model": model, "stream": True,
+                             "messages": [{"role": "user", "content": content}]}, True
+    if route == "vision":
+        seed = f"synthetic-image-{index}".encode()
+        repeat = max(64, payload_kb * 768 // len(seed)) if payload_kb else 64
+        image = base64.b64encode(seed * repeat).decode()
+        return "/api/chat", {"model": model, "stream": True, "messages": [
+            {"role": "user", "content": f"Describe image {index}.",
+             "images": [f"data:image/png;base64,{image}"]}]}, True
+    if route == "passthrough":
+        text = f"benchmark passthrough {index}"
+        if payload_kb:
+            text = (text + " ") * (payload_kb * 1024 // (len(text) + 1))
+        return "/api/embed", {"model": model, "input": text}, False
+    raise ValueError(f"unknown route: {route}")
+
+
+def is_token_line(line: bytes) -> bool:
+    """是否為帶有模型輸出的串流事件；代理提早送出的進度/保活事件 (SSE 註解、空內容的 NDJSON) 不算。
+
+    PROGRESS_EVENTS=thinking 的狀態文字與模型的思考內容無法區分，壓測時請使用預設的 keepalive 模式。
+    """
+    line = line.strip()
+    if line.startswith(b"data:"):
+        if line == b"data: [DONE]":
+            return False
+        try:
+            choices = json.loads(line[5:]).get("choices") or [{}]
+        except ValueError:
+            return False
+        delta = choices[0].get("delta") or {}
+        return bool(delta.get("content") or delta.get("reasoning") or delta.get("tool_calls"))
+    if not line or line.startswith(b":"):
+        return False
+    try:
+        data = json.loads(line)
+    except ValueError:
+        return False
+    message = data.get("message") or {}
+    return not data.get("done", False) and bool(
+        message.get("content") or message.get("thinking") or message.get("tool_calls") or data.get("response"))
+
+
+def timed_request(session: requests.Session, base_url: str, path: str, payload: dict, stream: bool) -> dict:
+    """TTFB 為收到任何位元組的時間 (可能是進度事件)，TTFT 為收到第一個模型 token 的時間。"""
+    started = time.perf_counter()
+    ttfb = ttft = None
+    tokens = 0
+    pending = b""
+    try:
+        with session.post(base_url + path, json=payload, stream=stream, timeout=(5, 600)) as response:
+            for chunk in response.iter_content(chunk_size=None):
+                if ttfb is None and chunk.strip():
+                    ttfb = time.perf_counter() - started
+                if not stream:
+                    continue
+                *lines, pending = (pending + chunk).split(b"\n")
+                for line in lines:
+                    if is_token_line(line):
+                        tokens += 1
+                        if ttft is None:
+                            ttft = time.perf_counter() - started
+            tokens += is_token_line(pending)
+            ok = response.status_code == 200
+    except requests.exceptions.RequestException:
+        ok = False
+    total = time.perf_counter() - started
+    ttft = total if ttft is None else ttft
+    ttfb = ttft if ttfb is None else ttfb
+    decode_seconds = total - ttft
+    return {"ok": ok, "ttfb": ttfb, "ttft": ttft, "total": total, "tokens": tokens,
+            "tokens_per_second": tokens / decode_seconds if tokens and decode_seconds > 0 else 0.0}
+
+
+def run_level(base_url: str, route: str, concurrency: int, count: int, model: str, offset: int,
+              payload_kb: int = 0) -> list[dict]:
+    local = threading.local()
+
+    def one(index: int) -> dict:
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        path, payload, stream = build_request(route, offset + index, model, payload_kb)
+        return timed_request(local.session, base_url, path, payload, stream)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(one, range(count)))
+
+
+def summarize(samples: list[dict]) -> dict:
+    ok = [s for s in samples if s["ok"]]
+    ttfb = [s["ttfb"] * 1000 for s in ok]
+    ttft = [s["ttft"] * 1000 for s in ok]
+    total = [s["total"] * 1000 for s in ok]
+    rates = [s["tokens_per_second"] for s in ok if s["tokens_per_second"]]
+    return {"requests": len(samples), "errors": len(samples) - len(ok),
+            "ttfb_ms": {f"p{p}": round(percentile(ttfb, p), 1) for p in (50, 95, 99)},
+            "ttft_ms": {f"p{p}": round(percentile(ttft, p), 1) for p in (50, 95, 99)},
+            "total_ms": {f"p{p}": round(percentile(total, p), 1) for p in (50, 95, 99)},
+            "tokens_per_second": round(sum(rates) / len(rates), 1) if rates else 0.0}
+
+
+def free_port() -> int:
+    """代理在子行程中啟動，無法直接綁定埠 0，先向作業系統取得一個目前未使用的埠。"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_proxy(server: str, port: int, ollama_url: str, search_endpoint: str, workdir: str,
+                extra_env: dict | None = None) -> subprocess.Popen:
+    env = dict(os.environ,
+               PROXY_PORT=str(port), OLLAMA_BASE_URL=ollama_url,
+               GOOGLE_API_KEY="bench", GOOGLE_CSE_ID="bench", GOOGLE_SEARCH_ENDPOINT=search_endpoint,
+               GOOGLE_SEARCH_DAILY_LIMIT="1000000",
+               USAGE_DB_PATH=os.path.join(workdir, "usage.sqlite3"),
+               SEARCH_CACHE_PATH=os.path.join(workdir, "search_cache.sqlite3"),
+               VISION_CACHE_DIR=os.path.join(workdir, "vision_cache"), **(extra_env or {}))
+    script = "asgi_server.py" if server == "asgi" else "proxy_server.py"
+    log = open(os.path.join(workdir, "proxy.log"), "wb")
+    process = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, script)],
+                               cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"proxy exited early, see {log.name}")
+        try:
+            requests.get(f"http://127.0.0.1:{port}/proxy/stats", timeout=1)
+            return process
+        except requests.exceptions.RequestException:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"proxy did not start within 60s, see {log.name}")
+
+
+def reset_peak_rss(pid: int):
+    """寫入 5 到 clear_refs 會把 VmHWM 重設為目前的 RSS (Linux)，讓每個路由各自量測峰值。"""
+    try:
+        with open(f"/proc/{pid}/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_mb(pid: int) -> float | None:
+    try:
+        with open(f"/proc/{pid}/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+def compare(results: dict, baseline: dict, max_regression: float) -> list[str]:
+    regressions = []
+    for key, current in results["levels"].items():
+        previous = baseline.get("levels", {}).get(key)
+        if not previous:
+            continue
+        for metric in ("ttft_ms", "total_ms"):
+            before, after = previous[metric]["p95"], current[metric]["p95"]
+            if after - before > NOISE_FLOOR_MS and after > before * (1 + max_regression):
+                regressions.append(f"{key} {metric} p95: {before:.1f} -> {after:.1f} ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load/latency benchmark for the proxy.")
+    parser.add_argument("--server", choices=("flask", "asgi"), default="flask")
+    parser.add_argument("--routes", default=",".join(ROUTES))
+    parser.add_argument("--concurrency", default="1,4,16")
+    parser.add_argument("--requests", type=int, default=32, help="requests per route and concurrency level")
+    parser.add_argument("--proxy-url", help="benchmark an already running proxy instead of starting one")
+    # 埠號預設為 0：由作業系統分配未使用的臨時埠，避免與其他程式衝突
+    parser.add_argument("--proxy-port", type=int, default=0)
+    parser.add_argument("--ollama-port", type=int, default=0)
+    parser.add_argument("--ollama-nodes", type=int, default=1,
+                        help="start this many mock Ollama nodes on consecutive ports from --ollama-port "
+                             "(ephemeral ports when --ollama-port is 0)")
+    parser.add_argument("--web-port", type=int, default=0)
+    parser.add_argument("--prefill-ms", type=float, default=MockSettings.prefill_ms)
+    parser.add_argument("--tokens-per-second", type=float, default=MockSettings.tokens_per_second)
+    parser.add_argument("--stream-tokens", type=int, default=MockSettings.stream_tokens)
+    parser.add_argument("--internal-tokens", type=int, default=MockSettings.internal_tokens)
+    parser.add_argument("--search-ms", type=float, default=WebSettings.search_ms)
+    parser.add_argument("--page-ms", type=float, default=WebSettings.page_ms)
+    parser.add_argument("--model", default="bench-model")
+    parser.add_argument("--proxy-env", action="append", default=[], metavar="KEY=VALUE",
+                        help="extra environment for the proxy, e.g. --proxy-env EMBED_BATCHING=false")
+    parser.add_argument("--payload-kb", type=int, default=0,
+                        help="enlarge vision images and passthrough inputs to about this many KiB")
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--baseline", help="compare against a previous --json result")
+    parser.add_argument("--max-regression", type=float, default=0.2)
+    args = parser.parse_args()
+
+    routes = [r.strip() for r in args.routes.split(",") if r.strip()]
+    levels = [int(c) for c in args.concurrency.split(",") if c.strip()]
+    settings = MockSettings(args.prefill_ms, args.tokens_per_second, args.stream_tokens, args.internal_tokens)
+    count = max(1, args.ollama_nodes)
+    ports = range(args.ollama_port, args.ollama_port + count) if args.ollama_port else [0] * count
+    nodes = {f"http://127.0.0.1:{server.server_address[1]}": server
+             for server in (start_mock_ollama(port, settings) for port in ports)}
+    # 直接量測 (代理開銷的基準) 一律使用第一個節點
+    ollama_url = next(iter(nodes))
+    proxy_env = dict(item.split("=", 1) for item in args.proxy_env)
+    if len(nodes) > 1:
+        proxy_env.setdefault("OLLAMA_NODES", ",".join(nodes))
+    web_port = start_fake_web(args.web_port, WebSettings(args.search_ms, args.page_ms)).server_address[1]
+
+    process = None
+    workdir = tempfile.mkdtemp(prefix="ollama-bridge-bench-")
+    if args.proxy_url:
+        base_url = args.proxy_url.rstrip("/")
+    else:
+        proxy_port = args.proxy_port or free_port()
+        process = start_proxy(args.server, proxy_port, ollama_url,
+                              f"http://127.0.0.1:{web_port}/", workdir,
+                              proxy_env)
+        base_url = f"http://127.0.0.1:{proxy_port}"
+
+    results = {"config": vars(args), "levels": {}}
+    offset = 0
+    try:
+        print(f"{'route':<12}{'conc':>5}{'n':>5}{'err':>5}{'ttfb p50':>10}"
+              f"{'ttft p50':>10}{'p95':>9}{'p99':>9}{'total p50':>11}{'p95':>9}{'p99':>9}"
+              f"{'tok/s':>8}{'overhead':>10}{'peak MB':>9}")
+        for concurrency in levels:
+            # 代理開銷 = 經由代理的 TTFT p50 − 直接呼叫假 Ollama 同類端點的 TTFT p50
+            direct = {}
+            for kind in ("standard", "passthrough"):
+                direct[kind] = summarize(run_level(ollama_url, kind, concurrency, args.requests, args.model, offset))
+                offset += args.requests
+                results["levels"][f"direct_{kind}@{concurrency}"] = direct[kind]
+            for route in routes:
+                if process is not None:
+                    reset_peak_rss(process.pid)
+                summary = summarize(run_level(base_url, route, concurrency, args.requests, args.model, offset,
+                                              args.payload_kb))
+                offset += args.requests
+                # 代理行程在此路由期間的 RSS 峰值；以 --proxy-url 測試外部代理時無法取得
+                summary["peak_rss_mb"] = peak_rss_mb(process.pid) if process is not None else None
+                reference = direct["passthrough" if route == "passthrough" else "standard"]
+                summary["overhead_ms"] = round(summary["ttft_ms"]["p50"] - reference["ttft_ms"]["p50"], 1)
+                results["levels"][f"{route}@{concurrency}"] = summary
+                ttft, total = summary["ttft_ms"], summary["total_ms"]
+                print(f"{route:<12}{concurrency:>5}{summary['requests']:>5}{summary['errors']:>5}"
+                      f"{summary['ttfb_ms']['p50']:>10.1f}{ttft['p50']:>10.1f}{ttft['p95']:>9.1f}{ttft['p99']:>9.1f}"
+                      f"{total['p50']:>11.1f}{total['p95']:>9.1f}{total['p99']:>9.1f}"
+                      f"{summary['tokens_per_second']:>8.1f}{summary['overhead_ms']:>10.1f}"
+                      f"{summary['peak_rss_mb'] or '-':>9}")
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=10)
+
+    if len(nodes) > 1:
+        # 包含直接量測打在第一個節點上的請求
+        results["nodes"] = {url: server.state["requests"] for url, server in nodes.items()}
+        print("requests per node: " + ", ".join(f"{url} {count}" for url, count in results["nodes"].items()))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.max_regression)
+        if regressions:
+            print("Regressions detected:\n  " + "\n  ".join(regressions))
+            sys.exit(1)
+        print("No regressions against baseline.")
+
+
+if __name__ == "__main__":
+    main()
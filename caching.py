@@ -0,0 +1,87 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+
+
+def normalize_text(text: str) -> str:
+    """快取鍵用的文字正規化：合併空白並轉為小寫，讓僅差在格式的查詢或問題共用同一個項目。"""
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+class LRUCache:
+    """執行緒安全的 LRU 快取，支援 TTL 與依權重 (例如位元組數) 設定容量上限。"""
+
+    def __init__(self, maxsize: int = 1024, ttl: float | None = None,
+                 max_weight: int | None = None, weigher=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_weight = max_weight
+        self.weigher = weigher or (lambda value: 1)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, weight, expires_at = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl: float | None = None):
+        weight = self.weigher(value)
+        if self.max_weight is not None and weight > self.max_weight:
+            return
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (value, weight, expires_at)
+            self.weight += weight
+            while self._data and (len(self._data) > self.maxsize or
+                                   (self.max_weight is not None and self.weight > self.max_weight)):
+                oldest = next(iter(self._data))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            value = self._data[key][0]
+            self._remove(key)
+            return value
+
+    def keys(self) -> list:
+        with self._lock:
+            return list(self._data.keys())
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.weight = 0
+
+    def _remove(self, key):
+        _, weight, _ = self._data.pop(key)
+        self.weight -= weight
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._data), "weight": self.weight, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions}
@@ -0,0 +1,105 @@
+import hashlib
+import json
+import logging
+import re
+
+from caching import LRUCache
+
+logger = logging.getLogger(__name__)
+
+IMAGE_TOKEN_ESTIMATE = 256
+MESSAGE_OVERHEAD_TOKENS = 4
+_CJK = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]")
+
+
+def message_text(message: dict) -> str:
+    """同時支援 LobeChat (content 為字串、圖片在 images) 與 OpenAI/Cherry Studio (content 為 parts 陣列) 的格式。"""
+    content = message.get("content")
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "\n".join(part.get("text", "") for part in content
+                         if isinstance(part, dict) and part.get("type") == "text")
+    return ""
+
+
+def _image_count(message: dict) -> int:
+    count = len(message.get("images") or [])
+    if isinstance(message.get("content"), list):
+        count += sum(1 for part in message["content"]
+                     if isinstance(part, dict) and part.get("type") == "image_url")
+    return count
+
+
+def estimate_tokens(message: dict) -> int:
+    """粗估 token 數：CJK 字元約一字一 token，其餘約四個字元一 token。"""
+    text = message_text(message)
+    cjk = len(_CJK.findall(text))
+    return (MESSAGE_OVERHEAD_TOKENS + cjk + (len(text) - cjk + 3) // 4
+            + IMAGE_TOKEN_ESTIMATE * _image_count(message))
+
+
+def _chain_hashes(messages: list[dict]) -> list[str]:
+    """hashes[i] 為前 i 則訊息的雜湊，同一段對話的前綴在每一輪都會得到相同的鍵。"""
+    hashes = [hashlib.sha256(b"conversation").hexdigest()]
+    for message in messages:
+        canonical = json.dumps([message.get("role"), message.get("content"), message.get("images")],
+                               ensure_ascii=False, sort_keys=True)
+        hashes.append(hashlib.sha256(f"{hashes[-1]}\0{canonical}".encode("utf-8")).hexdigest())
+    return hashes
+
+
+class ConversationWindow:
+    """在 token 預算內保留最近的對話原文，較早的對話以滾動摘要取代。
+
+    摘要以「訊息前綴雜湊」為鍵快取；每輪只需摘要新溢出的訊息，且溢出後一次保留到
+    `keep_ratio` 的預算，接下來幾輪都能直接沿用同一份摘要。
+    """
+
+    def __init__(self, summarizer, budget_tokens: int = 6000, keep_ratio: float = 0.6,
+                 cache_size: int = 1024, cache_ttl: float = 86400):
+        self.summarizer = summarizer
+        self.budget_tokens = budget_tokens
+        self.keep_ratio = keep_ratio
+        self.cache = LRUCache(maxsize=cache_size, ttl=cache_ttl)
+        self.summaries = 0
+
+    def fit(self, messages: list[dict]) -> tuple[str | None, list[dict]]:
+        """回傳 (較早對話的摘要或 None, 需原文保留的最近訊息)。"""
+        costs = [estimate_tokens(m) for m in messages]
+        if len(messages) < 2 or sum(costs) <= self.budget_tokens:
+            return None, messages
+        suffix = [0] * (len(messages) + 1)
+        for i in range(len(messages) - 1, -1, -1):
+            suffix[i] = suffix[i + 1] + costs[i]
+        hashes = _chain_hashes(messages)
+
+        cached = {}
+        for i in range(len(messages) - 1, 0, -1):
+            summary = self.cache.get(hashes[i])
+            if summary is None:
+                continue
+            cached[i] = summary
+            if suffix[i] + estimate_tokens({"content": summary}) <= self.budget_tokens:
+                return summary, messages[i:]
+
+        target = self.budget_tokens * self.keep_ratio
+        split = next(i for i in range(1, len(messages)) if suffix[i] <= target or i == len(messages) - 1)
+        while split < len(messages) - 1 and messages[split].get("role") != "user":
+            split += 1
+        base = max((i for i in cached if i <= split), default=0)
+        previous = cached.get(base)
+        if base == split:
+            return previous, messages[split:]
+        summary = self.summarizer(previous, messages[base:split])
+        if not summary:
+            logger.warning(f"對話摘要失敗，捨棄第 {base + 1}-{split} 則訊息。")
+            return previous, messages[split:]
+        self.summaries += 1
+        self.cache.set(hashes[split], summary)
+        logger.info(f"對話超過 {self.budget_tokens} tokens 預算，已摘要第 {base + 1}-{split} 則訊息。")
+        return summary, messages[split:]
+
+    def stats(self) -> dict:
+        return {"budget_tokens": self.budget_tokens, "summaries": self.summaries,
+                "cache": self.cache.stats()}
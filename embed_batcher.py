@@ -0,0 +1,201 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+import requests
+
+from caching import LRUCache
+from metrics import EMBED_BATCH_SIZE, EMBED_BATCH_WAIT
+from ollama_client import OllamaClient
+
+logger = logging.getLogger(__name__)
+
+
+class EmbedUpstreamError(requests.exceptions.RequestException):
+    """上游回應 HTTP 錯誤；保留原始狀態碼與本文，原樣回傳給客戶端。"""
+
+    def __init__(self, status_code: int, body: bytes, content_type: str | None):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+        self.body = body
+        self.content_type = content_type
+
+
+class _Batch:
+    def __init__(self):
+        self.items = []
+        self.inputs = 0
+        self.full = threading.Event()
+
+
+class _Item:
+    def __init__(self, texts: list[str]):
+        self.texts = texts
+        self.future = Future()
+        self.enqueued = time.monotonic()
+
+
+class EmbedBatcher:
+    """把同一模型、同一參數的並行 /api/embed 請求合併成一次上游調用，再把向量依序分回給各請求。
+
+    第一個到達的請求等待 `window` 秒（或直到累積 `max_batch` 個輸入）後送出整批；
+    代價是單獨到達的請求最多多等一個 `window`。`cache_size` > 0 時以內容雜湊快取向量。
+    舊版 /api/embeddings 一次只接受一個 prompt 且不做正規化，無法合併，只使用快取。
+    """
+
+    def __init__(self, client: OllamaClient, window: float = 0.005, max_batch: int = 64,
+                 cache_size: int = 0, cache_ttl: float = 3600):
+        self.client = client
+        self.window = window
+        self.max_batch = max_batch
+        self.cache = LRUCache(maxsize=cache_size, ttl=cache_ttl) if cache_size > 0 else None
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.batches = 0
+        self.batched_inputs = 0
+        self.batched_requests = 0
+        self.fallbacks = 0
+        self.wait_seconds = 0.0
+        self.upstream_seconds = 0.0
+
+    @staticmethod
+    def batchable(payload: dict) -> bool:
+        texts = payload.get("input")
+        if isinstance(texts, str):
+            return bool(payload.get("model"))
+        return (bool(payload.get("model")) and isinstance(texts, list) and bool(texts)
+                and all(isinstance(text, str) for text in texts))
+
+    @staticmethod
+    def _batch_key(payload: dict, text_field: str) -> str:
+        params = {k: v for k, v in payload.items() if k != text_field}
+        return json.dumps(params, sort_keys=True, ensure_ascii=False)
+
+    @staticmethod
+    def _cache_key(batch_key: str, text: str) -> str:
+        return hashlib.sha256(f"{batch_key}\0{text}".encode("utf-8")).hexdigest()
+
+    def embed(self, payload: dict) -> dict:
+        """處理 /api/embed 請求本文；`batchable(payload)` 必須為 True。"""
+        texts = payload["input"]
+        texts = [texts] if isinstance(texts, str) else texts
+        key = self._batch_key(payload, "input")
+        with self._lock:
+            self.requests += 1
+        vectors = [None] * len(texts)
+        missing = list(range(len(texts)))
+        if self.cache is not None:
+            for i, text in enumerate(texts):
+                vectors[i] = self.cache.get(self._cache_key(key, text))
+            missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            fetched = self._submit(key, payload, [texts[i] for i in missing])
+            for i, vector in zip(missing, fetched):
+                vectors[i] = vector
+                if self.cache is not None:
+                    self.cache.set(self._cache_key(key, texts[i]), vector)
+        return {"model": payload["model"], "embeddings": vectors}
+
+    def embeddings(self, payload: dict) -> dict:
+        """處理舊版 /api/embeddings (單一 prompt)：只經過快取，不合併。"""
+        key = self._batch_key(payload, "prompt")
+        cache_key = self._cache_key(key, str(payload.get("prompt", "")))
+        if self.cache is not None:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return {"embedding": cached}
+        body = self._post("/api/embeddings", payload)
+        if self.cache is not None and body.get("embedding"):
+            self.cache.set(cache_key, body["embedding"])
+        return body
+
+    def _post(self, path: str, payload: dict) -> dict:
+        response = self.client.post("client_embed", path, json=payload)
+        if response.status_code >= 400:
+            raise EmbedUpstreamError(response.status_code, response.content,
+                                     response.headers.get("content-type"))
+        return response.json()
+
+    def _submit(self, key: str, payload: dict, texts: list[str]) -> list:
+        item = _Item(texts)
+        leader = False
+        with self._lock:
+            batch = self._pending.get(key)
+            if batch is None:
+                batch = self._pending[key] = _Batch()
+                leader = True
+            batch.items.append(item)
+            batch.inputs += len(texts)
+            if batch.inputs >= self.max_batch or self.window <= 0:
+                del self._pending[key]
+                batch.full.set()
+        if leader:
+            batch.full.wait(self.window)
+            with self._lock:
+                if self._pending.get(key) is batch:
+                    del self._pending[key]
+            self._flush(payload, batch)
+        return item.future.result()
+
+    def _flush(self, payload: dict, batch: _Batch):
+        started = time.monotonic()
+        texts = [text for item in batch.items for text in item.texts]
+        EMBED_BATCH_SIZE.observe(len(texts))
+        for item in batch.items:
+            EMBED_BATCH_WAIT.observe(started - item.enqueued)
+        with self._lock:
+            self.batches += 1
+            self.batched_inputs += len(texts)
+            self.batched_requests += len(batch.items)
+            self.wait_seconds += sum(started - item.enqueued for item in batch.items)
+        try:
+            vectors = self._post("/api/embed", {**payload, "input": texts}).get("embeddings", [])
+            if len(vectors) != len(texts):
+                raise requests.exceptions.InvalidJSONError(
+                    f"上游回傳 {len(vectors)} 個向量，預期 {len(texts)} 個。")
+        except EmbedUpstreamError as e:
+            if len(batch.items) > 1 and e.status_code < 500:
+                # 可能只是其中一個請求的輸入有問題，改為逐一送出，避免拖累同批的其他請求
+                with self._lock:
+                    self.fallbacks += 1
+                logger.warning(f"合併的嵌入請求失敗 ({e})，改為逐一送出 {len(batch.items)} 個請求。")
+                for item in batch.items:
+                    self._flush_single(payload, item)
+                return
+            for item in batch.items:
+                item.future.set_exception(e)
+            return
+        except Exception as e:
+            for item in batch.items:
+                item.future.set_exception(e)
+            return
+        finally:
+            with self._lock:
+                self.upstream_seconds += time.monotonic() - started
+        offset = 0
+        for item in batch.items:
+            item.future.set_result(vectors[offset:offset + len(item.texts)])
+            offset += len(item.texts)
+
+    def _flush_single(self, payload: dict, item: _Item):
+        try:
+            item.future.set_result(self._post("/api/embed", {**payload, "input": item.texts}).get("embeddings", []))
+        except Exception as e:
+            item.future.set_exception(e)
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = {"window_ms": self.window * 1000, "max_batch": self.max_batch,
+                     "requests": self.requests, "batches": self.batches, "fallbacks": self.fallbacks,
+                     "avg_batch_inputs": round(self.batched_inputs / self.batches, 2) if self.batches else 0.0,
+                     # 合併的代價 (平均排隊時間) 與收益 (平均每次上游調用時間) 並列，方便調整 window
+                     "avg_wait_ms": (round(self.wait_seconds / self.batched_requests * 1000, 2)
+                                     if self.batched_requests else 0.0),
+                     "avg_upstream_ms": round(self.upstream_seconds / self.batches * 1000, 2) if self.batches else 0.0}
+        if self.cache is not None:
+            stats["cache"] = self.cache.stats()
+        return stats
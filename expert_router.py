@@ -0,0 +1,102 @@
+import logging
+import threading
+import time
+
+import numpy as np
+import requests
+
+from caching import LRUCache, normalize_text
+
+logger = logging.getLogger(__name__)
+
+
+class ExpertRouter:
+    """以嵌入向量相似度挑選專家，只有在分數不明確時才交由 LLM 決策。"""
+
+    def __init__(self, client, embed_model: str, expert_prompts: dict,
+                 min_score: float = 0.35, margin: float = 0.03, team_margin: float = 0.05,
+                 max_team: int = 3, cache_size: int = 1024, cache_ttl: float = 3600,
+                 rebuild_interval: float = 60):
+        self.client = client
+        self.embed_model = embed_model
+        self.expert_prompts = expert_prompts
+        self.min_score = min_score
+        self.margin = margin
+        self.team_margin = team_margin
+        self.max_team = max_team
+        self.rebuild_interval = rebuild_interval
+        self.cache = LRUCache(maxsize=cache_size, ttl=cache_ttl)
+        self._names = []
+        self._matrix = None
+        self._build_lock = threading.Lock()
+        self._thread = None
+
+    def _embed(self, texts: list[str]) -> np.ndarray:
+        response = self.client.post(
+            "embed", "/api/embed", json={"model": self.embed_model, "input": texts})
+        response.raise_for_status()
+        vectors = np.asarray(response.json()["embeddings"], dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def build(self) -> bool:
+        with self._build_lock:
+            names = list(self.expert_prompts.keys())
+            try:
+                self._matrix = self._embed(
+                    [self.expert_prompts[name] for name in names])
+            except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+                logger.warning(f"專家嵌入向量預計算失敗: {e}. 暫時使用 LLM 決策。")
+                return False
+            self._names = names
+            logger.info(
+                f"已為 {len(names)} 位專家預計算嵌入向量 (模型: {self.embed_model})。")
+            return True
+
+    def start(self):
+        """在背景預計算專家嵌入向量，失敗時每隔 `rebuild_interval` 秒重試 (例如嵌入模型尚未下載)；
+        完成前 `route()` 一律回傳 None，交由 LLM 決策，啟動與請求都不必等待嵌入調用。"""
+        if self._thread is not None:
+            return
+
+        def loop():
+            while not self.build():
+                time.sleep(self.rebuild_interval)
+        self._thread = threading.Thread(target=loop, name="expert-router-build", daemon=True)
+        self._thread.start()
+
+    @property
+    def ready(self) -> bool:
+        return self._matrix is not None
+
+    def lookup(self, question: str):
+        return self.cache.get(normalize_text(question))
+
+    def remember(self, question: str, experts: list[tuple]):
+        self.cache.set(normalize_text(question), experts)
+
+    def route(self, question: str) -> list[tuple] | None:
+        if not self.ready:
+            return None
+        try:
+            query_vector = self._embed([question])[0]
+        except (requests.exceptions.RequestException, ValueError, KeyError, IndexError) as e:
+            logger.warning(f"問題嵌入失敗: {e}. 將交由 LLM 決策。")
+            return None
+        scores = self._matrix @ query_vector
+        order = np.argsort(scores)[::-1]
+        top_score = float(scores[order[0]])
+        runner_up = float(scores[order[1]]) if len(order) > 1 else -1.0
+        if top_score < self.min_score or top_score - runner_up < self.margin:
+            logger.info(
+                f"嵌入路由分數不明確 (最高 {top_score:.3f}, 次高 {runner_up:.3f})，交由 LLM 決策。")
+            return None
+        team = [(self._names[order[0]], "High")]
+        for index in order[1:self.max_team]:
+            if top_score - float(scores[index]) <= self.team_margin:
+                team.append((self._names[index], "Medium"))
+        logger.info(f"嵌入路由選擇專家: {team} (最高分 {top_score:.3f})")
+        return team
+
+    def stats(self) -> dict:
+        return {"ready": self.ready, "experts": len(self._names), "cache": self.cache.stats()}
@@ -0,0 +1,314 @@
+import collections
+import contextlib
+import contextvars
+import logging
+import sys
+import threading
+import time
+import traceback
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames: tuple, labelvalues: tuple, le: str | None = None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, labelvalues)]
+    if le is not None:
+        pairs.append(f'le="{le}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = collections.defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            self._values[key] += amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._series.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, bound)} {bucket_count}")
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, '+Inf')} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class GaugeCallback:
+    """在輸出時才呼叫 `collect()` 取得 [(labels_dict, value), ...]，適合暴露連線池、佇列等即時狀態。"""
+
+    def __init__(self, name: str, documentation: str, collect):
+        self.name = name
+        self.documentation = documentation
+        self.collect = collect
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        try:
+            samples = self.collect()
+        except Exception as e:
+            logger.warning(f"收集指標 {self.name} 失敗: {e}")
+            return lines
+        for labels, value in samples:
+            names = tuple(labels.keys())
+            lines.append(f"{self.name}{_format_labels(names, tuple(labels.values()))} {value}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name: str, documentation: str, labelnames=()) -> Counter:
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge_callback(self, name: str, documentation: str, collect) -> GaugeCallback:
+        metric = GaugeCallback(name, documentation, collect)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+STAGE_LATENCY = REGISTRY.histogram(
+    "proxy_stage_duration_seconds", "Latency of each pipeline stage.", ["stage"])
+TIME_TO_FIRST_TOKEN = REGISTRY.histogram(
+    "proxy_time_to_first_token_seconds", "Time from request arrival to the first upstream token.", ["route"])
+REQUESTS = REGISTRY.counter(
+    "proxy_requests_total", "Requests handled, by route taken.", ["route"])
+UPSTREAM_ERRORS = REGISTRY.counter(
+    "proxy_upstream_errors_total", "Failed upstream Ollama calls.", ["profile", "kind"])
+TIME_TO_FIRST_BYTE = REGISTRY.histogram(
+    "proxy_time_to_first_byte_seconds",
+    "Time from request arrival to the first streamed byte, by whether it was a progress event or model output.",
+    ["kind"])
+TOKENS_STREAMED = REGISTRY.counter(
+    "proxy_tokens_streamed_total", "Streamed chunks (approximately tokens) relayed to clients.", ["route"])
+TOKEN_USAGE = REGISTRY.counter(
+    "proxy_token_usage_total", "Prompt and completion tokens reported by Ollama for final streams.", ["route", "kind"])
+SEARCH_PROVIDER_LATENCY = REGISTRY.histogram(
+    "proxy_search_provider_seconds", "Latency of each search backend call.", ["provider", "outcome"])
+PAGE_FETCHES = REGISTRY.counter(
+    "proxy_page_fetches_total", "Deep-browse page downloads, by outcome.", ["outcome"])
+EMBED_BATCH_SIZE = REGISTRY.histogram(
+    "proxy_embed_batch_inputs", "Inputs per coalesced upstream /api/embed call.", [],
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+EMBED_BATCH_WAIT = REGISTRY.histogram(
+    "proxy_embed_batch_wait_seconds", "Time an embed request waited for its batch to be sent.")
+RESPONSE_CACHE_LOOKUPS = REGISTRY.counter(
+    "proxy_response_cache_lookups_total", "Full-response cache lookups, by response kind and outcome.",
+    ["kind", "status"])
+ADMISSION_WAIT = REGISTRY.histogram(
+    "proxy_admission_wait_seconds", "Time spent queued for a model concurrency slot.", ["lane"])
+ADMISSION_REJECTED = REGISTRY.counter(
+    "proxy_admission_rejected_total", "Upstream calls rejected by admission control.", ["lane", "reason"])
+
+
+class RequestTrace:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans = []
+        self.route = "unknown"
+        self.first_byte = None
+        # 前置階段的進度事件接收者 (例如 ProgressChannel)，以 (事件名稱, 細節 dict) 呼叫，可能來自任何執行緒
+        self.progress_listener = None
+        self._lock = threading.Lock()
+
+    def mark_first_byte(self, kind: str):
+        with self._lock:
+            if self.first_byte is not None:
+                return
+            self.first_byte = self.elapsed()
+            self.spans.append(("ttfb", self.first_byte))
+        TIME_TO_FIRST_BYTE.observe(self.first_byte, kind=kind)
+
+    def add(self, name: str, duration: float):
+        with self._lock:
+            self.spans.append((name, duration))
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def server_timing(self) -> str:
+        with self._lock:
+            spans = list(self.spans)
+        entries = [f"{name};dur={duration * 1000:.1f}" for name, duration in spans]
+        entries.append(f"total;dur={self.elapsed() * 1000:.1f}")
+        return ", ".join(entries)
+
+
+_current_trace = contextvars.ContextVar("proxy_request_trace", default=None)
+
+
+def start_trace() -> RequestTrace:
+    trace = RequestTrace()
+    _current_trace.set(trace)
+    return trace
+
+
+def current_trace() -> RequestTrace | None:
+    return _current_trace.get()
+
+
+def set_route(route: str):
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.route = route
+    REQUESTS.inc(route=route)
+
+
+def report_progress(event: str, **detail):
+    """通知目前請求的進度接收者；沒有接收者時不做任何事。"""
+    trace = _current_trace.get()
+    listener = trace.progress_listener if trace is not None else None
+    if listener is not None:
+        listener(event, detail)
+
+
+@contextlib.contextmanager
+def stage(name: str):
+    report_progress(name)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - started
+        STAGE_LATENCY.observe(duration, stage=name)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add(name, duration)
+
+
+def submit_in_context(executor, fn, *args, **kwargs):
+    """在執行緒池中執行時保留目前請求的 trace，讓並行階段也記錄到同一個請求。"""
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+class SlowRequestProfiler:
+    """取樣式剖析器：追蹤中的請求執行緒每隔 `interval` 秒取樣一次呼叫堆疊，超過門檻時輸出最常見的堆疊。"""
+
+    def __init__(self, threshold: float, interval: float = 0.01, top: int = 10):
+        self.threshold = threshold
+        self.interval = interval
+        self.top = top
+        self._active = {}
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._sample_loop, name="slow-request-profiler", daemon=True)
+        self._thread.start()
+
+    def _sample_loop(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                active = dict(self._active)
+            if not active:
+                continue
+            frames = sys._current_frames()
+            for thread_id, samples in active.items():
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                stack = ";".join(f"{f.name}:{f.lineno}" for f in traceback.extract_stack(frame)[-12:])
+                samples[stack] += 1
+
+    @contextlib.contextmanager
+    def track(self, label: str):
+        thread_id = threading.get_ident()
+        samples = collections.Counter()
+        with self._lock:
+            self._active[thread_id] = samples
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._active.pop(thread_id, None)
+            elapsed = time.perf_counter() - started
+            if elapsed >= self.threshold and samples:
+                total = sum(samples.values())
+                report = "\n".join(f"  {count / total:6.1%}  {stack}" for stack, count in samples.most_common(self.top))
+                logger.warning(f"慢請求 {label} 耗時 {elapsed:.2f}s，取樣 {total} 次，熱點堆疊:\n{report}")
+
+
+class StreamMeter:
+    """記錄最終串流的首個 token 延遲與轉送的事件數（SSE 的 data: 行或 NDJSON 行，約等於 token 數）。"""
+
+    def __init__(self, route: str, trace: RequestTrace | None = None):
+        self.route = route
+        self.trace = trace
+        self._first = True
+
+    def observe(self, chunk: bytes):
+        self.observe_tokens(chunk.count(b"data:") or chunk.count(b"\n"))
+
+    def observe_tokens(self, count: int):
+        """StreamTranslator 合併 token 後事件數不再等於 token 數，改由它直接回報上游的 token 數。"""
+        if self._first:
+            self._first = False
+            if self.trace is not None:
+                # 沒有提早送出進度事件時，首個 token 同時也是首個位元組
+                self.trace.mark_first_byte("stream")
+                ttft = self.trace.elapsed()
+                TIME_TO_FIRST_TOKEN.observe(ttft, route=self.route)
+                self.trace.add("ttft", ttft)
+        if count:
+            TOKENS_STREAMED.inc(count, route=self.route)
+
+    def record_usage(self, prompt_tokens: int, completion_tokens: int):
+        TOKEN_USAGE.inc(prompt_tokens, route=self.route, kind="prompt")
+        TOKEN_USAGE.inc(completion_tokens, route=self.route, kind="completion")
@@ -0,0 +1,60 @@
+import logging
+import threading
+import time
+
+import requests
+
+from backend_pool import BackendPool
+
+logger = logging.getLogger(__name__)
+
+
+class ModelWarmer:
+    """啟動時及定期預先載入模型到每個可服務的 Ollama 節點，並以 `keep_alive` 讓模型常駐，閒置後的首個請求不再付出載入時間。"""
+
+    def __init__(self, backend_pool: BackendPool, models: list[str], keep_alive: str = "30m",
+                 interval: float = 600.0):
+        self.backend_pool = backend_pool
+        self.models = list(dict.fromkeys(m for m in models if m))
+        self.keep_alive = keep_alive
+        self.interval = interval
+        self._session = requests.Session()
+        self._thread = None
+        self.warmups = 0
+        self.failures = 0
+
+    def warm(self):
+        for node in self.backend_pool.nodes:
+            if not node.healthy:
+                continue
+            for model in self.models:
+                if not node.serves(model):
+                    continue
+                # 空白 prompt 只會載入模型而不產生任何內容
+                payload = {"model": model, "prompt": "", "stream": False, "keep_alive": self.keep_alive}
+                try:
+                    response = self._session.post(f"{node.url}/api/generate", json=payload, timeout=(5, 600))
+                    response.raise_for_status()
+                except requests.exceptions.RequestException as e:
+                    self.failures += 1
+                    logger.warning(f"預熱模型 '{model}' 於 {node.url} 失敗: {e}")
+                    continue
+                self.warmups += 1
+                logger.info(f"已預熱模型 '{model}' 於 {node.url} (keep_alive={self.keep_alive})")
+
+    def start(self):
+        if self._thread is not None or not self.models:
+            return
+
+        def loop():
+            while True:
+                self.warm()
+                if self.interval <= 0:
+                    return
+                time.sleep(self.interval)
+        self._thread = threading.Thread(target=loop, name="model-warmup", daemon=True)
+        self._thread.start()
+
+    def stats(self) -> dict:
+        return {"models": self.models, "keep_alive": self.keep_alive,
+                "warmups": self.warmups, "failures": self.failures}
@@ -0,0 +1,189 @@
+import logging
+import threading
+import time
+from dataclasses import dataclass
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from admission import ModelScheduler
+from backend_pool import BackendPool, OllamaNode
+from metrics import UPSTREAM_ERRORS
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class CallProfile:
+    pool_size: int
+    connect_timeout: float
+    read_timeout: float | None
+    pool_timeout: float = 30.0
+    retries: int = 1
+    lane: str = "internal"
+
+
+# 每種調用類型各自擁有一個連線池，避免長時間的串流佔滿短小的內部調用所需的連線。
+DEFAULT_PROFILES = {
+    "query": CallProfile(pool_size=8, connect_timeout=5, read_timeout=45),
+    "relevance": CallProfile(pool_size=8, connect_timeout=5, read_timeout=45),
+    "decision": CallProfile(pool_size=8, connect_timeout=5, read_timeout=90),
+    "embed": CallProfile(pool_size=8, connect_timeout=5, read_timeout=30),
+    "summary": CallProfile(pool_size=6, connect_timeout=5, read_timeout=180, lane="background"),
+    "vision": CallProfile(pool_size=4, connect_timeout=5, read_timeout=300, lane="background"),
+    "stream": CallProfile(pool_size=32, connect_timeout=5, read_timeout=None, lane="stream"),
+    "client_embed": CallProfile(pool_size=8, connect_timeout=5, read_timeout=120, lane="stream"),
+    "passthrough": CallProfile(pool_size=16, connect_timeout=5, read_timeout=None, retries=0, lane="stream"),
+}
+
+
+class OllamaPoolTimeout(requests.exceptions.RequestException):
+    pass
+
+
+class _ProfilePool:
+    def __init__(self, name: str, profile: CallProfile, hosts: int = 1):
+        self.name = name
+        self.profile = profile
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=hosts,
+                              pool_maxsize=profile.pool_size, pool_block=False)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._slots = threading.BoundedSemaphore(profile.pool_size)
+        self._lock = threading.Lock()
+        self.in_use = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.requests = 0
+
+    def acquire(self):
+        if not self._slots.acquire(blocking=False):
+            started = time.monotonic()
+            with self._lock:
+                self.waits += 1
+            acquired = self._slots.acquire(timeout=self.profile.pool_timeout)
+            with self._lock:
+                self.wait_seconds += time.monotonic() - started
+            if not acquired:
+                UPSTREAM_ERRORS.inc(profile=self.name, kind="pool_timeout")
+                raise OllamaPoolTimeout(
+                    f"連線池 '{self.name}' 已滿，等待 {self.profile.pool_timeout}s 後仍無可用連線。")
+        with self._lock:
+            self.in_use += 1
+            self.requests += 1
+
+    def release(self):
+        with self._lock:
+            self.in_use -= 1
+        self._slots.release()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"pool_size": self.profile.pool_size, "in_use": self.in_use,
+                    "available": self.profile.pool_size - self.in_use, "waits": self.waits,
+                    "wait_seconds": round(self.wait_seconds, 3), "requests": self.requests}
+
+
+class OllamaClient:
+    """所有對 Ollama 的 HTTP 往返都經由此客戶端，以重用 keep-alive 連線並在多個節點間分流。"""
+
+    def __init__(self, base_url: str | None = None, profiles: dict | None = None,
+                 backend_pool: BackendPool | None = None, scheduler: ModelScheduler | None = None):
+        self.backend_pool = backend_pool or BackendPool([OllamaNode(base_url)])
+        self.scheduler = scheduler
+        hosts = len(self.backend_pool.nodes)
+        self._pools = {name: _ProfilePool(name, profile, hosts)
+                       for name, profile in (profiles or DEFAULT_PROFILES).items()}
+
+    def request(self, profile: str, method: str, path: str, stream: bool = False,
+                model: str | None = None, **kwargs) -> requests.Response:
+        pool = self._pools[profile]
+        kwargs.setdefault("timeout", (pool.profile.connect_timeout,
+                                      pool.profile.read_timeout))
+        if model is None and isinstance(kwargs.get("json"), dict):
+            model = kwargs["json"].get("model")
+        admitted = self.scheduler is not None and model is not None
+        if admitted:
+            self.scheduler.acquire(model, pool.profile.lane)
+        try:
+            pool.acquire()
+        except BaseException:
+            if admitted:
+                self.scheduler.release(model, pool.profile.lane)
+            raise
+
+        def release_slots():
+            pool.release()
+            if admitted:
+                self.scheduler.release(model, pool.profile.lane)
+        try:
+            response, node = self._send_with_retry(
+                pool, method, path, stream, model, kwargs)
+        except BaseException:
+            release_slots()
+            raise
+        ok = response.status_code < 500
+        if not stream:
+            self.backend_pool.release(node, ok, model)
+            release_slots()
+            return response
+        self._release_on_close(response, lambda: (
+            self.backend_pool.release(node, ok, model), release_slots()))
+        return response
+
+    def _send_with_retry(self, pool: _ProfilePool, method: str, path: str, stream: bool,
+                         model: str | None, kwargs: dict):
+        tried = []
+        attempts = pool.profile.retries + 1
+        for attempt in range(attempts):
+            node = self.backend_pool.acquire(model, exclude=tried)
+            tried.append(node)
+            is_last = attempt + 1 >= attempts or not self.backend_pool.has_alternative(model, tried)
+            try:
+                response = pool.session.request(
+                    method, f"{node.url}/{path.lstrip('/')}", stream=stream, **kwargs)
+            except requests.exceptions.ConnectionError as e:
+                self.backend_pool.release(node, False)
+                UPSTREAM_ERRORS.inc(profile=pool.name, kind="connection")
+                if is_last:
+                    raise
+                logger.warning(f"Ollama 節點 {node.url} 連線失敗 ({e})，改由其他節點重試。")
+                continue
+            except BaseException as e:
+                self.backend_pool.release(node, False)
+                if isinstance(e, requests.exceptions.RequestException):
+                    UPSTREAM_ERRORS.inc(profile=pool.name, kind=type(e).__name__)
+                raise
+            if response.status_code >= 500:
+                UPSTREAM_ERRORS.inc(profile=pool.name, kind=f"http_{response.status_code}")
+            if response.status_code >= 500 and not stream and not is_last:
+                self.backend_pool.release(node, False)
+                logger.warning(
+                    f"Ollama 節點 {node.url} 回應 HTTP {response.status_code}，改由其他節點重試。")
+                continue
+            return response, node
+
+    def post(self, profile: str, path: str, stream: bool = False, **kwargs) -> requests.Response:
+        return self.request(profile, "POST", path, stream=stream, **kwargs)
+
+    @staticmethod
+    def _release_on_close(response: requests.Response, release):
+        original_close = response.close
+        released = threading.Event()
+
+        def close():
+            try:
+                original_close()
+            finally:
+                if not released.is_set():
+                    released.set()
+                    release()
+        response.close = close
+
+    def stats(self) -> dict:
+        return {name: pool.stats() for name, pool in self._pools.items()}
+
+    def close(self):
+        for pool in self._pools.values():
+            pool.session.close()
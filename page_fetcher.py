@@ -0,0 +1,143 @@
+import logging
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+
+from caching import LRUCache
+from metrics import PAGE_FETCHES
+
+logger = logging.getLogger(__name__)
+
+HTML_CONTENT_TYPES = ("text/html", "application/xhtml+xml", "text/plain")
+
+
+class PageFetchError(requests.exceptions.RequestException):
+    """下載被拒絕或中止；`reason` 例如 content_type、too_large、deadline、host_backoff。"""
+
+    def __init__(self, reason: str, message: str):
+        super().__init__(message)
+        self.reason = reason
+
+
+class PageFetcher:
+    """深度瀏覽專用的下載器：串流讀取並限制位元組數與總時間，只接受 HTML/純文字，並暫時略過持續失敗的主機。
+
+    requests 的 HTTPAdapter 底層為每個主機各自維護一個連線池，`pool_hosts` 為保留的主機數量。
+    """
+
+    def __init__(self, max_bytes: int = 2 * 1024 * 1024, connect_timeout: float = 5.0,
+                 read_timeout: float = 10.0, total_timeout: float = 20.0, pool_hosts: int = 64,
+                 pool_size: int = 4, failure_threshold: int = 3, failure_ttl: float = 600.0,
+                 chunk_size: int = 65536):
+        self.max_bytes = max_bytes
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.total_timeout = total_timeout
+        self.failure_threshold = failure_threshold
+        self.chunk_size = chunk_size
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["User-Agent"] = "Mozilla/5.0 (compatible; ollama-bridge/1.0)"
+        self.session.headers["Accept"] = "text/html,application/xhtml+xml;q=0.9,text/plain;q=0.8"
+        self._host_failures = LRUCache(maxsize=1024, ttl=failure_ttl)
+        self._lock = threading.Lock()
+        self.outcomes = {}
+        self.bytes_downloaded = 0
+
+    def _count(self, outcome: str, downloaded: int = 0):
+        PAGE_FETCHES.inc(outcome=outcome)
+        with self._lock:
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+            self.bytes_downloaded += downloaded
+
+    def _host_failed(self, host: str):
+        with self._lock:
+            failures = self._host_failures.get(host, 0) + 1
+            self._host_failures.set(host, failures)
+        if failures == self.failure_threshold:
+            logger.warning(f"主機 {host} 連續失敗 {failures} 次，暫時略過。")
+
+    def _reject(self, reason: str, message: str, host: str | None = None):
+        self._count(reason)
+        if host:
+            self._host_failed(host)
+        raise PageFetchError(reason, message)
+
+    def _chunks(self, response: requests.Response):
+        """urllib3 2.x 的 read1 只要有資料就回傳，不會為了湊滿一個區塊而卡住，總時間檢查才能準時生效。"""
+        read1 = getattr(response.raw, "read1", None)
+        if read1 is None:
+            yield from response.iter_content(self.chunk_size)
+            return
+        try:
+            while chunk := read1(self.chunk_size, decode_content=True):
+                yield chunk
+        except urllib3.exceptions.HTTPError as e:
+            raise requests.exceptions.ConnectionError(e) from e
+
+    def fetch(self, url: str, etag: str | None = None, last_modified: str | None = None,
+              cancelled: threading.Event | None = None):
+        """回傳 (內容位元組或 None 表示 304 未修改, ETag, Last-Modified)；被拒絕或失敗時拋出 RequestException。"""
+        host = urlsplit(url).netloc.lower()
+        if self._host_failures.get(host, 0) >= self.failure_threshold:
+            self._reject("host_backoff", f"主機 {host} 近期持續失敗，略過 {url}")
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        deadline = time.monotonic() + self.total_timeout
+        try:
+            response = self.session.get(url, headers=headers, stream=True,
+                                        timeout=(self.connect_timeout, self.read_timeout))
+        except requests.exceptions.RequestException:
+            self._count("error")
+            self._host_failed(host)
+            raise
+        with response:
+            if response.status_code == 304:
+                self._count("not_modified")
+                return None, etag, last_modified
+            if response.status_code >= 400:
+                self._count("http_error")
+                if response.status_code >= 500:
+                    self._host_failed(host)
+                response.raise_for_status()
+            content_type = response.headers.get("Content-Type", "").split(";")[0].strip().lower()
+            if content_type and content_type not in HTML_CONTENT_TYPES:
+                self._reject("content_type", f"略過非 HTML 內容 ({content_type}): {url}")
+            declared = response.headers.get("Content-Length")
+            if declared and declared.isdigit() and int(declared) > self.max_bytes:
+                self._reject("too_large", f"內容長度 {declared} 超過上限 {self.max_bytes}: {url}")
+            body = bytearray()
+            try:
+                for chunk in self._chunks(response):
+                    body += chunk
+                    if len(body) > self.max_bytes:
+                        self._reject("too_large", f"下載超過 {self.max_bytes} 位元組，已中止: {url}")
+                    if time.monotonic() > deadline:
+                        self._reject("deadline", f"下載超過 {self.total_timeout}s，已中止: {url}", host)
+                    if cancelled is not None and cancelled.is_set():
+                        self._reject("cancelled", f"深度瀏覽已取消，中止下載: {url}")
+            except PageFetchError:
+                raise
+            except requests.exceptions.RequestException:
+                self._count("error", len(body))
+                self._host_failed(host)
+                raise
+        self._host_failures.pop(host)
+        self._count("ok", len(body))
+        return bytes(body), response.headers.get("ETag"), response.headers.get("Last-Modified")
+
+    def stats(self) -> dict:
+        backing_off = sum(1 for host in self._host_failures.keys()
+                          if self._host_failures.get(host, 0) >= self.failure_threshold)
+        with self._lock:
+            return {"outcomes": dict(self.outcomes), "bytes_downloaded": self.bytes_downloaded,
+                    "hosts_backing_off": backing_off}
@@ -0,0 +1,91 @@
+import re
+
+import numpy as np
+
+_WORD = re.compile(r"[a-z0-9]+(?:['’][a-z]+)?")
+_CJK_RUN = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]+")
+_SENTENCE_END = re.compile(r"(?<=[.!?。！？])\s*")
+
+
+def tokenize(text: str) -> list[str]:
+    """英數字以單字切分；中日韓文字沒有空白分隔，改用字元 bigram（單字則保留原字）。"""
+    text = text.lower()
+    tokens = _WORD.findall(text)
+    for run in _CJK_RUN.findall(text):
+        tokens.extend([run] if len(run) == 1 else [run[i:i + 2] for i in range(len(run) - 1)])
+    return tokens
+
+
+def split_passages(text: str, max_chars: int = 700) -> list[str]:
+    """依段落切分，過短的段落合併、過長的段落再依句子切開，使每個段落約為 `max_chars` 字元。"""
+    passages, current = [], ""
+    for paragraph in (p.strip() for p in re.split(r"\n\s*\n|\n", text)):
+        if not paragraph:
+            continue
+        pieces = [paragraph] if len(paragraph) <= max_chars else _split_long(paragraph, max_chars)
+        for piece in pieces:
+            if current and len(current) + len(piece) + 1 > max_chars:
+                passages.append(current)
+                current = ""
+            current = f"{current}\n{piece}" if current else piece
+    if current:
+        passages.append(current)
+    return passages
+
+
+def _split_long(paragraph: str, max_chars: int) -> list[str]:
+    pieces, current = [], ""
+    for sentence in (s for s in _SENTENCE_END.split(paragraph) if s):
+        while len(sentence) > max_chars:
+            pieces.append(sentence[:max_chars])
+            sentence = sentence[max_chars:]
+        if current and len(current) + len(sentence) + 1 > max_chars:
+            pieces.append(current)
+            current = ""
+        current = f"{current} {sentence}" if current else sentence
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def bm25_scores(query: str, passages: list[str], k1: float = 1.5, b: float = 0.75) -> np.ndarray:
+    """對所有段落一次計算 BM25 分數；只需為查詢詞建立 (段落 × 查詢詞) 的詞頻矩陣。"""
+    terms = list(dict.fromkeys(tokenize(query)))
+    if not terms or not passages:
+        return np.zeros(len(passages))
+    index = {term: j for j, term in enumerate(terms)}
+    tf = np.zeros((len(passages), len(terms)))
+    lengths = np.zeros(len(passages))
+    for i, passage in enumerate(passages):
+        tokens = tokenize(passage)
+        lengths[i] = len(tokens)
+        for token in tokens:
+            j = index.get(token)
+            if j is not None:
+                tf[i, j] += 1
+    df = np.count_nonzero(tf, axis=0)
+    idf = np.log1p((len(passages) - df + 0.5) / (df + 0.5))
+    norm = k1 * (1 - b + b * lengths / max(lengths.mean(), 1.0))
+    return ((tf * (k1 + 1)) / (tf + norm[:, None]) * idf).sum(axis=1)
+
+
+def rank_passages(question: str, documents: list[tuple[int, str]], budget_chars: int = 6000,
+                  passage_chars: int = 700, max_per_source: int = 4) -> list[tuple[int, str]]:
+    """從所有來源的段落中挑出與問題最相關者，總長度不超過 `budget_chars`；回傳 (來源索引, 段落)，依來源與原文順序排列。"""
+    candidates = [(source, position, passage)
+                  for source, text in documents
+                  for position, passage in enumerate(split_passages(text, passage_chars))]
+    if not candidates:
+        return []
+    scores = bm25_scores(question, [passage for _, _, passage in candidates])
+    chosen, used, per_source = [], 0, {}
+    for i in np.argsort(-scores, kind="stable"):
+        source, position, passage = candidates[i]
+        if scores[i] <= 0 and chosen:
+            break
+        if per_source.get(source, 0) >= max_per_source or used + len(passage) > budget_chars:
+            continue
+        chosen.append((source, position, passage))
+        used += len(passage)
+        per_source[source] = per_source.get(source, 0) + 1
+    return [(source, passage) for source, _, passage in sorted(chosen)]
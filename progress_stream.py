@@ -0,0 +1,58 @@
+import threading
+
+# 各前置階段開始時送出的狀態文字；未列出的階段 (例如 adapter_parse) 不送出事件
+PROGRESS_MESSAGES = {
+    "history_summary": "正在整理對話歷史…",
+    "search_query": "正在產生搜尋關鍵字…",
+    "web_search": "正在搜尋網路…",
+    "deep_browse": "正在閱讀搜尋結果…",
+    "read_source": "已讀完來源 {done}/{total}: {title}",
+    "relevance_check": "正在檢查搜尋結果的相關性…",
+    "expert_decision": "正在挑選專家…",
+    "planner": "正在規劃回答…",
+    "vision": "正在分析圖片…",
+}
+
+
+def describe_progress(event: str, detail: dict) -> str | None:
+    template = PROGRESS_MESSAGES.get(event)
+    return template.format(**detail) if template is not None else None
+
+
+class ProgressChannel:
+    """作為 RequestTrace 的進度接收者，把前置階段 (任何執行緒) 的狀態文字交給回應產生器依序輸出。
+
+    `wakeup` 在有新事件或通道關閉時被呼叫，供非同步模式喚醒事件迴圈；同步模式直接以 `wait()` 阻塞等待。
+    """
+
+    def __init__(self, wakeup=None):
+        self._items = []
+        self._closed = False
+        self._cond = threading.Condition()
+        self._wakeup = wakeup
+
+    def __call__(self, event: str, detail: dict):
+        text = describe_progress(event, detail)
+        if text is None:
+            return
+        with self._cond:
+            self._items.append(text)
+            self._cond.notify_all()
+        if self._wakeup is not None:
+            self._wakeup()
+
+    def close(self, *_):
+        """前置階段結束 (可直接作為 Future 的 done callback)。"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._wakeup is not None:
+            self._wakeup()
+
+    def wait(self, timeout: float | None = None) -> tuple[list[str], bool]:
+        """等待新事件最多 `timeout` 秒，回傳 (累積的狀態文字, 是否已關閉)；逾時且沒有事件時回傳空串列。"""
+        with self._cond:
+            if not self._items and not self._closed:
+                self._cond.wait(timeout)
+            items, self._items = self._items, []
+            return items, self._closed
@@ -0,0 +1,31 @@
+"""以固定順序組裝最終提示詞：穩定的角色文字在前、易變的上下文在後，讓 Ollama 的提示詞前綴快取能夠命中。"""
+
+INFLUENCE_ORDER = {"High": 0, "Medium": 1, "Low": 2}
+
+
+def canonical_team(experts: list[tuple]) -> list[tuple]:
+    """去除重複的專家（保留最高影響力），並依 (影響力, 名稱) 排序，使相同團隊永遠得到相同順序。"""
+    strongest = {}
+    for name, influence in experts:
+        current = strongest.get(name)
+        if current is None or INFLUENCE_ORDER.get(influence, 99) < INFLUENCE_ORDER.get(current, 99):
+            strongest[name] = influence
+    return sorted(strongest.items(), key=lambda item: (INFLUENCE_ORDER.get(item[1], 99), item[0]))
+
+
+def build_persona_prompt(team: list[tuple], expert_prompts: dict) -> str:
+    lead_name, _ = team[0]
+    persona_prompt = expert_prompts.get(lead_name, "")
+    if len(team) > 1:
+        persona_prompt += "\n### CONSULTING EXPERTS' PERSPECTIVES ###\nYou must incorporate the perspectives of:\n"
+        for name, influence in team[1:]:
+            persona_prompt += f"- **{name} (Influence: {influence})**: {expert_prompts.get(name, '')}\n"
+    return persona_prompt
+
+
+def build_messages(system_prompt: str, user_content: str, context: str | None = None) -> list[dict]:
+    """系統訊息只放穩定內容；搜尋結果、圖片描述等每次不同的上下文放在最後一則使用者訊息中。"""
+    if context:
+        user_content = f"{context}\n\n--- USER'S QUESTION ---\n{user_content}"
+    return [{"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_content}]
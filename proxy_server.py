@@ -1,13 +1,37 @@
 from adapters import find_adapter
+from admission import AdmissionRejected, ModelScheduler
+from ollama_client import OllamaClient
+from backend_pool import BackendPool
+from expert_router import ExpertRouter
+from embed_batcher import EmbedBatcher, EmbedUpstreamError
+from conversation_window import ConversationWindow, message_text
+from passage_ranker import rank_passages
+from page_fetcher import PageFetcher, PageFetchError
+from search_cache import SearchCache
+from search_providers import (FixtureSearchProvider, GoogleSearchProvider, SearchRouter,
+                              SearxngSearchProvider, StubSearchProvider)
+from vision_cache import VisionCache, image_content_key
+from usage_store import UsageStore
+from model_warmup import ModelWarmer
+from progress_stream import ProgressChannel
+from response_cache import ResponseCache
+from stream_translation import (CONTENT_TYPES, OLLAMA, StreamTranslator, error_event, headers_event,
+                                openai_to_ollama_request, progress_event, replay_stream, text_stream)
+from prompt_layout import build_messages, build_persona_prompt, canonical_team
+from metrics import (REGISTRY, RESPONSE_CACHE_LOOKUPS, SlowRequestProfiler, StreamMeter, current_trace,
+                     report_progress, set_route, stage, start_trace, submit_in_context)
 import os
 import logging
 import json
 import base64
+import contextlib
+import math
 import threading
-from datetime import datetime, date
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
+from dataclasses import dataclass
 from flask import Flask, request, Response
 import requests
-from googleapiclient.discovery import build
 from dotenv import load_dotenv
 import trafilatura
 
@@ -18,44 +42,131 @@ logger = logging.getLogger(__name__)
 load_dotenv()
 app = Flask(__name__)
 
-USAGE_FILE = "usage.json"
-api_usage_lock = threading.RLock()
+USAGE_STORE = UsageStore(
+    os.getenv("USAGE_DB_PATH", "usage.sqlite3"),
+    lease_size=int(os.getenv("USAGE_LEASE_SIZE", "5")),
+    flush_interval=float(os.getenv("USAGE_FLUSH_INTERVAL", "5")))
+USAGE_STORE.register("google_search", int(
+    os.getenv("GOOGLE_SEARCH_DAILY_LIMIT", "100")))
+USAGE_STORE.import_legacy_json("usage.json", "google_search")
+if os.getenv("SEARXNG_DAILY_LIMIT"):
+    USAGE_STORE.register("searxng_search", int(os.getenv("SEARXNG_DAILY_LIMIT")))
 
+OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
+THINKING_MODEL = os.getenv("THINKING_MODEL", "gpt-oss:20b")
+VISION_MODEL = os.getenv("VISION_MODEL", "gemma3:4b")
+BACKEND_POOL = BackendPool.from_config(
+    os.getenv("OLLAMA_NODES"), OLLAMA_BASE_URL,
+    health_interval=float(os.getenv("OLLAMA_HEALTH_INTERVAL", "10")),
+    failure_threshold=int(os.getenv("OLLAMA_FAILURE_THRESHOLD", "3")),
+    ejection_seconds=float(os.getenv("OLLAMA_EJECTION_SECONDS", "30")))
+BACKEND_POOL.start_health_checks()
+# 每個模型的並行上限（預設不限制；未設定 MODEL_CONCURRENCY 時沿用 OLLAMA_NUM_PARALLEL）；
+# 額滿時內部短調用優先於最終串流，佇列滿或等待逾時回應 429/503
+SCHEDULER = ModelScheduler(
+    default_limit=int(os.getenv("MODEL_CONCURRENCY", os.getenv("OLLAMA_NUM_PARALLEL", "0"))),
+    limits=ModelScheduler.parse_limits(os.getenv("MODEL_CONCURRENCY_LIMITS")),
+    max_queue=int(os.getenv("ADMISSION_QUEUE_SIZE", "64")),
+    wait_timeout=float(os.getenv("ADMISSION_WAIT_TIMEOUT", "30")),
+    retry_after=float(os.getenv("ADMISSION_RETRY_AFTER", "5")),
+    internal_reserve=int(os.getenv("ADMISSION_INTERNAL_RESERVE", "1")))
+OLLAMA_CLIENT = OllamaClient(backend_pool=BACKEND_POOL, scheduler=SCHEDULER)
+# 客戶端的 /api/embed 請求在 EMBED_BATCH_WINDOW_MS 內合併成一次上游調用（最多 EMBED_BATCH_MAX 個輸入）；
+# EMBED_CACHE_SIZE > 0 時以內容雜湊快取向量
+EMBED_BATCHER = EmbedBatcher(
+    OLLAMA_CLIENT,
+    window=float(os.getenv("EMBED_BATCH_WINDOW_MS", "5")) / 1000,
+    max_batch=int(os.getenv("EMBED_BATCH_MAX", "64")),
+    cache_size=int(os.getenv("EMBED_CACHE_SIZE", "0")),
+    cache_ttl=float(os.getenv("EMBED_CACHE_TTL", "3600"))
+) if os.getenv("EMBED_BATCHING", "true").lower() == "true" else None
+# 模型常駐時間；最終請求與預熱都會帶上，MODEL_WARMUP_INTERVAL 為定期預熱間隔（秒，0 表示僅在啟動時預熱）
+MODEL_KEEP_ALIVE = os.getenv("MODEL_KEEP_ALIVE", "30m")
+MODEL_WARMER = ModelWarmer(
+    BACKEND_POOL, [THINKING_MODEL, VISION_MODEL], keep_alive=MODEL_KEEP_ALIVE,
+    interval=float(os.getenv("MODEL_WARMUP_INTERVAL", "600")))
+if os.getenv("MODEL_WARMUP", "true").lower() in ("1", "true", "yes"):
+    MODEL_WARMER.start()
 
-def load_api_usage():
-    with api_usage_lock:
-        if not os.path.exists(USAGE_FILE):
-            usage_data = {"google_search": {
-                "count": 0, "daily_limit": 100, "reset_date": datetime.now().date()}}
-            save_api_usage(usage_data)
-            return usage_data
-        try:
-            with open(USAGE_FILE, 'r', encoding='utf-8') as f:
-                usage_data = json.load(f)
-                usage_data["google_search"]["reset_date"] = datetime.fromisoformat(
-                    usage_data["google_search"]["reset_date"]).date()
-                return usage_data
-        except (json.JSONDecodeError, KeyError):
-            logger.warning(f"{USAGE_FILE} 文件格式錯誤，將重新創建。")
-            os.remove(USAGE_FILE)
-            return load_api_usage()
+SEARCH_CACHE = SearchCache(
+    os.getenv("SEARCH_CACHE_PATH", "search_cache.sqlite3"),
+    query_ttl=float(os.getenv("SEARCH_CACHE_QUERY_TTL", str(6 * 3600))),
+    page_ttl=float(os.getenv("SEARCH_CACHE_PAGE_TTL", str(24 * 3600))),
+    max_bytes=int(os.getenv("SEARCH_CACHE_MAX_BYTES", str(64 * 1024 * 1024))))
+VISION_CACHE = VisionCache(
+    os.getenv("VISION_CACHE_DIR", "vision_cache"),
+    memory_entries=int(os.getenv("VISION_CACHE_MEMORY_ENTRIES", "512")),
+    max_disk_bytes=int(os.getenv("VISION_CACHE_MAX_DISK_BYTES", str(32 * 1024 * 1024))))
+SEARCH_TIMEOUT = float(os.getenv("SEARCH_TIMEOUT", "10"))
+# GOOGLE_SEARCH_ENDPOINT 可指向相容的本地服務（例如 bench/fake_web.py），供離線壓測使用
+SEARCH_PROVIDER_FACTORIES = {
+    "google": lambda: GoogleSearchProvider(
+        os.getenv("GOOGLE_API_KEY"), os.getenv("GOOGLE_CSE_ID"), os.getenv("GOOGLE_SEARCH_ENDPOINT"),
+        quota_key="google_search", timeout=SEARCH_TIMEOUT),
+    "searxng": lambda: SearxngSearchProvider(
+        os.getenv("SEARXNG_URL"), timeout=SEARCH_TIMEOUT,
+        quota_key="searxng_search" if os.getenv("SEARXNG_DAILY_LIMIT") else None),
+    "stub": lambda: StubSearchProvider(),
+    "fixture": lambda: FixtureSearchProvider(os.getenv("SEARCH_FIXTURE_PATH")),
+}
+# "first": 依順序查詢，採用第一個回傳結果的後端 (之後的後端不扣額度)；"merge": 合併所有後端的結果並去除重複網址
+SEARCH_ROUTER = SearchRouter(
+    [SEARCH_PROVIDER_FACTORIES[name.strip()]()
+     for name in os.getenv("SEARCH_PROVIDERS", "google").split(",") if name.strip()],
+    usage_store=USAGE_STORE, strategy=os.getenv("SEARCH_STRATEGY", "first"), timeout=SEARCH_TIMEOUT)
+# 深度瀏覽下載上限：位元組數、連線/讀取逾時與單頁總時間（秒）；同一主機連續失敗後暫停一段時間（秒）
+PAGE_FETCHER = PageFetcher(
+    max_bytes=int(os.getenv("PAGE_FETCH_MAX_BYTES", str(2 * 1024 * 1024))),
+    connect_timeout=float(os.getenv("PAGE_FETCH_CONNECT_TIMEOUT", "5")),
+    read_timeout=float(os.getenv("PAGE_FETCH_READ_TIMEOUT", "10")),
+    total_timeout=float(os.getenv("PAGE_FETCH_TOTAL_TIMEOUT", "20")),
+    failure_threshold=int(os.getenv("PAGE_FETCH_HOST_FAILURES", "3")),
+    failure_ttl=float(os.getenv("PAGE_FETCH_HOST_BACKOFF", "600")))
 
+DEEP_BROWSE_SOURCES = int(os.getenv("DEEP_BROWSE_SOURCES", "3"))
+DEEP_BROWSE_BUDGET = float(os.getenv("DEEP_BROWSE_BUDGET", "60"))
+DEEP_BROWSE_EXECUTOR = ThreadPoolExecutor(
+    max_workers=int(os.getenv("DEEP_BROWSE_WORKERS", "8")), thread_name_prefix="deep-browse")
+# "extractive": 以 BM25 從所有頁面挑選最相關段落直接放入上下文；"llm_summary": 每個頁面各調用一次 LLM 摘要
+DEEP_BROWSE_MODE = os.getenv("DEEP_BROWSE_MODE", "extractive")
+DEEP_BROWSE_PASSAGE_CHARS = int(os.getenv("DEEP_BROWSE_PASSAGE_CHARS", "6000"))
 
-def save_api_usage(usage_data):
-    with api_usage_lock:
-        data_to_save = json.loads(json.dumps(usage_data, default=str))
-        reset_date_val = usage_data["google_search"]["reset_date"]
-        if isinstance(reset_date_val, date):
-            data_to_save["google_search"]["reset_date"] = reset_date_val.isoformat()
-        with open(USAGE_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data_to_save, f, indent=2)
+# "native": 上游一律使用 /api/chat，由代理轉換為客戶端的串流格式；"shim": OpenAI 客戶端改走 Ollama 的 /v1 相容層
+STREAM_TRANSLATION = os.getenv("STREAM_TRANSLATION", "native")
+# 合併細碎 token 的間隔（毫秒）；預設 0 表示每個上游事件立即送出。
+# 啟用時只暫存密集到達的 token，但上游在一串快速 token 後停頓時，暫存的內容會等到下一塊資料才送出
+STREAM_FLUSH_INTERVAL = float(os.getenv("STREAM_FLUSH_INTERVAL_MS", "0")) / 1000
+# 溫度為 0 的請求之完整回應快取（預設關閉）；以位元組數為上限，命中時依客戶端格式重播
+RESPONSE_CACHE = ResponseCache(
+    max_bytes=int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+    ttl=float(os.getenv("RESPONSE_CACHE_TTL", "3600")),
+    max_entries=int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "10000"))
+) if os.getenv("RESPONSE_CACHE", "false").lower() == "true" else None
+RESPONSE_CACHE_HEADER = "X-Proxy-Cache"
+# 串流請求的前置階段 (搜尋、視覺等) 超過 PROGRESS_GRACE_MS 仍未完成時，先開啟串流並送出進度事件，之後再接上最終串流。
+# "keepalive": 客戶端會忽略的事件 (SSE 註解行、NDJSON 空內容)；"thinking": 狀態文字放在 thinking/reasoning 欄位；"off": 停用
+PROGRESS_EVENTS = os.getenv("PROGRESS_EVENTS", "keepalive")
+PROGRESS_GRACE = float(os.getenv("PROGRESS_GRACE_MS", "500")) / 1000
+PROGRESS_KEEPALIVE_INTERVAL = float(os.getenv("PROGRESS_KEEPALIVE_INTERVAL", "5"))
+# Flask 版在背景執行緒中執行前置階段，請求執行緒才能送出進度事件；執行緒全忙時改在請求執行緒中直接執行
+# (不送進度事件)，不讓前置階段排隊等待。只在啟用進度事件時建立。
+PREPARE_WORKERS = int(os.getenv("PREPARE_WORKERS", "16"))
+PREPARE_EXECUTOR = ThreadPoolExecutor(
+    max_workers=max(1, PREPARE_WORKERS), thread_name_prefix="prepare") if PROGRESS_EVENTS != "off" else None
+PREPARE_SLOTS = threading.BoundedSemaphore(PREPARE_WORKERS)
 
+# 需要解析 JSON 的聊天請求本文上限（位元組）；其餘路由以串流直接轉發，不受此限制
+MAX_JSON_BODY_BYTES = int(os.getenv("MAX_JSON_BODY_BYTES", str(64 * 1024 * 1024)))
+REQUEST_BODY_CHUNK_SIZE = 64 * 1024
+# 逐請求轉發時不應帶到上游的標頭；長度與傳輸編碼由 requests 依實際本文重新設定
+FORWARD_EXCLUDED_HEADERS = {"host", "content-length", "transfer-encoding", "connection", "keep-alive"}
 
-API_USAGE = load_api_usage()
-
-OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
-THINKING_MODEL = os.getenv("THINKING_MODEL", "gpt-oss:20b")
-VISION_MODEL = os.getenv("VISION_MODEL", "gemma3:4b")
+# "pipelined": 專家決策與搜尋/瀏覽並行；"snippet_aware": 等待搜尋結果後再參考摘要進行決策
+EXPERT_SELECTION_MODE = os.getenv("EXPERT_SELECTION_MODE", "pipelined")
+# 啟用後以單次結構化 (JSON schema) 調用取代搜尋查詢優化與專家決策，失敗時退回多次調用流程
+PLANNER_MODE = os.getenv("PLANNER_MODE", "false").lower() in ("1", "true", "yes")
+PIPELINE_EXECUTOR = ThreadPoolExecutor(
+    max_workers=int(os.getenv("PIPELINE_WORKERS", "16")), thread_name_prefix="pipeline")
 
 
 def load_prompts_from_directory(directory: str) -> dict:
@@ -78,9 +189,48 @@ EXPERT_PROMPTS = load_prompts_from_directory("prompts")
 if "Assistant" not in EXPERT_PROMPTS:
     EXPERT_PROMPTS["Assistant"] = "You are a helpful AI assistant."
 
+# "embedding": 先以嵌入向量相似度路由專家，分數不明確時才調用 LLM；"llm": 一律由 LLM 決策
+EXPERT_ROUTER_MODE = os.getenv("EXPERT_ROUTER", "embedding")
+EMBED_MODEL = os.getenv("EMBED_MODEL", "nomic-embed-text")
+EXPERT_ROUTER = ExpertRouter(
+    OLLAMA_CLIENT, EMBED_MODEL, EXPERT_PROMPTS,
+    min_score=float(os.getenv("ROUTER_MIN_SCORE", "0.35")),
+    margin=float(os.getenv("ROUTER_MARGIN", "0.03")),
+    cache_size=int(os.getenv("ROUTER_CACHE_SIZE", "1024")),
+    cache_ttl=float(os.getenv("ROUTER_CACHE_TTL", "3600")))
+if EXPERT_ROUTER_MODE == "embedding":
+    EXPERT_ROUTER.start()
+
+# 設定後，前置階段耗時超過此秒數的請求會輸出取樣剖析結果（熱點呼叫堆疊）
+SLOW_REQUEST_PROFILE_SECONDS = os.getenv("SLOW_REQUEST_PROFILE_SECONDS")
+SLOW_REQUEST_PROFILER = SlowRequestProfiler(
+    float(SLOW_REQUEST_PROFILE_SECONDS)) if SLOW_REQUEST_PROFILE_SECONDS else None
+
+REGISTRY.gauge_callback(
+    "proxy_ollama_pool_in_use", "Connections in use per Ollama call profile.",
+    lambda: [({"profile": name}, pool["in_use"]) for name, pool in OLLAMA_CLIENT.stats().items()])
+REGISTRY.gauge_callback(
+    "proxy_ollama_node_outstanding", "Outstanding requests per Ollama node.",
+    lambda: [({"node": node["url"]}, node["outstanding"]) for node in BACKEND_POOL.stats()])
+REGISTRY.gauge_callback(
+    "proxy_admission_queue_depth", "Calls waiting for a model concurrency slot.",
+    lambda: [({"model": model, "lane": lane}, depth) for model, gate in SCHEDULER.stats().items()
+             for lane, depth in gate["queued"].items()])
+REGISTRY.gauge_callback(
+    "proxy_admission_active", "Admitted in-flight calls per model.",
+    lambda: [({"model": model}, gate["active"]) for model, gate in SCHEDULER.stats().items()])
+
+
+@app.before_request
+def before_request_func():
+    start_trace()
+
 
 @app.after_request
 def after_request_func(response):
+    trace = current_trace()
+    if trace is not None:
+        response.headers['Server-Timing'] = trace.server_timing()
     origin = request.headers.get('Origin')
     if origin:
         response.headers.add('Access-Control-Allow-Origin', origin)
@@ -92,12 +242,68 @@ def after_request_func(response):
     return response
 
 
-def stream_forwarder(response):
-    for chunk in response.iter_content(chunk_size=None):
-        yield chunk
+def collect_stats() -> dict:
+    return {"ollama_nodes": BACKEND_POOL.stats(),
+            "ollama_pools": OLLAMA_CLIENT.stats(),
+            "admission": SCHEDULER.stats(),
+            "embed_batcher": EMBED_BATCHER.stats() if EMBED_BATCHER else None,
+            "response_cache": RESPONSE_CACHE.stats() if RESPONSE_CACHE else None,
+            "model_warmup": MODEL_WARMER.stats(),
+            "conversation_window": CONVERSATION_WINDOW.stats(),
+            "expert_router": EXPERT_ROUTER.stats(),
+            "search_cache": SEARCH_CACHE.stats(),
+            "search_providers": SEARCH_ROUTER.stats(),
+            "page_fetcher": PAGE_FETCHER.stats(),
+            "vision_cache": VISION_CACHE.stats(),
+            "api_usage": USAGE_STORE.snapshot()}
+
+
+@app.route('/proxy/stats', methods=['GET'])
+def proxy_stats():
+    return Response(json.dumps(collect_stats()), mimetype='application/json')
+
+
+@app.route('/proxy/cache', methods=['DELETE'])
+def purge_response_cache():
+    if RESPONSE_CACHE is None:
+        return create_error_response("回應快取未啟用。", "not_found", 404)
+    return Response(json.dumps({"purged": purge_cache_entries(request.args)}), mimetype='application/json')
 
 
-def create_error_response(message: str, error_type: str = "api_error", status_code: int = 500) -> Response:
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/proxy/usage', methods=['GET'])
+def proxy_usage():
+    return Response(json.dumps(USAGE_STORE.snapshot()), mimetype='application/json')
+
+
+def stream_forwarder(response, meter: StreamMeter | None = None):
+    try:
+        for chunk in response.iter_content(chunk_size=None):
+            if meter is not None:
+                meter.observe(chunk)
+            yield chunk
+    finally:
+        response.close()
+
+
+def translated_stream(response, translator: StreamTranslator):
+    try:
+        for chunk in response.iter_content(chunk_size=None):
+            data = translator.feed(chunk)
+            if data:
+                yield data
+        data = translator.finish()
+        if data:
+            yield data
+    finally:
+        response.close()
+
+
+def build_error_payload(message: str, error_type: str = "api_error", status_code: int = 500) -> str:
     logger.error(f"生成錯誤回應 (HTTP {status_code}): {message}")
     error_payload = {
         "error": {
@@ -106,14 +312,22 @@ def create_error_response(message: str, error_type: str = "api_error", status_co
             "status_code": status_code
         }
     }
-    return Response(json.dumps(error_payload), status=status_code, mimetype='application/json')
+    return json.dumps(error_payload)
+
+
+def create_error_response(message: str, error_type: str = "api_error", status_code: int = 500,
+                          retry_after: float | None = None) -> Response:
+    response = Response(build_error_payload(message, error_type, status_code), status=status_code, mimetype='application/json')
+    if retry_after is not None:
+        response.headers['Retry-After'] = str(math.ceil(retry_after))
+    return response
 
 
 def call_llm(messages: list, stream: bool = False):
     payload = {"model": THINKING_MODEL, "messages": messages, "stream": stream}
     try:
-        response = requests.post(
-            f"{OLLAMA_BASE_URL}/api/chat", json=payload, stream=stream, timeout=180)
+        response = OLLAMA_CLIENT.post(
+            "summary", "/api/chat", json=payload, stream=stream)
         response.raise_for_status()
         return response
     except requests.exceptions.RequestException as e:
@@ -121,6 +335,7 @@ def call_llm(messages: list, stream: bool = False):
         return None
 
 
+@stage("search_query")
 def generate_search_query(original_question: str) -> str:
     logger.info("正在將問題轉換為搜尋關鍵字...")
     prompt = (f"You are a search engine optimization expert... convert the user's question into a concise, keyword-based search query...\n\n"
@@ -128,8 +343,7 @@ def generate_search_query(original_question: str) -> str:
     payload = {"model": THINKING_MODEL, "prompt": prompt,
                "stream": False, "options": {"temperature": 0.0}}
     try:
-        response = requests.post(
-            f"{OLLAMA_BASE_URL}/api/generate", json=payload, timeout=45)
+        response = OLLAMA_CLIENT.post("query", "/api/generate", json=payload)
         response.raise_for_status()
         optimized_query = response.json().get(
             "response", original_question).strip().replace("\"", "")
@@ -141,43 +355,136 @@ def generate_search_query(original_question: str) -> str:
         return original_question
 
 
-def perform_google_search(query: str, max_results: int = 5) -> list[dict]:
-    logger.info(f"正在執行 Google 網路搜尋: '{query}'")
-    with api_usage_lock:
-        today = datetime.now().date()
-        if API_USAGE["google_search"]["reset_date"] != today:
-            API_USAGE["google_search"]["count"] = 0
-            API_USAGE["google_search"]["reset_date"] = today
-        if API_USAGE["google_search"]["count"] >= API_USAGE["google_search"]["daily_limit"]:
-            logger.warning("Google Search API 每日免費額度已用盡。")
-            return []
-        API_USAGE["google_search"]["count"] += 1
-        save_api_usage(API_USAGE)
-        logger.info(
-            f"Google Search API 使用次數: {API_USAGE['google_search']['count']}/{API_USAGE['google_search']['daily_limit']}")
+@stage("history_summary")
+def summarize_conversation(previous_summary: str | None, messages: list[dict]) -> str | None:
+    transcript = "\n".join(f"{m.get('role', 'user')}: {message_text(m)}" for m in messages)
+    earlier = f"--- EARLIER SUMMARY ---\n{previous_summary}\n\n" if previous_summary else ""
+    prompt = (f"Update the running summary of a conversation. Merge the earlier summary with the new messages, keeping facts, decisions, names, numbers and open questions. "
+              f"Write in the conversation's language, under 300 words.\n\n{earlier}--- NEW MESSAGES ---\n{transcript}\n\n--- UPDATED SUMMARY ---")
+    payload = {"model": THINKING_MODEL, "prompt": prompt,
+               "stream": False, "options": {"temperature": 0.0}}
+    try:
+        response = OLLAMA_CLIENT.post("summary", "/api/generate", json=payload)
+        response.raise_for_status()
+        return response.json().get("response", "").strip() or None
+    except requests.exceptions.RequestException as e:
+        logger.error(f"對話摘要調用失敗: {e}", exc_info=True)
+        return None
+
+
+# 標準文字流程的對話 token 預算；超出時較早的對話以快取的滾動摘要取代（0 表示停用）
+CONVERSATION_WINDOW = ConversationWindow(
+    summarize_conversation,
+    budget_tokens=int(os.getenv("CONTEXT_TOKEN_BUDGET", "6000")),
+    keep_ratio=float(os.getenv("CONTEXT_KEEP_RATIO", "0.6")),
+    cache_size=int(os.getenv("CONTEXT_SUMMARY_CACHE_SIZE", "1024")),
+    cache_ttl=float(os.getenv("CONTEXT_SUMMARY_CACHE_TTL", "86400")))
 
-    api_key = os.getenv('GOOGLE_API_KEY')
-    search_engine_id = os.getenv('GOOGLE_CSE_ID')
-    if not api_key or not search_engine_id:
-        logger.error("GOOGLE_API_KEY 或 GOOGLE_CSE_ID 環境變數未設定。")
+
+@stage("web_search")
+def perform_web_search(query: str, max_results: int = 5) -> list[dict]:
+    cached_results = SEARCH_CACHE.get_query(query, max_results)
+    if cached_results is not None:
+        logger.info(f"搜尋快取命中: '{query}'，共 {len(cached_results)} 條結果，不計入 API 額度。")
+        return cached_results
+    logger.info(f"正在執行網路搜尋: '{query}'")
+    structured_results = SEARCH_ROUTER.search(query, max_results)
+    if not structured_results:
+        logger.info("網路搜尋沒有找到相關結果。")
         return []
+    logger.info(f"網路搜尋成功，找到 {len(structured_results)} 條結果。")
+    SEARCH_CACHE.put_query(query, max_results, structured_results)
+    return structured_results
+
 
+def _load_page_text(url: str, report: dict, cancelled: threading.Event):
+    page = SEARCH_CACHE.get_page(url)
+    if page and page["fresh"]:
+        report["cache"] = "hit"
+        return page["main_text"], page
+    started = time.monotonic()
     try:
-        service = build("customsearch", "v1", developerKey=api_key)
-        res = service.cse().list(q=query, cx=search_engine_id, num=max_results).execute()
-        items = res.get('items', [])
-        if not items:
-            logger.info("Google 網路搜尋沒有找到相關結果。")
-            return []
-        structured_results = [{"title": item.get('title', 'N/A'), "link": item.get(
-            'link', 'N/A'), "snippet": item.get('snippet', 'N/A')} for item in items]
-        logger.info(f"Google 搜尋成功，找到 {len(structured_results)} 條結果。")
-        return structured_results
-    except Exception as e:
-        logger.error(f"Google 網路搜尋失敗: {e}", exc_info=True)
-        return []
+        with stage("page_fetch"):
+            downloaded, etag, last_modified = PAGE_FETCHER.fetch(
+                url, page["etag"] if page else None, page["last_modified"] if page else None, cancelled)
+    except requests.exceptions.RequestException as e:
+        # HTTP 錯誤、連線失敗與下載限制都只影響這個來源；有過期的正文時仍可使用
+        reason = e.reason if isinstance(e, PageFetchError) else type(e).__name__
+        if page:
+            logger.info(f"下載失敗 ({reason})，改用過期的頁面快取: {url}")
+            report["cache"] = "stale"
+            return page["main_text"], page
+        logger.info(f"略過頁面 ({reason}): {e}")
+        report["status"] = "fetch_failed"
+        return None, None
+    finally:
+        report["fetch_s"] = time.monotonic() - started
+    if downloaded is None and page:
+        SEARCH_CACHE.mark_revalidated(url)
+        report["cache"] = "revalidated"
+        return page["main_text"], page
+    report["cache"] = "miss"
+    if not downloaded:
+        logger.warning(f"無法從 {url} 下載內容。")
+        report["status"] = "fetch_failed"
+        return None, None
+    if cancelled.is_set():
+        return None, None
+    started = time.monotonic()
+    with stage("page_extract"):
+        page_main_text = trafilatura.extract(
+            downloaded, include_comments=False, include_tables=True)
+    report["extract_s"] = time.monotonic() - started
+    if page_main_text:
+        SEARCH_CACHE.put_page(url, page_main_text, etag, last_modified)
+    return page_main_text, None
+
 
+def _deep_browse_source(index: int, result: dict, question: str, cancelled: threading.Event,
+                        summarize: bool = True) -> dict:
+    url = result.get('link')
+    title = result.get('title', 'N/A')
+    report = {"index": index, "url": url, "status": "skipped", "summary": "", "text": "", "cache": "-",
+              "fetch_s": 0.0, "extract_s": 0.0, "summary_s": 0.0}
+    # 只有摘要可用的結果 (例如 stub 搜尋後端) 不下載，以免被當成主機失敗
+    if not url or not result.get('browsable', True) or cancelled.is_set():
+        return report
+    page_main_text, cached_page = _load_page_text(url, report, cancelled)
+    if report["status"] == "fetch_failed" or cancelled.is_set():
+        return report
+    if not page_main_text or len(page_main_text) <= 100:
+        logger.warning(f"未能從 {url} 提取到有效的主要內容。")
+        report["status"] = "no_content"
+        return report
+    if not summarize:
+        report["text"] = page_main_text
+        report["status"] = "ok"
+        return report
+    cached_summary = SEARCH_CACHE.get_summary(cached_page, question)
+    if cached_summary:
+        report["summary"] = cached_summary
+        report["status"] = "ok"
+        return report
+    # 時間預算已用完時不再佔用執行緒與 Ollama 的背景名額產生已不會被使用的摘要
+    if cancelled.is_set():
+        return report
+    summary_prompt = (f"Please read the main content from '{title}' and extract ONLY the key points relevant to: '{question}'.\n\n"
+                      f"--- WEBPAGE MAIN CONTENT ---\n{page_main_text[:4000]}\n\n--- RELEVANT KEY POINTS SUMMARY ---")
+    started = time.monotonic()
+    with stage("page_summary"):
+        summary_response = call_llm(
+            [{"role": "user", "content": summary_prompt}], stream=False)
+    report["summary_s"] = time.monotonic() - started
+    if summary_response:
+        report["summary"] = summary_response.json().get(
+            "message", {}).get("content", "")
+    if report["summary"]:
+        SEARCH_CACHE.put_summary(url, question, report["summary"])
+    report["status"] = "ok" if report["summary"] else "summary_failed"
+    return report
 
+
+@stage("deep_browse")
 def generate_search_context(search_results: list[dict], question: str) -> str:
     logger.info(f"正在處理 {len(search_results)} 條搜尋結果以生成上下文...")
     if not search_results:
@@ -186,40 +493,59 @@ def generate_search_context(search_results: list[dict], question: str) -> str:
     for i, result in enumerate(search_results):
         final_context += f"[Source {i+1}]\nTitle: {result['title']}\nURL: {result['link']}\nContent Snippet: {result['snippet']}\n\n"
 
-    deep_browse_content = ""
-    for i, result in enumerate(search_results[:3]):
-        url = result.get('link')
-        title = result.get('title', 'N/A')
-        if not url:
-            continue
-        logger.info(f"深度瀏覽 {i+1}/3: 正在嘗試連結: {url}")
-        try:
-            downloaded = trafilatura.fetch_url(url)
-            if not downloaded:
-                logger.warning(f"無法從 {url} 下載內容。")
+    browse_targets = search_results[:DEEP_BROWSE_SOURCES]
+    total = len(browse_targets)
+    cancelled = threading.Event()
+    futures = {}
+    for i, result in enumerate(browse_targets):
+        logger.info(f"深度瀏覽 {i+1}/{total}: 正在嘗試連結: {result.get('link')}")
+        futures[submit_in_context(
+            DEEP_BROWSE_EXECUTOR, _deep_browse_source, i, result, question, cancelled,
+            DEEP_BROWSE_MODE == "llm_summary")] = result
+
+    reports = {}
+    try:
+        for done, future in enumerate(as_completed(futures, timeout=DEEP_BROWSE_BUDGET), 1):
+            result = futures[future]
+            report_progress("read_source", done=done, total=total, title=result.get('title', ''))
+            try:
+                report = future.result()
+            except Exception as e:
+                logger.error(
+                    f"深度瀏覽失敗: {result.get('link')}, 原因: {e}", exc_info=False)
                 continue
-            page_main_text = trafilatura.extract(
-                downloaded, include_comments=False, include_tables=True)
-            if page_main_text and len(page_main_text) > 100:
-                summary_prompt = (f"Please read the main content from '{title}' and extract ONLY the key points relevant to: '{question}'.\n\n"
-                                  f"--- WEBPAGE MAIN CONTENT ---\n{page_main_text[:4000]}\n\n--- RELEVANT KEY POINTS SUMMARY ---")
-                summary_response = call_llm(
-                    [{"role": "user", "content": summary_prompt}], stream=False)
-                if summary_response:
-                    summary = summary_response.json().get("message", {}).get("content", "")
-                    if summary:
-                        deep_browse_content += f"[Deep Dive Summary for Source {i+1}: {title}]\n{summary}\n\n"
-                        logger.info(f"成功對 {url} 進行深度總結。")
-            else:
-                logger.warning(f"未能從 {url} 提取到有效的主要內容。")
-        except Exception as e:
-            logger.error(f"深度瀏覽 {i+1}/3 失敗: {url}, 原因: {e}", exc_info=False)
-            continue
+            reports[report["index"]] = report
+            logger.info(
+                f"深度瀏覽 {report['index']+1}/{total} [{report['status']}, 快取 {report['cache']}] {report['url']} "
+                f"(下載 {report['fetch_s']:.2f}s, 提取 {report['extract_s']:.2f}s, 總結 {report['summary_s']:.2f}s)")
+    except FuturesTimeoutError:
+        cancelled.set()
+        unfinished = [f for f in futures if not f.done()]
+        for future in unfinished:
+            future.cancel()
+        logger.warning(
+            f"深度瀏覽超過時間預算 {DEEP_BROWSE_BUDGET}s，已取消 {len(unfinished)} 個未完成的來源。")
+
+    if DEEP_BROWSE_MODE != "llm_summary":
+        passages = rank_passages(question, [(index, reports[index]["text"]) for index in sorted(reports)
+                                            if reports[index]["text"]], budget_chars=DEEP_BROWSE_PASSAGE_CHARS)
+        if passages:
+            final_context += "--- RELEVANT PASSAGES ---\n" + "".join(
+                f"[Source {index+1}]\n{passage}\n\n" for index, passage in passages)
+        return final_context
+
+    deep_browse_content = ""
+    for index in sorted(reports):
+        report = reports[index]
+        if report["summary"]:
+            title = browse_targets[index].get('title', 'N/A')
+            deep_browse_content += f"[Deep Dive Summary for Source {index+1}: {title}]\n{report['summary']}\n\n"
     if deep_browse_content:
         final_context += "--- DEEP DIVE SUMMARIES ---\n" + deep_browse_content
     return final_context
 
 
+@stage("relevance_check")
 def is_context_relevant(context: str, original_question: str) -> bool:
     if not context:
         return False
@@ -229,8 +555,8 @@ def is_context_relevant(context: str, original_question: str) -> bool:
     payload = {"model": THINKING_MODEL, "prompt": check_prompt,
                "stream": False, "options": {"temperature": 0.0, "top_p": 0.1}}
     try:
-        response = requests.post(
-            f"{OLLAMA_BASE_URL}/api/generate", json=payload, timeout=45)
+        response = OLLAMA_CLIENT.post(
+            "relevance", "/api/generate", json=payload)
         response.raise_for_status()
         verdict = response.json().get("response", "No").strip().lower()
         logger.info(f"關聯性檢查判斷結果: {verdict}")
@@ -240,106 +566,23 @@ def is_context_relevant(context: str, original_question: str) -> bool:
         return False
 
 
-def handle_vision_request(adapter, user_prompt, image_base64, final_system_prompt):
-    logger.info("進入圖文處理流程...")
-    vision_payload = {"model": VISION_MODEL, "prompt": "Describe this image in detail.", "images": [
-        image_base64], "stream": False}
-    try:
-        vision_response = requests.post(
-            f"{OLLAMA_BASE_URL}/api/generate", json=vision_payload, timeout=300)
-        vision_response.raise_for_status()
-        image_description = vision_response.json().get(
-            "response", "Could not get a description.")
-    except requests.exceptions.RequestException as e:
-        return create_error_response(f"調用視覺模型出錯: {e}", "vision_model_error", 502)
-
-    new_messages = [{"role": "system", "content": f"{final_system_prompt}\n\nImage Description: '{image_description}'."}, {
-        "role": "user", "content": user_prompt}]
-    thinking_payload = {"model": THINKING_MODEL,
-                        "messages": new_messages, "stream": True}
-    try:
-        thinking_response = requests.post(
-            f"{OLLAMA_BASE_URL}{adapter.get_final_stream_endpoint()}", json=thinking_payload, stream=True)
-        thinking_response.raise_for_status()
-        logger.info("將視覺模型描述與問題傳遞給思考模型，並流式傳輸回應。")
-        return Response(stream_forwarder(thinking_response), status=thinking_response.status_code, content_type=thinking_response.headers.get('content-type'))
-    except requests.exceptions.RequestException as e:
-        return create_error_response(f"調用思考模型出錯: {e}", "thinking_model_error", 502)
+EXPERT_KEYWORDS = {
+    'Writer': ['作家', 'Writer'],
+    'UX_UI_Developer': ['使用者體驗', '介面開發者', 'UX/UI', 'UX_UI_Developer'],
+    'Cyber_Security_Specialist': ['網路安全', 'Cyber_Security_Specialist'],
+    'Legal_Advisor': ['法律顧問', 'Legal_Advisor'],
+    'Relationship_Coach': ['關係教練', 'Relationship_Coach'],
+    'Philosopher': ['哲學家', 'Philosopher'],
+    'Doctor': ['醫師', '醫學專家', 'Doctor'],
+    'Financial_Analyst': ['財務分析師', 'Financial_Analyst']
+    # ... 可繼續添加其他專家的關鍵詞
+}
 
 
-@app.route('/<path:subpath>', methods=['POST', 'OPTIONS'])
-def intelligent_proxy(subpath):
-    if request.method == 'OPTIONS':
-        return Response(status=200)
-
-    if not (request.method == 'POST' and ("v1/chat/completions" in subpath or "api/chat" in subpath)):
-        logger.info(f"進入通用轉發器處理 {request.method} /{subpath}...")
-        target_url = f"{OLLAMA_BASE_URL}/{subpath}"
-        try:
-            resp = requests.request(method=request.method, url=target_url, headers={k: v for (
-                k, v) in request.headers if k.lower() != 'host'}, data=request.get_data(), params=request.args, stream=True)
-            return Response(stream_forwarder(resp), status=resp.status_code, content_type=resp.headers.get('content-type'))
-        except requests.exceptions.RequestException as e:
-            return create_error_response(f"通用轉發失敗: {e}", "forwarding_error", 502)
-
-    client_request_json = request.get_json()
-    if not client_request_json.get("stream", False):
-        logger.info("檢測到非流式請求，進入通用轉發器...")
-        target_url = f"{OLLAMA_BASE_URL}/{subpath}"
-        try:
-            resp = requests.post(target_url, headers={k: v for (
-                k, v) in request.headers if k.lower() != 'host'}, json=client_request_json)
-            return Response(resp.content, status=resp.status_code, content_type=resp.headers.get('content-type'))
-        except requests.exceptions.RequestException as e:
-            return create_error_response(f"非流式轉發失敗: {e}", "forwarding_error", 502)
-
-    logger.info(f"--- [STEP 1] 接收到【流式】請求: {subpath} ---")
-    adapter_class = find_adapter(subpath)
-    if not adapter_class:
-        return create_error_response(f"不支援的 API 路徑: {subpath}", "unsupported_path", 404)
-
-    adapter = adapter_class(client_request_json)
-    logger.info(f"==> [STEP 2] 使用適配器: {adapter.name}")
-    try:
-        user_prompt, core_question, image_base64 = adapter.parse()
-    except Exception as e:
-        return create_error_response(f"適配器解析失敗: {e}", "adapter_error", 400)
-
-    logger.info(f"--- [STEP 3] 初始解析出的核心問題: '{core_question[:200]}...' ---")
-    SEARCH_PREFIX = "@網路搜尋"
-    search_context = None
-    original_question = core_question
-    search_results = []
-
-    if core_question.strip().startswith(SEARCH_PREFIX):
-        original_question = core_question.strip().split(
-            '\n')[0].replace(SEARCH_PREFIX, "", 1).strip()
-        if original_question:
-            search_query = generate_search_query(original_question)
-            search_results = perform_google_search(search_query, max_results=5)
-            if search_results:
-                search_context = generate_search_context(
-                    search_results, original_question)
-            image_base64 = None
-
+def select_expert_team(original_question: str, search_results: list[dict] | None = None) -> list[tuple]:
     logger.info("==> [STEP 4] 請求思考模型進行角色選擇與權重分配...")
     expert_list = list(EXPERT_PROMPTS.keys())
-    pre_selected_experts = set()
-    expert_keywords = {
-        'Writer': ['作家', 'Writer'],
-        'UX_UI_Developer': ['使用者體驗', '介面開發者', 'UX/UI', 'UX_UI_Developer'],
-        'Cyber_Security_Specialist': ['網路安全', 'Cyber_Security_Specialist'],
-        'Legal_Advisor': ['法律顧問', 'Legal_Advisor'],
-        'Relationship_Coach': ['關係教練', 'Relationship_Coach'],
-        'Philosopher': ['哲學家', 'Philosopher'],
-        'Doctor': ['醫師', '醫學專家', 'Doctor'],
-        'Financial_Analyst': ['財務分析師', 'Financial_Analyst']
-        # ... 可繼續添加其他專家的關鍵詞
-    }
-    scan_area = original_question[:256]
-    for expert, keywords in expert_keywords.items():
-        if any(keyword.lower() in original_question.lower() for keyword in keywords):
-            pre_selected_experts.add(expert)
+    pre_selected_experts = preselect_experts(original_question)
 
     logger.info(f"程式碼預選專家 (僅掃描前256字符): {list(pre_selected_experts)}")
     context_preview = ""
@@ -347,6 +590,7 @@ def intelligent_proxy(subpath):
         context_preview += "### AVAILABLE INFORMATION PREVIEW ###\n"
         for i, result in enumerate(search_results[:3]):
             context_preview += f"- Title {i+1}: {result.get('title', 'N/A')}\n  Snippet: {result.get('snippet', 'N/A')}\n"
+        context_preview += "\n"
     remaining_experts = [
         exp for exp in expert_list if exp not in pre_selected_experts]
     decision_prompt = (
@@ -359,6 +603,7 @@ def intelligent_proxy(subpath):
         f"3.  **Combine and Finalize:** Create a single, final comma-separated list of all chosen experts and their influence levels.\n\n"
         f"### List of Additional Experts to Consider ###\n"
         f"{remaining_experts}\n\n"
+        f"{context_preview}"
         f"### User Request ###\n"
         f"\"{original_question}\"\n\n"
         f"Your output MUST BE a single, comma-separated list of 'Expert (Influence)' pairs, including both the mandatory and any additional experts you selected."
@@ -371,8 +616,8 @@ def intelligent_proxy(subpath):
     try:
         decision_payload = {"model": THINKING_MODEL,
                             "prompt": decision_prompt, "stream": False}
-        decision_response = requests.post(
-            f"{OLLAMA_BASE_URL}/api/generate", json=decision_payload, timeout=90)
+        decision_response = OLLAMA_CLIENT.post(
+            "decision", "/api/generate", json=decision_payload)
         decision_response.raise_for_status()
         response_text = decision_response.json().get("response", "").strip()
         parts = [p.strip() for p in response_text.split(',')]
@@ -384,101 +629,644 @@ def intelligent_proxy(subpath):
         logger.warning(f"AI 輔助決策失敗: {e}. 將僅使用預選專家。", exc_info=True)
         if not pre_selected_experts:
             selected_experts_with_weights = [("Assistant", "High")]
-    
+
     if not selected_experts_with_weights:
         logger.warning("專家團隊選擇結果為空，將指派預設的 'Assistant' 角色。")
         selected_experts_with_weights = [("Assistant", "High")]
-    
+    return selected_experts_with_weights
+
+
+def preselect_experts(question: str) -> set:
+    return {expert for expert, keywords in EXPERT_KEYWORDS.items()
+            if any(keyword.lower() in question.lower() for keyword in keywords)}
+
+
+@stage("expert_decision")
+def route_experts(original_question: str, search_results: list[dict] | None = None) -> list[tuple]:
+    if search_results:
+        return select_expert_team(original_question, search_results)
+    cached = EXPERT_ROUTER.lookup(original_question)
+    if cached is not None:
+        logger.info(f"專家路由快取命中: {cached}")
+        return cached
+    experts = None
+    if EXPERT_ROUTER_MODE == "embedding":
+        experts = EXPERT_ROUTER.route(original_question)
+        if experts is not None:
+            chosen = {name for name, _ in experts}
+            experts.extend((name, "Medium") for name in sorted(
+                preselect_experts(original_question)) if name not in chosen)
+    if experts is None:
+        experts = select_expert_team(original_question)
+    EXPERT_ROUTER.remember(original_question, experts)
+    return experts
+
+
+@stage("planner")
+def plan_request(original_question: str, search_requested: bool) -> dict | None:
+    logger.info("==> [STEP 4] 請求規劃器以單次結構化調用完成搜尋規劃與專家選擇...")
+    expert_list = list(EXPERT_PROMPTS.keys())
+    pre_selected_experts = sorted(preselect_experts(original_question))
+    properties = {
+        "experts": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "name": {"type": "string", "enum": expert_list},
+                    "influence": {"type": "string", "enum": ["High", "Medium", "Low"]}
+                },
+                "required": ["name", "influence"]
+            }
+        }
+    }
+    search_instruction = ""
+    if search_requested:
+        properties["needs_search"] = {"type": "boolean"}
+        properties["search_query"] = {"type": "string"}
+        search_instruction = (
+            "2.  **Search Plan:** The user asked for a web search. Set `needs_search` to false ONLY if the request can be answered reliably without any up-to-date information. "
+            "Otherwise set it to true and write a concise, keyword-based `search_query` optimized for a search engine.\n")
+    schema = {"type": "object", "properties": properties,
+              "required": list(properties.keys())}
+    planner_prompt = (
+        f"You are a strict and efficient Chief of Staff planning how to answer a user request.\n\n"
+        f"**Your tasks are:**\n"
+        f"1.  **Expert Team:** Choose the experts needed for this request from the list below and assign each an influence level (High, Medium, or Low). "
+        f"The following experts are MANDATORY: {pre_selected_experts if pre_selected_experts else 'None'}\n"
+        f"{search_instruction}\n"
+        f"### Available Experts ###\n"
+        f"{expert_list}\n\n"
+        f"### User Request ###\n"
+        f"\"{original_question}\"\n\n"
+        f"Respond ONLY with a JSON object matching the required schema."
+    )
+    payload = {"model": THINKING_MODEL, "prompt": planner_prompt, "stream": False,
+               "format": schema, "options": {"temperature": 0.0}}
+    try:
+        response = OLLAMA_CLIENT.post("decision", "/api/generate", json=payload)
+        response.raise_for_status()
+        plan_json = json.loads(response.json().get("response", ""))
+        experts = [(e["name"], e["influence"]) for e in plan_json.get("experts", [])
+                   if isinstance(e, dict) and e.get("name") in EXPERT_PROMPTS]
+    except (requests.exceptions.RequestException, ValueError, KeyError, TypeError, AttributeError) as e:
+        logger.warning(f"規劃器調用失敗: {e}. 將退回多次調用流程。", exc_info=True)
+        return None
+
+    chosen = {name for name, _ in experts}
+    experts.extend((name, "Medium")
+                   for name in pre_selected_experts if name not in chosen)
+    if not experts:
+        experts = [("Assistant", "High")]
+    plan = {"experts": experts,
+            "needs_search": bool(plan_json.get("needs_search", search_requested)),
+            "search_query": str(plan_json.get("search_query", "")).strip().replace("\"", "")}
     logger.info(
-        f"--- [STEP 5] 模型決策: 選擇專家團隊 -> {selected_experts_with_weights} ---")
+        f"規劃結果: 需要搜尋={plan['needs_search']}, 查詢='{plan['search_query']}', 專家={plan['experts']}")
+    return plan
+
+
+class PipelineError(Exception):
+    def __init__(self, message: str, error_type: str, status_code: int, retry_after: float | None = None):
+        super().__init__(message)
+        self.message = message
+        self.error_type = error_type
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class _SizedStream:
+    """讓 requests 以原本的 Content-Length 邊讀邊送 WSGI 輸入，而不必先把整個本文讀進記憶體。"""
+
+    def __init__(self, stream, length: int):
+        self.stream = stream
+        self.length = length
+
+    def read(self, size: int = -1) -> bytes:
+        return self.stream.read(size)
+
+    def __len__(self) -> int:
+        return self.length
 
-    weight_map = {"High": 0, "Medium": 1, "Low": 2}
-    sorted_experts = sorted(selected_experts_with_weights,
-                            key=lambda x: weight_map.get(x[1], 99))
-    lead_expert_name, _ = sorted_experts[0]
-    lead_expert_prompt = EXPERT_PROMPTS.get(lead_expert_name, "")
+    def __iter__(self):
+        while chunk := self.stream.read(REQUEST_BODY_CHUNK_SIZE):
+            yield chunk
 
-    consultant_prompts = ""
-    if len(sorted_experts) > 1:
-        consultant_prompts += "\n### CONSULTING EXPERTS' PERSPECTIVES ###\nYou must incorporate the perspectives of:\n"
-        for name, influence in sorted_experts[1:]:
-            consultant_prompts += f"- **{name} (Influence: {influence})**: {EXPERT_PROMPTS.get(name, '')}\n"
 
-    base_system_prompt = lead_expert_prompt + consultant_prompts
+def streamed_request_body():
+    if request.content_length is not None:
+        return _SizedStream(request.stream, request.content_length)
+    # 客戶端以 chunked 傳送時長度未知，上游同樣以 chunked 轉送
+    return iter(lambda: request.stream.read(REQUEST_BODY_CHUNK_SIZE), b"")
+
+
+def parse_json_body(raw: bytes) -> dict:
+    try:
+        payload = json.loads(raw)
+    except ValueError as e:
+        raise PipelineError(f"請求本文不是有效的 JSON: {e}", "invalid_request_error", 400)
+    if not isinstance(payload, dict):
+        raise PipelineError("請求本文必須是 JSON 物件。", "invalid_request_error", 400)
+    return payload
+
+
+def read_json_body() -> tuple[bytes, dict]:
+    """讀取並解析 JSON 本文，不經 Flask 快取，原始位元組在轉發或解析後即可釋放；回傳 (原始位元組, 解析結果)。"""
+    if request.content_length is not None and request.content_length > MAX_JSON_BODY_BYTES:
+        raise PipelineError(f"請求本文超過 {MAX_JSON_BODY_BYTES} 位元組上限。", "request_too_large", 413)
+    raw = request.stream.read(MAX_JSON_BODY_BYTES + 1)
+    if len(raw) > MAX_JSON_BODY_BYTES:
+        raise PipelineError(f"請求本文超過 {MAX_JSON_BODY_BYTES} 位元組上限。", "request_too_large", 413)
+    return raw, parse_json_body(raw)
+
+
+@dataclass
+class PreparedChat:
+    adapter: object
+    route: str
+    payload: dict | None = None
+    apology_text: str | None = None
+    failure_message: str = "最終請求轉發失敗"
+    failure_type: str = "forwarding_error"
+
+    @property
+    def endpoint(self) -> str:
+        return upstream_endpoint(self.adapter)
+
+    @property
+    def content_type(self) -> str:
+        return CONTENT_TYPES[self.adapter.stream_format]
+
+
+@stage("vision")
+def describe_image(image_base64: str) -> str:
+    vision_prompt = "Describe this image in detail."
+    cache_key = image_content_key(image_base64, VISION_MODEL, vision_prompt)
+    image_description = VISION_CACHE.get(cache_key)
+    if image_description is not None:
+        logger.info(f"視覺描述快取命中 ({cache_key[:12]})，略過視覺模型。")
+        return image_description
+    vision_payload = {"model": VISION_MODEL, "prompt": vision_prompt, "images": [
+        image_base64], "stream": False}
+    try:
+        vision_response = OLLAMA_CLIENT.post(
+            "vision", "/api/generate", json=vision_payload)
+        vision_response.raise_for_status()
+        image_description = vision_response.json().get("response")
+    except AdmissionRejected as e:
+        raise PipelineError(f"調用視覺模型出錯: {e}", "overloaded", e.status_code, e.retry_after)
+    except requests.exceptions.RequestException as e:
+        raise PipelineError(f"調用視覺模型出錯: {e}", "vision_model_error", 502)
+    if not image_description:
+        return "Could not get a description."
+    VISION_CACHE.set(cache_key, image_description)
+    return image_description
+
+
+def upstream_endpoint(adapter) -> str:
+    return "/api/chat" if STREAM_TRANSLATION == "native" else adapter.get_final_stream_endpoint()
+
+
+def finalize_payload(adapter, payload: dict) -> dict:
+    """轉為上游端點的請求格式，並在原生端點上帶入 keep_alive。"""
+    endpoint = upstream_endpoint(adapter)
+    if endpoint == "/api/chat" and adapter.stream_format != OLLAMA:
+        payload = openai_to_ollama_request(payload)
+    # OpenAI 相容端點不支援 keep_alive，只在原生 /api/ 端點上帶入
+    if endpoint.startswith("/api/"):
+        payload.setdefault("keep_alive", MODEL_KEEP_ALIVE)
+    return payload
+
+
+def build_stream_translator(prepared: PreparedChat, client_request_json: dict, meter: StreamMeter,
+                            on_complete=None) -> StreamTranslator | None:
+    """原生模式下把 /api/chat 的 NDJSON 轉為客戶端格式；shim 模式直接轉送 Ollama 相容層的輸出，回傳 None。"""
+    if STREAM_TRANSLATION != "native":
+        return None
+    stream_options = client_request_json.get("stream_options") or {}
+    return StreamTranslator(OLLAMA, prepared.adapter.stream_format, prepared.payload.get("model"),
+                            flush_interval=STREAM_FLUSH_INTERVAL,
+                            include_usage=bool(stream_options.get("include_usage")), meter=meter,
+                            on_complete=on_complete)
+
+
+def prepare_vision_request(adapter, user_prompt, image_base64, persona_prompt) -> PreparedChat:
+    logger.info("進入圖文處理流程...")
+    image_description = describe_image(image_base64)
+    new_messages = build_messages(
+        persona_prompt, user_prompt, context=f"Image Description: '{image_description}'.")
+    thinking_payload = finalize_payload(adapter, {"model": THINKING_MODEL,
+                                                  "messages": new_messages, "stream": True})
+    logger.info("將視覺模型描述與問題傳遞給思考模型，並流式傳輸回應。")
+    return PreparedChat(adapter, "vision", payload=thinking_payload,
+                        failure_message="調用思考模型出錯", failure_type="thinking_model_error")
+
+
+def generate_apology_stream(apology_text: str, adapter):
+    # 依客戶端格式輸出：LobeChat 等原生客戶端收到 NDJSON，OpenAI 客戶端收到 SSE
+    yield text_stream(apology_text, adapter.stream_format, THINKING_MODEL)
+
+
+def generate_cached_stream(answer: dict, prepared: PreparedChat, client_request_json: dict):
+    stream_options = client_request_json.get("stream_options") or {}
+    yield replay_stream(answer, prepared.adapter.stream_format, prepared.payload.get("model"),
+                        include_usage=bool(stream_options.get("include_usage")))
+
+
+CITATION_INSTRUCTION = (
+    "**CRITICAL INSTRUCTIONS (You must follow BOTH):**\n"
+    "1.  **In-line Citations:** ... `[Source X]`.\n"
+    "2.  **Final Reference List:** ... `References` or `資料來源`... list every source you cited... format MUST be exactly as follows:\n"
+    "    *   [Source 1] - Title of the first article (URL: the_full_url_here)"
+)
+
+
+def response_cache_lookup(kind: str, payload: dict, client_request_json: dict, no_cache: bool = False,
+                          scope: str = ""):
+    """回傳 (快取鍵, 快取內容, 快取狀態標頭)；未啟用時全為 None，非確定性請求為 BYPASS (鍵為 None)。
+
+    `Cache-Control: no-cache` 的請求不讀取快取，但仍會以新的回應覆寫。
+    """
+    if RESPONSE_CACHE is None:
+        return None, None, None
+    # shim 模式的串流由 Ollama 相容層直接輸出，代理看不到完整答案
+    if not RESPONSE_CACHE.deterministic(client_request_json) or (kind == "stream" and STREAM_TRANSLATION != "native"):
+        RESPONSE_CACHE_LOOKUPS.inc(kind=kind, status="bypass")
+        return None, None, "BYPASS"
+    key = RESPONSE_CACHE.make_key(kind, payload, scope)
+    cached = None if no_cache else RESPONSE_CACHE.get(key)
+    status = "HIT" if cached is not None else "MISS"
+    RESPONSE_CACHE_LOOKUPS.inc(kind=kind, status=status.lower())
+    return key, cached, status
+
+
+def purge_cache_entries(args) -> int:
+    """依 `key` 清除單一項目，或依 `prefix` (例如 `模型名稱/`) 清除；兩者皆未提供時清除全部。"""
+    if args.get("key"):
+        purged = RESPONSE_CACHE.purge(key=args["key"])
+    else:
+        purged = RESPONSE_CACHE.purge(prefix=args.get("prefix", ""))
+    logger.info(f"已清除 {purged} 筆回應快取。")
+    return purged
+
+
+def wants_fresh_response(headers) -> bool:
+    return "no-cache" in headers.get("Cache-Control", "").lower()
+
+
+def cache_stream_answer(key: str | None):
+    """回傳 StreamTranslator 的 on_complete 回呼，把完整答案寫入回應快取。"""
+    if key is None:
+        return None
+    return lambda answer: RESPONSE_CACHE.put(key, answer)
+
+
+def progress_format(subpath: str) -> str | None:
+    """回傳提早開啟串流時要使用的客戶端格式；停用或找不到轉接器時回傳 None，改為等待前置階段完成。"""
+    adapter_class = find_adapter(subpath)
+    if PROGRESS_EVENTS == "off" or adapter_class is None:
+        return None
+    return adapter_class.stream_format
+
+
+def encode_progress(texts: list[str], client_format: str) -> bytes:
+    """把狀態文字編碼成客戶端格式；空串列代表送出一個保活事件。"""
+    visible = PROGRESS_EVENTS == "thinking"
+    return b"".join(progress_event(text, client_format, THINKING_MODEL, visible) for text in texts or [""])
+
+
+def deferred_headers_event(response_headers, client_format: str, trace) -> bytes:
+    """提早開啟的串流已送出標頭；把最終回應原本會帶的快取狀態與當下的 Server-Timing 改以串流內事件送出。"""
+    headers = {}
+    if RESPONSE_CACHE_HEADER in response_headers:
+        headers[RESPONSE_CACHE_HEADER] = response_headers[RESPONSE_CACHE_HEADER]
+    if trace is not None:
+        headers["Server-Timing"] = trace.server_timing()
+    return headers_event(headers, client_format, THINKING_MODEL)
+
+
+def is_chat_request(method: str, subpath: str) -> bool:
+    return method == 'POST' and ("v1/chat/completions" in subpath or "api/chat" in subpath)
+
+
+def is_embed_request(method: str, subpath: str) -> bool:
+    return EMBED_BATCHER is not None and method == 'POST' and subpath.strip("/") in ("api/embed", "api/embeddings")
+
+
+def serve_embed_request(subpath: str, payload: dict) -> dict | None:
+    """經由 EMBED_BATCHER 處理嵌入請求；輸入格式無法合併 (例如 token 陣列) 時回傳 None，由呼叫端原樣轉發。"""
+    if subpath.strip("/") == "api/embeddings":
+        return EMBED_BATCHER.embeddings(payload)
+    if not EMBED_BATCHER.batchable(payload):
+        return None
+    return EMBED_BATCHER.embed(payload)
+
+
+def prepare_chat_request(subpath: str, client_request_json: dict) -> PreparedChat:
+    """執行所有前置階段（解析、搜尋、專家決策、視覺），回傳待轉發的最終請求；與 Web 框架無關。"""
+    profiling = SLOW_REQUEST_PROFILER.track(subpath) if SLOW_REQUEST_PROFILER else contextlib.nullcontext()
+    with profiling:
+        return _prepare_chat_request(subpath, client_request_json)
+
+
+def _prepare_chat_request(subpath: str, client_request_json: dict) -> PreparedChat:
+    logger.info(f"--- [STEP 1] 接收到【流式】請求: {subpath} ---")
+    adapter_class = find_adapter(subpath)
+    if not adapter_class:
+        raise PipelineError(
+            f"不支援的 API 路徑: {subpath}", "unsupported_path", 404)
+
+    adapter = adapter_class(client_request_json)
+    logger.info(f"==> [STEP 2] 使用適配器: {adapter.name}")
+    try:
+        with stage("adapter_parse"):
+            user_prompt, core_question, image_base64 = adapter.parse()
+    except Exception as e:
+        raise PipelineError(f"適配器解析失敗: {e}", "adapter_error", 400)
+
+    logger.info(f"--- [STEP 3] 初始解析出的核心問題: '{core_question[:200]}...' ---")
+    SEARCH_PREFIX = "@網路搜尋"
+    search_context = None
+    original_question = core_question
+    search_results = []
+
+    expert_future = None
+    plan = None
+
+    if core_question.strip().startswith(SEARCH_PREFIX):
+        original_question = core_question.strip().split(
+            '\n')[0].replace(SEARCH_PREFIX, "", 1).strip()
+        if original_question:
+            if PLANNER_MODE:
+                plan = plan_request(original_question, search_requested=True)
+            if plan is None and EXPERT_SELECTION_MODE == "pipelined":
+                expert_future = submit_in_context(
+                    PIPELINE_EXECUTOR, route_experts, original_question)
+            if plan is None:
+                search_query = generate_search_query(original_question)
+            elif plan["needs_search"]:
+                search_query = plan["search_query"] or original_question
+            else:
+                logger.info("規劃器判斷此問題無需網路搜尋，略過搜尋階段。")
+                search_query = None
+            if search_query:
+                search_results = perform_web_search(
+                    search_query, max_results=5)
+            if search_results:
+                search_context = generate_search_context(
+                    search_results, original_question)
+            image_base64 = None
+    elif PLANNER_MODE:
+        plan = plan_request(original_question, search_requested=False)
+
+    if plan is not None:
+        selected_experts_with_weights = plan["experts"]
+    elif expert_future is not None:
+        selected_experts_with_weights = expert_future.result()
+    else:
+        selected_experts_with_weights = route_experts(
+            original_question, search_results if EXPERT_SELECTION_MODE == "snippet_aware" else None)
+
+    logger.info(
+        f"--- [STEP 5] 模型決策: 選擇專家團隊 -> {selected_experts_with_weights} ---")
+
+    # 團隊順序與角色文字只取決於選出的專家集合，與模型輸出順序無關，系統訊息才能跨請求重用前綴快取
+    persona_prompt = build_persona_prompt(
+        canonical_team(selected_experts_with_weights), EXPERT_PROMPTS)
 
     if image_base64 and not search_context:
         logger.info("==> [STEP 6] 路由決策: 進入【圖文處理】流程。")
-        return handle_vision_request(adapter, user_prompt, image_base64, base_system_prompt)
+        return prepare_vision_request(adapter, user_prompt, image_base64, persona_prompt)
     elif search_context and original_question:
         logger.info("==> [STEP 6] 路由決策: 進入【網路搜尋】流程。")
-        final_messages = []
         if is_context_relevant(search_context, original_question):
-            citation_instruction = (
-                "**CRITICAL INSTRUCTIONS (You must follow BOTH):**\n"
-                "1.  **In-line Citations:** ... `[Source X]`.\n"
-                "2.  **Final Reference List:** ... `References` or `資料來源`... list every source you cited... format MUST be exactly as follows:\n"
-                "    *   [Source 1] - Title of the first article (URL: the_full_url_here)"
-            )
-            final_system_prompt = f"{base_system_prompt}\n\n{citation_instruction}\n\n{search_context}"
-            final_messages.append(
-                {"role": "system", "content": final_system_prompt})
-            final_messages.append(
-                {"role": "user", "content": original_question})
+            final_messages = build_messages(
+                f"{persona_prompt}\n\n{CITATION_INSTRUCTION}", original_question, context=search_context)
         else:
             logger.warning("上下文關聯性檢查未通過，生成標準回覆。")
-            apology_text = "我進行了網路搜尋，但找到的資料似乎與您提出的問題關聯性不高..."
-
-            def generate_apology_stream():
-                chunk_id = "chatcmpl-mock"
-                created_time = int(datetime.now().timestamp())
-                delta_payload = {
-                    "id": chunk_id, "object": "chat.completion.chunk", "created": created_time,
-                    "model": THINKING_MODEL, "choices": [{"index": 0, "delta": {"role": "assistant", "content": apology_text}, "finish_reason": None}]
-                }
-                yield f"data: {json.dumps(delta_payload)}\n\n"
-                done_payload = {
-                    "id": chunk_id, "object": "chat.completion.chunk", "created": created_time,
-                    "model": THINKING_MODEL, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]
-                }
-                yield f"data: {json.dumps(done_payload)}\n\n"
-                yield "data: [DONE]\n\n"
-            return Response(generate_apology_stream(), content_type='text/event-stream')
+            return PreparedChat(adapter, "apology", apology_text="我進行了網路搜尋，但找到的資料似乎與您提出的問題關聯性不高...")
+        route = "search"
     else:
         logger.info("==> [STEP 6] 路由決策: 進入【標準文字】流程。")
-        final_messages = []
-        final_messages.append(
-            {"role": "system", "content": base_system_prompt})
         original_messages = client_request_json.get("messages", [])
-        final_messages.extend([msg for msg in original_messages if msg.get(
-            "role") not in ["system", "developer"]])
+        history = [msg for msg in original_messages if msg.get(
+            "role") not in ["system", "developer"]]
+        history_summary = None
+        if CONVERSATION_WINDOW.budget_tokens > 0:
+            history_summary, history = CONVERSATION_WINDOW.fit(history)
+        system_prompt = persona_prompt
+        if history_summary:
+            system_prompt += f"\n\n### EARLIER CONVERSATION SUMMARY ###\n{history_summary}"
+        final_messages = [{"role": "system", "content": system_prompt}] + history
+        route = "standard"
 
     logger.info("==> [STEP 7] 正在組裝最終 payload 並轉發至 Ollama...")
-    forward_payload = client_request_json.copy()
-    forward_payload['messages'] = final_messages
-    forward_payload['model'] = THINKING_MODEL
+    # 淺層複製即可：原始訊息 (含 base64 圖片字串) 與轉發內容共用同一份物件，不會再複製一次
+    forward_payload = {**client_request_json, 'messages': final_messages, 'model': THINKING_MODEL}
+    return PreparedChat(adapter, route, payload=finalize_payload(adapter, forward_payload))
+
+
+def forward_headers() -> dict:
+    return {k: v for (k, v) in request.headers if k.lower() not in FORWARD_EXCLUDED_HEADERS}
+
+
+def handle_embed_request(subpath: str) -> Response:
+    set_route("embed")
+    try:
+        raw_body, payload = read_json_body()
+        body = serve_embed_request(subpath, payload)
+        if body is None:
+            resp = OLLAMA_CLIENT.post("passthrough", subpath, headers=forward_headers(), data=raw_body,
+                                      model=payload.get("model"))
+            return Response(resp.content, status=resp.status_code, content_type=resp.headers.get('content-type'))
+    except PipelineError as e:
+        return create_error_response(e.message, e.error_type, e.status_code)
+    except EmbedUpstreamError as e:
+        return Response(e.body, status=e.status_code, content_type=e.content_type)
+    except AdmissionRejected as e:
+        return create_error_response(str(e), "overloaded", e.status_code, e.retry_after)
+    except requests.exceptions.RequestException as e:
+        return create_error_response(f"嵌入請求轉發失敗: {e}", "forwarding_error", 502)
+    return Response(json.dumps(body), mimetype='application/json')
+
+
+@app.route('/<path:subpath>', methods=['POST', 'OPTIONS'])
+def intelligent_proxy(subpath):
+    if request.method == 'OPTIONS':
+        return Response(status=200)
+
+    if is_embed_request(request.method, subpath):
+        return handle_embed_request(subpath)
+
+    if not is_chat_request(request.method, subpath):
+        logger.info(f"進入通用轉發器處理 {request.method} /{subpath}...")
+        set_route("passthrough")
+        try:
+            resp = OLLAMA_CLIENT.request("passthrough", request.method, subpath, headers=forward_headers(),
+                                         data=streamed_request_body(), params=request.args, stream=True)
+            return Response(stream_forwarder(resp), status=resp.status_code, content_type=resp.headers.get('content-type'))
+        except requests.exceptions.RequestException as e:
+            return create_error_response(f"通用轉發失敗: {e}", "forwarding_error", 502)
 
     try:
-        ollama_response = requests.post(
-            f"{OLLAMA_BASE_URL}{adapter.get_final_stream_endpoint()}", json=forward_payload, stream=True)
+        raw_body, client_request_json = read_json_body()
+    except PipelineError as e:
+        set_route("error")
+        return create_error_response(e.message, e.error_type, e.status_code)
+    if not client_request_json.get("stream", False):
+        logger.info("檢測到非流式請求，進入通用轉發器...")
+        set_route("non_stream")
+        cache_key, cached, cache_status = response_cache_lookup(
+            "response", client_request_json, client_request_json, wants_fresh_response(request.headers), subpath)
+        if cached is not None:
+            return Response(cached["body"], content_type=cached["content_type"],
+                            headers={RESPONSE_CACHE_HEADER: cache_status})
+        try:
+            # 原樣轉送客戶端的位元組，不必重新序列化
+            resp = OLLAMA_CLIENT.post("passthrough", subpath, headers=forward_headers(), data=raw_body,
+                                      model=client_request_json.get("model"))
+            if cache_key is not None and resp.status_code == 200:
+                RESPONSE_CACHE.put(cache_key, {"body": resp.content, "content_type": resp.headers.get('content-type')})
+            response = Response(resp.content, status=resp.status_code, content_type=resp.headers.get('content-type'))
+            if cache_status:
+                response.headers[RESPONSE_CACHE_HEADER] = cache_status
+            return response
+        except AdmissionRejected as e:
+            return create_error_response(str(e), "overloaded", e.status_code, e.retry_after)
+        except requests.exceptions.RequestException as e:
+            return create_error_response(f"非流式轉發失敗: {e}", "forwarding_error", 502)
+
+    # 之後只需要解析後的內容，提早釋放原始位元組
+    raw_body = None
+    no_cache = wants_fresh_response(request.headers)
+    client_format = progress_format(subpath)
+    try:
+        SCHEDULER.check_capacity(THINKING_MODEL, "stream")
+        if client_format is None or not PREPARE_SLOTS.acquire(blocking=False):
+            prepared = prepare_chat_request(subpath, client_request_json)
+        else:
+            channel = ProgressChannel()
+            current_trace().progress_listener = channel
+            try:
+                future = submit_in_context(PREPARE_EXECUTOR, prepare_chat_request, subpath, client_request_json)
+            except BaseException:
+                PREPARE_SLOTS.release()
+                raise
+            future.add_done_callback(lambda _: PREPARE_SLOTS.release())
+            future.add_done_callback(channel.close)
+            try:
+                # 寬限時間內完成時與不提早開啟串流完全相同，錯誤仍以正確的 HTTP 狀態碼回應
+                prepared = future.result(timeout=PROGRESS_GRACE)
+            except FuturesTimeoutError:
+                logger.info(f"前置階段超過 {PROGRESS_GRACE}s，提早開啟串流並送出進度事件。")
+                return Response(progress_then_stream(future, channel, client_format, client_request_json, no_cache,
+                                                     current_trace()),
+                                content_type=CONTENT_TYPES[client_format])
+    except AdmissionRejected as e:
+        set_route("rejected")
+        return create_error_response(str(e), "overloaded", e.status_code, e.retry_after)
+    except PipelineError as e:
+        set_route("error")
+        return create_error_response(e.message, e.error_type, e.status_code, e.retry_after)
+    set_route(prepared.route)
+    try:
+        return open_final_stream(prepared, client_request_json, no_cache)
+    except PipelineError as e:
+        return create_error_response(e.message, e.error_type, e.status_code, e.retry_after)
+
+
+def open_final_stream(prepared: PreparedChat, client_request_json: dict, no_cache: bool) -> Response:
+    """把前置階段的結果 (道歉訊息、快取或上游串流) 包成最終串流回應；連線上游失敗時拋出 PipelineError。"""
+    if prepared.apology_text is not None:
+        return Response(generate_apology_stream(prepared.apology_text, prepared.adapter),
+                        content_type=prepared.content_type)
+    cache_key, cached, cache_status = response_cache_lookup("stream", prepared.payload, client_request_json, no_cache)
+    cache_headers = {RESPONSE_CACHE_HEADER: cache_status} if cache_status else None
+    if cached is not None:
+        return Response(generate_cached_stream(cached, prepared, client_request_json),
+                        content_type=prepared.content_type, headers=cache_headers)
+
+    ollama_response = None
+    try:
+        with stage("upstream_connect"):
+            ollama_response = OLLAMA_CLIENT.post(
+                "stream", prepared.endpoint, json=prepared.payload, stream=True)
         ollama_response.raise_for_status()
         logger.info("==> [STEP 8] 成功轉發請求，開始流式傳輸回應。")
-        return Response(stream_forwarder(ollama_response), status=ollama_response.status_code, content_type=ollama_response.headers.get('content-type'))
+        meter = StreamMeter(prepared.route, current_trace())
+        translator = build_stream_translator(prepared, client_request_json, meter, cache_stream_answer(cache_key))
+        if translator is not None:
+            response = Response(translated_stream(ollama_response, translator), status=ollama_response.status_code,
+                                content_type=prepared.content_type, headers=cache_headers)
+        else:
+            response = Response(stream_forwarder(ollama_response, meter), status=ollama_response.status_code,
+                                content_type=ollama_response.headers.get('content-type'), headers=cache_headers)
+        # 產生器尚未開始時關閉它不會執行其 finally，上游連線與各項名額需另外歸還 (重複關閉無害)
+        response.call_on_close(ollama_response.close)
+        return response
+    except AdmissionRejected as e:
+        raise PipelineError(str(e), "overloaded", e.status_code, e.retry_after)
     except requests.exceptions.RequestException as e:
-        return create_error_response(f"最終請求轉發失敗: {e}", "forwarding_error", 502)
+        if ollama_response is not None:
+            ollama_response.close()
+        raise PipelineError(f"{prepared.failure_message}: {e}", prepared.failure_type, 502)
+
+
+def progress_then_stream(future, channel: ProgressChannel, client_format: str, client_request_json: dict,
+                         no_cache: bool, trace):
+    """先送出前置階段的進度事件 (沒有新進度時定期保活)，完成後在同一條回應中接上最終串流。"""
+    items, closed = channel.wait(0)
+    trace.mark_first_byte("progress")
+    yield encode_progress(items, client_format)
+    while not closed:
+        items, closed = channel.wait(PROGRESS_KEEPALIVE_INTERVAL)
+        if items or not closed:
+            yield encode_progress(items, client_format)
+    trace.progress_listener = None
+    # 狀態碼已經送出，之後的失敗只能以客戶端格式的錯誤事件結束串流
+    try:
+        prepared = future.result()
+    except AdmissionRejected as e:
+        set_route("rejected")
+        yield error_event(str(e), client_format, THINKING_MODEL)
+        return
+    except PipelineError as e:
+        set_route("error")
+        logger.error(f"提早開啟的串流在前置階段失敗: {e.message}")
+        yield error_event(e.message, client_format, THINKING_MODEL)
+        return
+    except Exception as e:
+        # 前置階段的非預期錯誤：不能讓例外中斷已開始的回應，否則客戶端只會收到沒有結尾的串流
+        set_route("error")
+        logger.error(f"提早開啟的串流在前置階段發生未預期的錯誤: {e}", exc_info=True)
+        yield error_event(f"處理請求時發生內部錯誤: {e}", client_format, THINKING_MODEL)
+        return
+    set_route(prepared.route)
+    try:
+        response = open_final_stream(prepared, client_request_json, no_cache)
+    except PipelineError as e:
+        yield error_event(e.message, client_format, THINKING_MODEL)
+        return
+    try:
+        yield deferred_headers_event(response.headers, client_format, trace)
+        yield from response.response
+    finally:
+        response.close()
 
 
 if __name__ == '__main__':
+    port = int(os.getenv("PROXY_PORT", "5000"))
     logger.info("="*60)
     logger.info(
         "  Universal Adapter Proxy Started - Refactored & Compatible Version")
     logger.info(f"  Thinking Model: {THINKING_MODEL}")
     logger.info(f"  Vision Model: {VISION_MODEL}")
-    logger.info("  Listening on: http://localhost:5000")
+    logger.info(f"  Listening on: http://localhost:{port}")
     logger.info("="*60)
     try:
         from waitress import serve
-        serve(app, host='0.0.0.0', port=5000)
+        serve(app, host='0.0.0.0', port=port)
     except ImportError:
         logger.warning(
             "Waitress not found. Falling back to Flask's development server.")
-        app.run(host='0.0.0.0', port=5000)
+        app.run(host='0.0.0.0', port=port)
@@ -0,0 +1,70 @@
+import hashlib
+import json
+import threading
+
+from caching import LRUCache
+
+# 影響生成結果的欄位；stream、keep_alive 與 stream_options 只影響傳輸方式，不列入快取鍵
+KEY_FIELDS = ("messages", "prompt", "system", "template", "images", "options", "format", "tools", "think",
+              "temperature", "top_p", "seed", "stop", "max_tokens", "max_completion_tokens",
+              "frequency_penalty", "presence_penalty", "response_format")
+
+
+def _entry_size(entry: dict) -> int:
+    if "body" in entry:
+        return len(entry["body"]) + 256
+    return len(entry.get("content", "").encode("utf-8")) + len(entry.get("thinking", "").encode("utf-8")) + 256
+
+
+class ResponseCache:
+    """溫度為 0 的請求之完整回應快取，以位元組數為容量上限並依 LRU/TTL 淘汰。
+
+    鍵的格式為 `模型/類型/雜湊`，可依單一鍵或前綴 (例如某個模型) 清除。
+    串流類型保存與格式無關的完整答案，命中時依客戶端格式重新編碼；非串流類型保存上游的原始回應本文。
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, ttl: float = 3600, max_entries: int = 10000):
+        self._cache = LRUCache(maxsize=max_entries, ttl=ttl, max_weight=max_bytes, weigher=_entry_size)
+        self._lock = threading.Lock()
+        self.stores = 0
+        self.purged = 0
+
+    @staticmethod
+    def deterministic(payload: dict) -> bool:
+        """只有明確設定為數值 0 的溫度才視為確定性請求；格式錯誤的值一律略過快取，不讓請求失敗。"""
+        options = payload.get("options")
+        temperature = payload.get("temperature")
+        if isinstance(options, dict) and "temperature" in options:
+            temperature = options["temperature"]
+        return isinstance(temperature, (int, float)) and not isinstance(temperature, bool) and temperature == 0
+
+    @staticmethod
+    def make_key(kind: str, payload: dict, scope: str = "") -> str:
+        material = [scope] + [payload.get(field) for field in KEY_FIELDS]
+        digest = hashlib.sha256(json.dumps(material, sort_keys=True, ensure_ascii=False,
+                                           separators=(",", ":")).encode("utf-8")).hexdigest()
+        return f"{payload.get('model')}/{kind}/{digest}"
+
+    def get(self, key: str) -> dict | None:
+        return self._cache.get(key)
+
+    def put(self, key: str, entry: dict):
+        self._cache.set(key, entry)
+        with self._lock:
+            self.stores += 1
+
+    def purge(self, key: str | None = None, prefix: str | None = None) -> int:
+        if key is not None:
+            removed = int(self._cache.pop(key) is not None)
+        else:
+            removed = 0
+            for candidate in self._cache.keys():
+                if candidate.startswith(prefix or "") and self._cache.pop(candidate) is not None:
+                    removed += 1
+        with self._lock:
+            self.purged += removed
+        return removed
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._cache.stats(), "stores": self.stores, "purged": self.purged}
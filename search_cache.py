@@ -0,0 +1,166 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from caching import normalize_text
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS search_queries (
+    query TEXT PRIMARY KEY,
+    results TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    last_access REAL NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS page_extracts (
+    url TEXT PRIMARY KEY,
+    main_text TEXT NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    fetched_at REAL NOT NULL,
+    summary_question TEXT,
+    summary TEXT,
+    last_access REAL NOT NULL,
+    size INTEGER NOT NULL
+);
+"""
+
+
+class SearchCache:
+    """以 SQLite 保存搜尋結果與網頁正文/摘要，跨重啟保留並依容量淘汰最久未使用的項目。"""
+
+    def __init__(self, path: str, query_ttl: float = 6 * 3600, page_ttl: float = 24 * 3600,
+                 max_bytes: int = 64 * 1024 * 1024):
+        self.path = path
+        self.query_ttl = query_ttl
+        self.page_ttl = page_ttl
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._counter_lock = threading.Lock()
+        # 命中時的 last_access 更新先記在記憶體，下次寫入時在寫入鎖內一併套用，讀取路徑不寫入資料庫
+        self._touched = {"search_queries": {}, "page_extracts": {}}
+        self.counters = {"query_hits": 0, "query_misses": 0, "page_hits": 0, "page_misses": 0,
+                         "page_revalidated": 0, "summary_hits": 0, "evictions": 0}
+        with self._write_lock:
+            self._conn().executescript(_SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _count(self, name: str):
+        with self._counter_lock:
+            self.counters[name] += 1
+
+    def _touch(self, table: str, key: str, now: float):
+        with self._counter_lock:
+            self._touched[table][key] = now
+
+    def _apply_touches(self, conn: sqlite3.Connection):
+        """在寫入鎖內呼叫；last_access 只影響淘汰順序，延後套用不影響讀取結果。"""
+        with self._counter_lock:
+            touched, self._touched = self._touched, {"search_queries": {}, "page_extracts": {}}
+        for table, column in (("search_queries", "query"), ("page_extracts", "url")):
+            if touched[table]:
+                conn.executemany(
+                    f"UPDATE {table} SET last_access = MAX(last_access, ?) WHERE {column} = ?",
+                    [(now, key) for key, now in touched[table].items()])
+
+    def get_query(self, query: str, max_results: int) -> list[dict] | None:
+        key = f"{max_results}:{normalize_text(query)}"
+        row = self._conn().execute(
+            "SELECT results, created_at FROM search_queries WHERE query = ?", (key,)).fetchone()
+        now = time.time()
+        if row is None or now - row[1] > self.query_ttl:
+            self._count("query_misses")
+            return None
+        self._touch("search_queries", key, now)
+        self._count("query_hits")
+        return json.loads(row[0])
+
+    def put_query(self, query: str, max_results: int, results: list[dict]):
+        key = f"{max_results}:{normalize_text(query)}"
+        payload = json.dumps(results, ensure_ascii=False)
+        now = time.time()
+        with self._write_lock:
+            self._conn().execute(
+                "INSERT OR REPLACE INTO search_queries VALUES (?, ?, ?, ?, ?)",
+                (key, payload, now, now, len(payload.encode("utf-8"))))
+            self._evict()
+
+    def get_page(self, url: str) -> dict | None:
+        row = self._conn().execute(
+            "SELECT main_text, etag, last_modified, fetched_at, summary_question, summary "
+            "FROM page_extracts WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            self._count("page_misses")
+            return None
+        now = time.time()
+        self._touch("page_extracts", url, now)
+        page = {"main_text": row[0], "etag": row[1], "last_modified": row[2],
+                "summary_question": row[4], "summary": row[5],
+                "fresh": now - row[3] <= self.page_ttl}
+        self._count("page_hits" if page["fresh"] else "page_misses")
+        return page
+
+    def put_page(self, url: str, main_text: str, etag: str | None, last_modified: str | None):
+        now = time.time()
+        with self._write_lock:
+            self._conn().execute(
+                "INSERT OR REPLACE INTO page_extracts VALUES (?, ?, ?, ?, ?, NULL, NULL, ?, ?)",
+                (url, main_text, etag, last_modified, now, now, len(main_text.encode("utf-8"))))
+            self._evict()
+
+    def mark_revalidated(self, url: str):
+        self._count("page_revalidated")
+        with self._write_lock:
+            self._conn().execute(
+                "UPDATE page_extracts SET fetched_at = ? WHERE url = ?", (time.time(), url))
+
+    def get_summary(self, page: dict | None, question: str) -> str | None:
+        if page and page["summary"] and page["summary_question"] == normalize_text(question):
+            self._count("summary_hits")
+            return page["summary"]
+        return None
+
+    def put_summary(self, url: str, question: str, summary: str):
+        with self._write_lock:
+            self._conn().execute(
+                "UPDATE page_extracts SET summary_question = ?, summary = ?, "
+                "size = length(CAST(main_text AS BLOB)) + length(CAST(? AS BLOB)) WHERE url = ?",
+                (normalize_text(question), summary, summary, url))
+
+    def _evict(self):
+        conn = self._conn()
+        self._apply_touches(conn)
+        total = conn.execute(
+            "SELECT (SELECT COALESCE(SUM(size), 0) FROM search_queries) + "
+            "(SELECT COALESCE(SUM(size), 0) FROM page_extracts)").fetchone()[0]
+        while total > self.max_bytes:
+            oldest = conn.execute(
+                "SELECT 'search_queries', query, last_access, size FROM search_queries "
+                "UNION ALL SELECT 'page_extracts', url, last_access, size FROM page_extracts "
+                "ORDER BY last_access LIMIT 64").fetchall()
+            if not oldest:
+                break
+            for table, key, _, size in oldest:
+                column = "query" if table == "search_queries" else "url"
+                conn.execute(f"DELETE FROM {table} WHERE {column} = ?", (key,))
+                total -= size
+                self._count("evictions")
+                if total <= self.max_bytes:
+                    break
+
+    def stats(self) -> dict:
+        with self._counter_lock:
+            return dict(self.counters)
@@ -0,0 +1,235 @@
+import abc
+import hashlib
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
+from urllib.parse import urlsplit, urlunsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from caching import normalize_text
+from metrics import SEARCH_PROVIDER_LATENCY
+
+logger = logging.getLogger(__name__)
+
+
+def _pooled_session(pool_size: int = 8) -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers["User-Agent"] = "Mozilla/5.0 (compatible; ollama-bridge/1.0)"
+    return session
+
+
+class SearchProvider(abc.ABC):
+    """搜尋後端的共同介面；`quota_key` 不為 None 時，每次調用都會先向 UsageStore 申請額度。"""
+
+    name = "base"
+
+    def __init__(self, quota_key: str | None = None, timeout: float = 10.0):
+        self.quota_key = quota_key
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.failures = 0
+        self.empty = 0
+        self.quota_rejections = 0
+        self.total_seconds = 0.0
+
+    def configured(self) -> bool:
+        return True
+
+    @abc.abstractmethod
+    def search(self, query: str, max_results: int) -> list[dict]:
+        ...
+
+    def acquire_quota(self, usage_store) -> bool:
+        """申請一次調用的額度；沒有額度限制時一律允許，額度用盡時記錄並回傳 False。"""
+        if self.quota_key is None or usage_store is None or usage_store.try_acquire(self.quota_key):
+            return True
+        with self._lock:
+            self.quota_rejections += 1
+        return False
+
+    def record(self, outcome: str, seconds: float):
+        SEARCH_PROVIDER_LATENCY.observe(seconds, provider=self.name, outcome=outcome)
+        with self._lock:
+            self.requests += 1
+            self.total_seconds += seconds
+            if outcome == "error":
+                self.failures += 1
+            elif outcome == "empty":
+                self.empty += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"requests": self.requests, "failures": self.failures, "empty": self.empty,
+                    "quota_rejections": self.quota_rejections,
+                    "avg_seconds": round(self.total_seconds / self.requests, 3) if self.requests else 0.0}
+
+
+class GoogleSearchProvider(SearchProvider):
+    """直接呼叫 Custom Search JSON API，重用同一個連線池，不必每次重建 discovery 服務物件。"""
+
+    name = "google"
+
+    def __init__(self, api_key: str | None, cse_id: str | None, endpoint: str | None = None, **kwargs):
+        super().__init__(**kwargs)
+        self.api_key = api_key
+        self.cse_id = cse_id
+        self.url = f"{(endpoint or 'https://customsearch.googleapis.com/').rstrip('/')}/customsearch/v1"
+        self.session = _pooled_session()
+
+    def configured(self) -> bool:
+        return bool(self.api_key and self.cse_id)
+
+    def search(self, query: str, max_results: int) -> list[dict]:
+        response = self.session.get(self.url, params={
+            "key": self.api_key, "cx": self.cse_id, "q": query, "num": min(max_results, 10)},
+            timeout=(5, self.timeout))
+        response.raise_for_status()
+        return [{"title": item.get('title', 'N/A'), "link": item.get('link', 'N/A'),
+                 "snippet": item.get('snippet', 'N/A')} for item in response.json().get('items', [])]
+
+
+class SearxngSearchProvider(SearchProvider):
+    name = "searxng"
+
+    def __init__(self, base_url: str | None, **kwargs):
+        super().__init__(**kwargs)
+        self.base_url = (base_url or "").rstrip("/")
+        self.session = _pooled_session()
+
+    def configured(self) -> bool:
+        return bool(self.base_url)
+
+    def search(self, query: str, max_results: int) -> list[dict]:
+        response = self.session.get(f"{self.base_url}/search", params={"q": query, "format": "json"},
+                                    timeout=(5, self.timeout))
+        response.raise_for_status()
+        return [{"title": item.get('title', 'N/A'), "link": item.get('url', 'N/A'),
+                 "snippet": item.get('content', 'N/A')} for item in response.json().get('results', [])[:max_results]]
+
+
+class StubSearchProvider(SearchProvider):
+    """本地開發用：不連網，依查詢產生固定的假結果；結果標記為 browsable=False，深度瀏覽不會下載這些網址。"""
+
+    name = "stub"
+
+    def __init__(self, base_url: str = "http://localhost", **kwargs):
+        super().__init__(**kwargs)
+        self.base_url = base_url.rstrip("/")
+
+    def search(self, query: str, max_results: int) -> list[dict]:
+        digest = hashlib.sha256(query.encode("utf-8")).hexdigest()[:12]
+        return [{"title": f"Stub result {i + 1} for {query}", "link": f"{self.base_url}/stub/{digest}/{i}",
+                 "snippet": f"Stub snippet {i + 1} about {query}.", "browsable": False} for i in range(max_results)]
+
+
+class FixtureSearchProvider(SearchProvider):
+    """離線測試用：從 JSON 檔讀取 {查詢: [結果...]}，鍵 "*" 為找不到查詢時的預設結果。"""
+
+    name = "fixture"
+
+    def __init__(self, path: str | None, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self.fixtures = {}
+        if path:
+            with open(path, 'r', encoding='utf-8') as f:
+                self.fixtures = {normalize_text(q): results for q, results in json.load(f).items()}
+
+    def configured(self) -> bool:
+        return bool(self.fixtures)
+
+    def search(self, query: str, max_results: int) -> list[dict]:
+        return list(self.fixtures.get(normalize_text(query), self.fixtures.get("*", [])))[:max_results]
+
+
+def _url_key(url: str) -> str:
+    parts = urlsplit(url.strip())
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower().removeprefix("www."),
+                       parts.path.rstrip("/"), parts.query, ""))
+
+
+class SearchRouter:
+    """依策略查詢後端。"first": 依設定順序逐一查詢，採用第一個回傳非空結果者，之後的後端不會被調用也不扣額度；
+    "merge": 並行查詢所有後端，等待全部後依名次交錯合併並去除重複網址。"""
+
+    def __init__(self, providers: list[SearchProvider], usage_store=None, strategy: str = "first",
+                 timeout: float = 10.0):
+        self.providers = [p for p in providers if p.configured()]
+        for provider in providers:
+            if not provider.configured():
+                logger.warning(f"搜尋後端 '{provider.name}' 未設定完整，已停用。")
+        self.usage_store = usage_store
+        self.strategy = strategy
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(1, 4 * len(self.providers)), thread_name_prefix="search")
+
+    def _call(self, provider: SearchProvider, query: str, max_results: int) -> list[dict]:
+        if not provider.acquire_quota(self.usage_store):
+            logger.warning(f"搜尋後端 '{provider.name}' 每日額度已用盡。")
+            return []
+        started = time.monotonic()
+        try:
+            results = provider.search(query, max_results)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            provider.record("error", time.monotonic() - started)
+            logger.error(f"搜尋後端 '{provider.name}' 查詢失敗: {e}")
+            return []
+        provider.record("ok" if results else "empty", time.monotonic() - started)
+        return results
+
+    def search(self, query: str, max_results: int = 5) -> list[dict]:
+        if not self.providers:
+            logger.error("沒有可用的搜尋後端。")
+            return []
+        if self.strategy == "first":
+            return self._search_first(query, max_results)
+        futures = {self._executor.submit(self._call, provider, query, max_results): provider
+                   for provider in self.providers}
+        ranked = {}
+        try:
+            for future in as_completed(futures, timeout=self.timeout):
+                ranked[futures[future].name] = future.result()
+        except FuturesTimeoutError:
+            logger.warning(f"部分搜尋後端超過 {self.timeout}s 未回應，僅使用已取得的結果。")
+        return self._merge([ranked.get(p.name, []) for p in self.providers], max_results)
+
+    def _search_first(self, query: str, max_results: int) -> list[dict]:
+        deadline = time.monotonic() + self.timeout
+        for provider in self.providers:
+            future = self._executor.submit(self._call, provider, query, max_results)
+            try:
+                results = future.result(timeout=max(0.0, deadline - time.monotonic()))
+            except FuturesTimeoutError:
+                logger.warning(f"搜尋超過 {self.timeout}s 仍未取得結果 (最後查詢的後端: '{provider.name}')。")
+                return []
+            if results:
+                logger.info(f"搜尋後端 '{provider.name}' 回傳 {len(results)} 條結果。")
+                return results[:max_results]
+        return []
+
+    @staticmethod
+    def _merge(result_lists: list[list[dict]], max_results: int) -> list[dict]:
+        merged, seen = [], set()
+        for rank in range(max((len(r) for r in result_lists), default=0)):
+            for results in result_lists:
+                if rank >= len(results):
+                    continue
+                key = _url_key(results[rank].get("link", ""))
+                if key in seen:
+                    continue
+                seen.add(key)
+                merged.append(results[rank])
+        return merged[:max_results]
+
+    def stats(self) -> dict:
+        return {"strategy": self.strategy,
+                "providers": {p.name: p.stats() for p in self.providers}}
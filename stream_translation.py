@@ -0,0 +1,403 @@
+"""在代理內轉換 Ollama 原生 NDJSON 與 OpenAI SSE 串流，不再依賴 Ollama 的 /v1 相容層。
+
+上游一律使用 /api/chat；`StreamTranslator` 逐塊解析上游串流，把間隔小於 `flush_interval` 的
+細碎 token 合併成一個事件再以客戶端的格式輸出，同時統計 token 數與用量。
+"""
+import json
+import time
+import uuid
+from datetime import datetime, timezone
+
+from adapters import strip_data_url
+from metrics import StreamMeter
+
+OLLAMA = "ollama"
+OPENAI = "openai"
+CONTENT_TYPES = {OLLAMA: "application/x-ndjson", OPENAI: "text/event-stream"}
+
+# OpenAI 請求參數 -> Ollama options
+OPENAI_OPTIONS = {"temperature": "temperature", "top_p": "top_p", "seed": "seed", "stop": "stop",
+                  "max_tokens": "num_predict", "max_completion_tokens": "num_predict",
+                  "frequency_penalty": "frequency_penalty", "presence_penalty": "presence_penalty"}
+OLLAMA_PASSTHROUGH_FIELDS = ("keep_alive", "think", "options", "format", "tools")
+
+
+def _ollama_tool_calls(tool_calls: list) -> list:
+    converted = []
+    for call in tool_calls:
+        function = call.get("function", {})
+        arguments = function.get("arguments", {})
+        if isinstance(arguments, str):
+            try:
+                arguments = json.loads(arguments) if arguments else {}
+            except ValueError:
+                arguments = {}
+        converted.append({"function": {"name": function.get("name", ""), "arguments": arguments}})
+    return converted
+
+
+def _ollama_message(message: dict) -> dict:
+    role = message.get("role")
+    converted = {"role": "system" if role == "developer" else role}
+    content = message.get("content")
+    if isinstance(content, list):
+        texts, images = [], []
+        for part in content:
+            if not isinstance(part, dict):
+                continue
+            if part.get("type") == "text":
+                texts.append(part.get("text", ""))
+            elif part.get("type") == "image_url":
+                url = part.get("image_url")
+                url = url.get("url", "") if isinstance(url, dict) else url
+                if url:
+                    images.append(strip_data_url(url))
+        converted["content"] = "\n".join(texts)
+        if images:
+            converted["images"] = images
+    else:
+        converted["content"] = content or ""
+    if message.get("images"):
+        converted["images"] = message["images"]
+    if message.get("tool_calls"):
+        converted["tool_calls"] = _ollama_tool_calls(message["tool_calls"])
+    return converted
+
+
+def openai_to_ollama_request(payload: dict) -> dict:
+    """把 OpenAI chat.completions 請求轉為 /api/chat 請求；已是 Ollama 格式的欄位原樣保留。"""
+    request = {"model": payload.get("model"), "stream": payload.get("stream", True),
+               "messages": [_ollama_message(m) for m in payload.get("messages", [])]}
+    for field in OLLAMA_PASSTHROUGH_FIELDS:
+        if payload.get(field) is not None:
+            request[field] = payload[field]
+    options = {target: payload[source] for source, target in OPENAI_OPTIONS.items()
+               if payload.get(source) is not None}
+    if options:
+        request["options"] = {**options, **request.get("options", {})}
+    response_format = payload.get("response_format") or {}
+    if response_format.get("type") == "json_object":
+        request["format"] = "json"
+    elif response_format.get("type") == "json_schema":
+        request["format"] = response_format.get("json_schema", {}).get("schema", "json")
+    return request
+
+
+class _Event:
+    __slots__ = ("content", "thinking", "tool_calls", "done", "done_reason", "error", "usage", "raw")
+
+    def __init__(self, content="", thinking="", tool_calls=None, done=False, done_reason=None,
+                 error=None, usage=None, raw=None):
+        self.content = content
+        self.thinking = thinking
+        self.tool_calls = tool_calls
+        self.done = done
+        self.done_reason = done_reason
+        self.error = error
+        self.usage = usage
+        self.raw = raw
+
+
+def _decode_ollama_line(line: bytes) -> _Event:
+    data = json.loads(line)
+    if "error" in data:
+        return _Event(error=str(data["error"]), raw=line)
+    message = data.get("message") or {}
+    event = _Event(content=message.get("content") or "", thinking=message.get("thinking") or "",
+                   tool_calls=message.get("tool_calls"), done=bool(data.get("done")),
+                   done_reason=data.get("done_reason"), raw=line)
+    if event.done:
+        event.usage = {"prompt_tokens": data.get("prompt_eval_count", 0),
+                       "completion_tokens": data.get("eval_count", 0)}
+    return event
+
+
+def _decode_sse_line(line: bytes) -> _Event | None:
+    if not line.startswith(b"data:"):
+        return None
+    body = line[5:].strip()
+    if body == b"[DONE]":
+        return _Event(done=True, raw=line)
+    data = json.loads(body)
+    if "error" in data:
+        error = data["error"]
+        return _Event(error=error.get("message", str(error)) if isinstance(error, dict) else str(error), raw=line)
+    event = _Event(raw=line)
+    if data.get("usage"):
+        event.usage = {"prompt_tokens": data["usage"].get("prompt_tokens", 0),
+                       "completion_tokens": data["usage"].get("completion_tokens", 0)}
+    for choice in data.get("choices") or []:
+        delta = choice.get("delta") or {}
+        event.content += delta.get("content") or ""
+        event.thinking += delta.get("reasoning") or delta.get("reasoning_content") or ""
+        if delta.get("tool_calls"):
+            event.tool_calls = _ollama_tool_calls(delta["tool_calls"])
+        if choice.get("finish_reason"):
+            event.done_reason = choice["finish_reason"]
+    return event
+
+
+class StreamTranslator:
+    """把上游串流 (`upstream_format`) 轉為客戶端格式 (`client_format`)。
+
+    `feed()` 逐塊餵入上游位元組並回傳此刻應送出的位元組；上游結束後呼叫 `finish()` 取得剩餘內容。
+    兩端格式相同時，結束、工具調用與錯誤等事件原樣轉送，只有細碎的文字 token 會被合併。
+    只有與前一塊資料的間隔小於 `flush_interval` 的 token 才會暫存：上游變慢時新資料一到就立即送出，
+    暫存的 token 因此只在 token 本來就密集到達時延後，不會在緩慢的生成中被扣住一整段間隔。
+    """
+
+    def __init__(self, upstream_format: str, client_format: str, model: str, flush_interval: float = 0.0,
+                 include_usage: bool = False, meter: StreamMeter | None = None, on_complete=None):
+        self.upstream_format = upstream_format
+        self.client_format = client_format
+        self.model = model
+        self.flush_interval = flush_interval
+        self.include_usage = include_usage
+        self.meter = meter
+        # 上游正常結束且沒有工具調用或錯誤時，以完整答案 {content, thinking, done_reason, usage} 呼叫
+        self.on_complete = on_complete
+        self._transcript = ([], []) if on_complete is not None else None
+        self._decode = _decode_ollama_line if upstream_format == OLLAMA else _decode_sse_line
+        self._buffer = b""
+        self._content = []
+        self._thinking = []
+        self._pending_tokens = 0
+        self._last_flush = 0.0
+        self._last_arrival = 0.0
+        self._role_sent = False
+        self._done_reason = None
+        self._sent_tool_calls = False
+        self._finished = False
+        self._model_json = json.dumps(model)
+        self._chunk_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        self._created = int(time.time())
+        self.tokens = 0
+        self.events_out = 0
+        self.usage = None
+
+    def feed(self, chunk: bytes) -> bytes:
+        out = []
+        now = time.monotonic()
+        slow = now - self._last_arrival >= self.flush_interval
+        self._last_arrival = now
+        self._buffer += chunk
+        *lines, self._buffer = self._buffer.split(b"\n")
+        for line in lines:
+            line = line.strip()
+            if line and not self._finished:
+                self._handle(line, out)
+        if self._pending_tokens and (slow or now - self._last_flush >= self.flush_interval):
+            self._flush(out)
+        return b"".join(out)
+
+    def finish(self) -> bytes:
+        out = []
+        line = self._buffer.strip()
+        self._buffer = b""
+        if line and not self._finished:
+            self._handle(line, out)
+        self._flush(out)
+        if not self._finished:
+            self._finish(None, out)
+        return b"".join(out)
+
+    def _handle(self, line: bytes, out: list):
+        try:
+            event = self._decode(line)
+        except ValueError:
+            return
+        if event is None:
+            return
+        if event.content or event.thinking:
+            self._content.append(event.content)
+            self._thinking.append(event.thinking)
+            self._pending_tokens += 1
+            if self._transcript is not None:
+                self._transcript[0].append(event.content)
+                self._transcript[1].append(event.thinking)
+        if event.tool_calls or event.error:
+            self._transcript = None
+        if event.usage:
+            self.usage = event.usage
+        if event.done_reason:
+            self._done_reason = event.done_reason
+        if event.tool_calls or event.error or event.done or event.done_reason:
+            self._flush(out)
+        if event.error:
+            out.append(event.raw + self._line_end() if self._same_format else self._encode_error(event.error))
+            self._finished = True
+            return
+        if event.tool_calls:
+            self._sent_tool_calls = True
+            out.append(event.raw + self._line_end() if self._same_format else self._encode_tool_calls(event.tool_calls))
+        if event.done:
+            self._finish(event, out)
+        elif self._same_format and not (event.content or event.thinking or event.tool_calls):
+            # 例如 OpenAI 的 finish_reason 與 usage 區塊
+            out.append(event.raw + self._line_end())
+
+    @property
+    def _same_format(self) -> bool:
+        return self.upstream_format == self.client_format
+
+    def _line_end(self) -> bytes:
+        return b"\n\n" if self.client_format == OPENAI else b"\n"
+
+    def _flush(self, out: list):
+        if not self._pending_tokens:
+            return
+        content, thinking = "".join(self._content), "".join(self._thinking)
+        self._content.clear()
+        self._thinking.clear()
+        if self.meter is not None:
+            self.meter.observe_tokens(self._pending_tokens)
+        self.tokens += self._pending_tokens
+        self._pending_tokens = 0
+        self._last_flush = time.monotonic()
+        self.events_out += 1
+        out.append(self._encode_delta(content, thinking))
+
+    def _finish(self, event: _Event | None, out: list):
+        done_reason = self._done_reason
+        self._finished = True
+        if self.usage and self.meter is not None:
+            self.meter.record_usage(self.usage["prompt_tokens"], self.usage["completion_tokens"])
+        if event is not None and self._transcript is not None:
+            self.on_complete({"content": "".join(self._transcript[0]), "thinking": "".join(self._transcript[1]),
+                              "done_reason": done_reason, "usage": self.usage})
+        if self._same_format and event is not None:
+            out.append(event.raw + self._line_end())
+            return
+        if self.client_format == OPENAI:
+            # Ollama 在工具調用後仍回報 "stop"，OpenAI 客戶端則依 "tool_calls" 判斷是否要執行工具
+            finish_reason = "tool_calls" if self._sent_tool_calls else done_reason or "stop"
+            out.append(self._sse_chunk('{}', finish_reason))
+            if self.include_usage and self.usage:
+                usage = {**self.usage, "total_tokens": self.usage["prompt_tokens"] + self.usage["completion_tokens"]}
+                out.append(f'data: {{"id":"{self._chunk_id}","object":"chat.completion.chunk",'
+                           f'"created":{self._created},"model":{self._model_json},"choices":[],'
+                           f'"usage":{json.dumps(usage)}}}\n\n'.encode("utf-8"))
+            out.append(b"data: [DONE]\n\n")
+        else:
+            final = {"model": self.model, "created_at": self._timestamp(),
+                     "message": {"role": "assistant", "content": ""}, "done": True,
+                     "done_reason": done_reason or "stop"}
+            if self.usage:
+                final["prompt_eval_count"] = self.usage["prompt_tokens"]
+                final["eval_count"] = self.usage["completion_tokens"]
+            out.append(json.dumps(final, ensure_ascii=False).encode("utf-8") + b"\n")
+
+    @staticmethod
+    def _timestamp() -> str:
+        return datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+
+    def _sse_chunk(self, delta_json: str, finish_reason: str | None = None) -> bytes:
+        # 只序列化本次的 delta，其餘欄位在整條串流中固定不變
+        reason = json.dumps(finish_reason) if finish_reason else "null"
+        return (f'data: {{"id":"{self._chunk_id}","object":"chat.completion.chunk","created":{self._created},'
+                f'"model":{self._model_json},"choices":[{{"index":0,"delta":{delta_json},'
+                f'"finish_reason":{reason}}}]}}\n\n').encode("utf-8")
+
+    def _encode_delta(self, content: str, thinking: str) -> bytes:
+        if self.client_format == OPENAI:
+            delta = {}
+            if not self._role_sent:
+                delta["role"] = "assistant"
+                self._role_sent = True
+            if thinking:
+                delta["reasoning"] = thinking
+            if content:
+                delta["content"] = content
+            return self._sse_chunk(json.dumps(delta, ensure_ascii=False))
+        message = {"role": "assistant", "content": content}
+        if thinking:
+            message["thinking"] = thinking
+        return (f'{{"model":{self._model_json},"created_at":"{self._timestamp()}",'
+                f'"message":{json.dumps(message, ensure_ascii=False)},"done":false}}\n').encode("utf-8")
+
+    def _encode_tool_calls(self, tool_calls: list) -> bytes:
+        if self.client_format == OPENAI:
+            calls = [{"index": i, "id": f"call_{uuid.uuid4().hex[:16]}", "type": "function",
+                      "function": {"name": call.get("function", {}).get("name", ""),
+                                   "arguments": json.dumps(call.get("function", {}).get("arguments", {}),
+                                                           ensure_ascii=False)}}
+                     for i, call in enumerate(tool_calls)]
+            return self._sse_chunk(json.dumps({"tool_calls": calls}, ensure_ascii=False))
+        return (f'{{"model":{self._model_json},"created_at":"{self._timestamp()}","message":'
+                f'{json.dumps({"role": "assistant", "content": "", "tool_calls": tool_calls}, ensure_ascii=False)},'
+                f'"done":false}}\n').encode("utf-8")
+
+    def _encode_error(self, message: str) -> bytes:
+        return encode_error(message, self.client_format)
+
+
+def encode_delta(content: str, thinking: str, client_format: str, model: str) -> bytes:
+    """單獨一個文字增量事件 (不屬於任何 StreamTranslator 的串流)，供串流開始前的狀態事件使用。"""
+    if client_format == OPENAI:
+        delta = {"role": "assistant"}
+        if thinking:
+            delta["reasoning"] = thinking
+        if content:
+            delta["content"] = content
+        chunk = {"id": f"chatcmpl-{uuid.uuid4().hex[:24]}", "object": "chat.completion.chunk",
+                 "created": int(time.time()), "model": model,
+                 "choices": [{"index": 0, "delta": delta, "finish_reason": None}]}
+        return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8")
+    message = {"role": "assistant", "content": content}
+    if thinking:
+        message["thinking"] = thinking
+    return json.dumps({"model": model, "created_at": StreamTranslator._timestamp(), "message": message,
+                       "done": False}, ensure_ascii=False).encode("utf-8") + b"\n"
+
+
+def encode_error(message: str, client_format: str) -> bytes:
+    if client_format == OPENAI:
+        return f"data: {json.dumps({'error': {'message': message, 'type': 'upstream_error'}}, ensure_ascii=False)}\n\n".encode("utf-8")
+    return json.dumps({"error": message}, ensure_ascii=False).encode("utf-8") + b"\n"
+
+
+def replay_stream(answer: dict, client_format: str, model: str, include_usage: bool = False) -> bytes:
+    """把完整答案 (例如快取的回應) 一次編碼成客戶端格式的串流。"""
+    translator = StreamTranslator(OLLAMA, client_format, model, include_usage=include_usage)
+    message = {"role": "assistant", "content": answer.get("content", "")}
+    if answer.get("thinking"):
+        message["thinking"] = answer["thinking"]
+    done = {"model": model, "message": {"role": "assistant", "content": ""}, "done": True,
+            "done_reason": answer.get("done_reason") or "stop"}
+    if answer.get("usage"):
+        done["prompt_eval_count"] = answer["usage"]["prompt_tokens"]
+        done["eval_count"] = answer["usage"]["completion_tokens"]
+    lines = [json.dumps({"model": model, "message": message, "done": False}, ensure_ascii=False),
+             json.dumps(done, ensure_ascii=False)]
+    return translator.feed("\n".join(lines).encode("utf-8") + b"\n") + translator.finish()
+
+
+def text_stream(text: str, client_format: str, model: str) -> bytes:
+    """把一段完整文字 (例如道歉訊息) 編碼成客戶端格式的串流。"""
+    return replay_stream({"content": text}, client_format, model)
+
+
+def progress_event(text: str, client_format: str, model: str, visible: bool = False) -> bytes:
+    """前置階段的狀態或保活事件 (text 為空字串)，可安全地接在最終串流之前。
+
+    不可見時 SSE 使用註解行、NDJSON 使用空內容訊息，客戶端都會忽略；可見時把狀態文字放在 thinking/reasoning 欄位。
+    """
+    if visible and text:
+        return encode_delta("", text + "\n", client_format, model)
+    if client_format == OPENAI:
+        return f": {' '.join(text.split()) or 'keep-alive'}\n\n".encode("utf-8")
+    return encode_delta("", "", client_format, model)
+
+
+def headers_event(headers: dict, client_format: str, model: str) -> bytes:
+    """串流已開始後才得知的回應標頭 (例如快取狀態)：SSE 以註解行、NDJSON 以空內容訊息的 `proxy_headers` 欄位送出。"""
+    if client_format == OPENAI:
+        return "".join(f": {name}: {value}\n" for name, value in headers.items()).encode("utf-8") + b"\n"
+    return json.dumps({"model": model, "created_at": StreamTranslator._timestamp(),
+                       "message": {"role": "assistant", "content": ""}, "done": False, "proxy_headers": headers},
+                      ensure_ascii=False).encode("utf-8") + b"\n"
+
+
+def error_event(message: str, client_format: str, model: str) -> bytes:
+    """串流已開始後才發生的錯誤，以客戶端格式的錯誤事件結束串流。"""
+    return encode_error(message, client_format)
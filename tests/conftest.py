@@ -0,0 +1,20 @@
+import os
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [REPO_DIR, os.path.join(REPO_DIR, "bench")]
+
+from mock_ollama import MockSettings, start_mock_ollama  # noqa: E402
+
+
+@pytest.fixture
+def mock_nodes():
+    """三個在臨時埠上的假 Ollama 節點，回傳 {url: server}；server.state 可讀取請求數或模擬故障。"""
+    settings = MockSettings(prefill_ms=10, tokens_per_second=1000, stream_tokens=4, internal_tokens=4)
+    servers = [start_mock_ollama(0, settings) for _ in range(3)]
+    yield {f"http://127.0.0.1:{server.server_address[1]}": server for server in servers}
+    for server in servers:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,88 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from admission import AdmissionRejected, ModelScheduler
+
+
+def test_unlimited_by_default():
+    scheduler = ModelScheduler()
+    for _ in range(100):
+        scheduler.acquire("m", "stream")
+    assert scheduler.stats()["m"]["active"] == 100
+    assert scheduler.stats()["m"]["limit"] is None
+
+
+def test_queue_full_is_rejected_with_429():
+    scheduler = ModelScheduler(limits={"m": 1}, max_queue=1, wait_timeout=5, internal_reserve=0)
+    scheduler.acquire("m", "stream")
+    waiter = threading.Thread(target=scheduler.acquire, args=("m", "stream"))
+    waiter.start()
+    while not scheduler.stats()["m"]["queued"]["stream"]:
+        time.sleep(0.01)
+    with pytest.raises(AdmissionRejected) as rejected:
+        scheduler.acquire("m", "stream")
+    assert rejected.value.status_code == 429
+    with pytest.raises(AdmissionRejected):
+        scheduler.check_capacity("m", "stream")
+    scheduler.release("m", "stream")
+    waiter.join(timeout=5)
+    assert scheduler.stats()["m"]["active"] == 1
+
+
+def test_wait_timeout_is_rejected_with_503_and_leaves_the_queue():
+    scheduler = ModelScheduler(limits={"m": 1}, wait_timeout=0.05, retry_after=7, internal_reserve=0)
+    scheduler.acquire("m", "stream")
+    with pytest.raises(AdmissionRejected) as rejected:
+        scheduler.acquire("m", "stream")
+    assert rejected.value.status_code == 503
+    assert rejected.value.retry_after == 7
+    assert scheduler.stats()["m"]["queued"]["stream"] == 0
+
+
+def test_internal_reserve_keeps_a_slot_for_internal_calls():
+    scheduler = ModelScheduler(limits={"m": 2}, wait_timeout=0.05, internal_reserve=1)
+    scheduler.acquire("m", "stream")
+    with pytest.raises(AdmissionRejected):
+        scheduler.acquire("m", "stream")
+    scheduler.acquire("m", "internal")
+    assert scheduler.stats()["m"]["active_by_lane"] == {"internal": 1, "background": 0, "stream": 1}
+
+
+def test_release_wakes_higher_priority_lanes_first():
+    scheduler = ModelScheduler(limits={"m": 1}, wait_timeout=5, internal_reserve=0)
+    scheduler.acquire("m", "stream")
+    order = []
+
+    def wait(lane):
+        scheduler.acquire("m", lane)
+        order.append(lane)
+        scheduler.release("m", lane)
+    threads = [threading.Thread(target=wait, args=(lane,)) for lane in ("stream", "background", "internal")]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.05)
+    scheduler.release("m", "stream")
+    for thread in threads:
+        thread.join(timeout=5)
+    assert order == ["internal", "background", "stream"]
+
+
+def test_acquire_async_is_woken_from_another_thread_and_cleans_up_on_cancel():
+    scheduler = ModelScheduler(limits={"m": 1}, wait_timeout=5, internal_reserve=0)
+
+    async def main():
+        await scheduler.acquire_async("m", "stream")
+        waiter = asyncio.create_task(scheduler.acquire_async("m", "stream"))
+        await asyncio.sleep(0.05)
+        threading.Timer(0.05, scheduler.release, ("m", "stream")).start()
+        await asyncio.wait_for(waiter, 5)
+        cancelled = asyncio.create_task(scheduler.acquire_async("m", "stream"))
+        await asyncio.sleep(0.05)
+        cancelled.cancel()
+        await asyncio.gather(cancelled, return_exceptions=True)
+    asyncio.run(main())
+    assert scheduler.stats()["m"]["active"] == 1
+    assert scheduler.stats()["m"]["queued"]["stream"] == 0
@@ -0,0 +1,100 @@
+import time
+
+import pytest
+
+from backend_pool import BackendPool, NoBackendAvailable, OllamaNode
+from ollama_client import OllamaClient
+
+
+def _generate(client: OllamaClient, model: str):
+    return client.post("query", "/api/generate", json={"model": model, "prompt": "pool test", "stream": False})
+
+
+def test_acquire_filters_nodes_by_model():
+    pool = BackendPool([OllamaNode("http://a", ["a"]), OllamaNode("http://b", ["b"]), OllamaNode("http://any")])
+    for _ in range(6):
+        node = pool.acquire("b")
+        assert node.url in ("http://b", "http://any")
+        pool.release(node, True, "b")
+    assert pool.acquire("a").url in ("http://a", "http://any")
+    with pytest.raises(NoBackendAvailable):
+        BackendPool([OllamaNode("http://a", ["a"])]).acquire("b")
+
+
+def test_acquire_prefers_least_outstanding():
+    pool = BackendPool([OllamaNode(f"http://n{i}") for i in range(3)])
+    held = [pool.acquire("m") for _ in range(6)]
+    assert sorted(node["outstanding"] for node in pool.stats()) == [2, 2, 2]
+    pool.release(held[0], True, "m")
+    assert pool.acquire("m") is held[0]
+
+
+def test_ties_rotate_across_sequential_requests():
+    pool = BackendPool([OllamaNode(f"http://n{i}") for i in range(3)], load_penalty=0)
+    for _ in range(6):
+        pool.release(pool.acquire("m"), True, "m")
+    assert [node["requests"] for node in pool.stats()] == [2, 2, 2]
+
+
+def test_loaded_model_is_preferred_until_overloaded():
+    pool = BackendPool([OllamaNode("http://cold"), OllamaNode("http://warm")], load_penalty=2)
+    pool.nodes[1].loaded_models.add("m")
+    # 未載入模型的節點視同多出 load_penalty 個未完成請求
+    assert [pool.acquire("m").url for _ in range(2)] == ["http://warm", "http://warm"]
+    pool.acquire("m")
+    pool.acquire("m")
+    assert [node["outstanding"] for node in pool.stats()] == [1, 3]
+
+
+def test_release_ejects_after_consecutive_failures():
+    pool = BackendPool([OllamaNode("http://bad"), OllamaNode("http://good")],
+                       failure_threshold=3, ejection_seconds=60, load_penalty=0)
+    bad = pool.nodes[0]
+    for _ in range(2):
+        pool.release(pool.acquire("m", exclude=[pool.nodes[1]]), False)
+    # 成功會重設連續失敗次數
+    pool.release(pool.acquire("m", exclude=[pool.nodes[1]]), True, "m")
+    assert not pool.stats()[0]["ejected"]
+    for _ in range(3):
+        pool.release(pool.acquire("m", exclude=[pool.nodes[1]]), False)
+    assert pool.stats()[0]["ejected"]
+    assert all(pool.acquire("m") is not bad for _ in range(4))
+    # 所有可服務的節點都被剔除時仍回傳其中之一，而不是拒絕請求
+    assert pool.acquire("m", exclude=[pool.nodes[1]]) is bad
+
+
+def test_ejected_node_returns_after_ejection_period():
+    pool = BackendPool([OllamaNode("http://bad")], failure_threshold=1, ejection_seconds=0.05)
+    pool.release(pool.acquire("m"), False)
+    assert pool.stats()[0]["ejected"]
+    time.sleep(0.06)
+    assert not pool.stats()[0]["ejected"]
+
+
+def test_client_retries_on_another_node_and_ejects_failing_node(mock_nodes):
+    urls = list(mock_nodes)
+    pool = BackendPool([OllamaNode(url) for url in urls], failure_threshold=3, ejection_seconds=60, load_penalty=0)
+    client = OllamaClient(backend_pool=pool)
+    failing = mock_nodes[urls[0]]
+    failing.state["failing"] = True
+    try:
+        for _ in range(9):
+            assert _generate(client, "m").status_code == 200
+        assert failing.state["requests"] == 3
+        assert pool.stats()[0]["ejected"]
+        assert [node["outstanding"] for node in pool.stats()] == [0, 0, 0]
+    finally:
+        client.close()
+
+
+def test_client_routes_by_model_against_mock_nodes(mock_nodes):
+    urls = list(mock_nodes)
+    pool = BackendPool([OllamaNode(urls[0], ["a"]), OllamaNode(urls[1], ["b"]), OllamaNode(urls[2])])
+    client = OllamaClient(backend_pool=pool)
+    try:
+        for _ in range(4):
+            _generate(client, "b").raise_for_status()
+    finally:
+        client.close()
+    assert mock_nodes[urls[0]].state["requests"] == 0
+    assert mock_nodes[urls[1]].state["requests"] + mock_nodes[urls[2]].state["requests"] == 4
@@ -0,0 +1,127 @@
+import json
+
+import stream_translation
+from stream_translation import (OLLAMA, OPENAI, StreamTranslator, encode_delta, error_event, headers_event,
+                                openai_to_ollama_request, progress_event, replay_stream)
+
+
+def _ollama_stream(tokens, **done):
+    lines = [{"model": "m", "message": {"role": "assistant", "content": token}, "done": False} for token in tokens]
+    lines.append({"model": "m", "message": {"role": "assistant", "content": ""}, "done": True,
+                  "done_reason": "stop", "prompt_eval_count": 3, "eval_count": len(tokens), **done})
+    return "".join(json.dumps(line) + "\n" for line in lines).encode()
+
+
+def _translate(translator, data: bytes, chunk_size: int = 7) -> bytes:
+    # 刻意以小塊餵入，讓事件跨越區塊邊界
+    out = b"".join(translator.feed(data[i:i + chunk_size]) for i in range(0, len(data), chunk_size))
+    return out + translator.finish()
+
+
+def _sse_events(data: bytes) -> list:
+    return [line[6:] for line in data.decode().split("\n\n") if line.startswith("data: ")]
+
+
+def _sse_content(data: bytes) -> str:
+    return "".join(json.loads(event)["choices"][0]["delta"].get("content", "")
+                   for event in _sse_events(data) if event != "[DONE]" and json.loads(event)["choices"])
+
+
+def _ndjson(data: bytes) -> list[dict]:
+    return [json.loads(line) for line in data.decode().splitlines() if line]
+
+
+def test_ollama_to_openai_round_trip():
+    tokens = ["Hel", "lo", " wor", "ld"]
+    openai = _translate(StreamTranslator(OLLAMA, OPENAI, "m", include_usage=True), _ollama_stream(tokens))
+    events = _sse_events(openai)
+    assert events[-1] == "[DONE]"
+    chunks = [json.loads(event) for event in events[:-1]]
+    assert chunks[0]["choices"][0]["delta"]["role"] == "assistant"
+    assert "".join(c["choices"][0]["delta"].get("content", "") for c in chunks if c["choices"]) == "Hello world"
+    assert [c["choices"][0]["finish_reason"] for c in chunks if c["choices"]][-1] == "stop"
+    assert chunks[-1]["usage"] == {"prompt_tokens": 3, "completion_tokens": 4, "total_tokens": 7}
+
+    back = _ndjson(_translate(StreamTranslator(OPENAI, OLLAMA, "m"), openai))
+    assert "".join(line["message"]["content"] for line in back) == "Hello world"
+    assert back[-1]["done"] is True
+    assert back[-1]["eval_count"] == 4
+
+
+def test_same_format_forwards_control_lines_unchanged():
+    upstream = _ollama_stream(["a", "b"])
+    lines = _ndjson(_translate(StreamTranslator(OLLAMA, OLLAMA, "m"), upstream))
+    assert "".join(line["message"]["content"] for line in lines) == "ab"
+    assert lines[-1] == _ndjson(upstream)[-1]
+
+
+def test_tool_calls_finish_with_tool_calls_reason():
+    upstream = (json.dumps({"model": "m", "message": {"role": "assistant", "content": "", "tool_calls": [
+        {"function": {"name": "lookup", "arguments": {"q": "x"}}}]}, "done": False}) + "\n").encode()
+    upstream += _ollama_stream([])
+    events = [json.loads(event) for event in _sse_events(_translate(StreamTranslator(OLLAMA, OPENAI, "m"), upstream))
+              if event != "[DONE]"]
+    call = events[0]["choices"][0]["delta"]["tool_calls"][0]
+    assert call["function"] == {"name": "lookup", "arguments": '{"q": "x"}'}
+    assert events[-1]["choices"][0]["finish_reason"] == "tool_calls"
+
+
+def test_upstream_error_ends_the_stream():
+    upstream = _ollama_stream(["a"]).split(b"\n")[0] + b"\n" + b'{"error": "model crashed"}\n'
+    translator = StreamTranslator(OLLAMA, OPENAI, "m")
+    events = _sse_events(_translate(translator, upstream))
+    assert json.loads(events[-1]) == {"error": {"message": "model crashed", "type": "upstream_error"}}
+    assert translator.finish() == b""
+
+
+def test_coalescing_merges_fast_tokens_and_flushes_after_a_slow_gap(monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(stream_translation.time, "monotonic", lambda: clock[0])
+    translator = StreamTranslator(OLLAMA, OLLAMA, "m", flush_interval=0.05)
+    lines = [json.dumps({"model": "m", "message": {"role": "assistant", "content": token}, "done": False}).encode()
+             + b"\n" for token in "abcd"]
+    assert _ndjson(translator.feed(lines[0]))[0]["message"]["content"] == "a"
+    clock[0] += 0.01
+    assert translator.feed(lines[1]) == b""
+    clock[0] += 0.01
+    assert translator.feed(lines[2]) == b""
+    # 上游變慢：新資料一到就連同暫存的 token 一起送出
+    clock[0] += 0.2
+    assert _ndjson(translator.feed(lines[3]))[0]["message"]["content"] == "bcd"
+    assert translator.tokens == 4
+    assert translator.events_out == 2
+
+
+def test_on_complete_transcript_replays_to_the_same_answer():
+    answers = []
+    translator = StreamTranslator(OLLAMA, OPENAI, "m", on_complete=answers.append)
+    original = _translate(translator, _ollama_stream(["Hi", " there"]))
+    assert answers == [{"content": "Hi there", "thinking": "", "done_reason": "stop",
+                        "usage": {"prompt_tokens": 3, "completion_tokens": 2}}]
+    replayed = replay_stream(answers[0], OPENAI, "m")
+    assert _sse_content(replayed) == _sse_content(original) == "Hi there"
+
+
+def test_openai_request_is_converted_to_ollama_chat():
+    request = openai_to_ollama_request({
+        "model": "m", "stream": True, "temperature": 0, "max_tokens": 16,
+        "response_format": {"type": "json_object"},
+        "messages": [{"role": "developer", "content": "be brief"},
+                     {"role": "user", "content": [{"type": "text", "text": "look"},
+                                                  {"type": "image_url", "image_url": {"url": "data:image/png;base64,QUJD"}}]}]})
+    assert request["options"] == {"temperature": 0, "num_predict": 16}
+    assert request["format"] == "json"
+    assert request["messages"][0] == {"role": "system", "content": "be brief"}
+    assert request["messages"][1] == {"role": "user", "content": "look", "images": ["QUJD"]}
+
+
+def test_standalone_events_are_valid_in_both_formats():
+    assert progress_event("", OPENAI, "m") == b": keep-alive\n\n"
+    visible = json.loads(_sse_events(progress_event("searching", OPENAI, "m", visible=True))[0])
+    assert visible["choices"][0]["delta"]["reasoning"] == "searching\n"
+    assert _ndjson(progress_event("searching", OLLAMA, "m"))[0]["message"] == {"role": "assistant", "content": ""}
+    assert _ndjson(headers_event({"X-Proxy-Cache": "MISS"}, OLLAMA, "m"))[0]["proxy_headers"] == {
+        "X-Proxy-Cache": "MISS"}
+    assert headers_event({"X-Proxy-Cache": "MISS"}, OPENAI, "m") == b": X-Proxy-Cache: MISS\n\n"
+    assert _ndjson(error_event("boom", OLLAMA, "m")) == [{"error": "boom"}]
+    assert _ndjson(encode_delta("x", "", OLLAMA, "m"))[0]["message"]["content"] == "x"
@@ -0,0 +1,170 @@
+import atexit
+import json
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS api_usage (
+    api TEXT NOT NULL,
+    day TEXT NOT NULL,
+    reserved INTEGER NOT NULL DEFAULT 0,
+    used INTEGER NOT NULL DEFAULT 0,
+    daily_limit INTEGER NOT NULL,
+    PRIMARY KEY (api, day)
+);
+"""
+
+
+class UsageStore:
+    """跨行程安全的 API 額度計數器。
+
+    每個行程以原子交易向 SQLite 一次預留 `lease_size` 次額度，在記憶體中消耗；
+    實際使用次數由背景執行緒批次寫回，不佔用請求路徑。
+    """
+
+    def __init__(self, path: str, lease_size: int = 5, flush_interval: float = 5.0):
+        self.path = path
+        self.lease_size = max(1, lease_size)
+        self.flush_interval = flush_interval
+        self._limits = {}
+        self._leases = {}
+        self._pending_used = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._stop = threading.Event()
+        self._conn().executescript(_SCHEMA)
+        self._flusher = threading.Thread(
+            target=self._flush_loop, name="usage-flush", daemon=True)
+        self._flusher.start()
+        atexit.register(self.close)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _today() -> str:
+        return datetime.now().date().isoformat()
+
+    def register(self, api: str, daily_limit: int):
+        self._limits[api] = daily_limit
+
+    def import_legacy_json(self, json_path: str, api: str):
+        if not os.path.exists(json_path):
+            return
+        try:
+            with open(json_path, 'r', encoding='utf-8') as f:
+                legacy = json.load(f)[api]
+        except (json.JSONDecodeError, KeyError, OSError):
+            return
+        if legacy.get("reset_date") != self._today():
+            return
+        count = int(legacy.get("count", 0))
+        self._conn().execute(
+            "INSERT OR IGNORE INTO api_usage (api, day, reserved, used, daily_limit) VALUES (?, ?, ?, ?, ?)",
+            (api, self._today(), count, count, self._limits.get(api, count)))
+        logger.info(f"已從 {json_path} 匯入今日 {api} 使用次數: {count}")
+
+    def try_acquire(self, api: str) -> bool:
+        today = self._today()
+        with self._lock:
+            lease_day, remaining = self._leases.get(api, (today, 0))
+            if lease_day != today:
+                remaining = 0
+            if remaining <= 0:
+                remaining = self._claim_lease(api, today)
+                if remaining <= 0:
+                    self._leases[api] = (today, 0)
+                    return False
+            self._leases[api] = (today, remaining - 1)
+            key = (api, today)
+            self._pending_used[key] = self._pending_used.get(key, 0) + 1
+            return True
+
+    def _claim_lease(self, api: str, day: str) -> int:
+        conn = self._conn()
+        daily_limit = self._limits[api]
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT OR IGNORE INTO api_usage (api, day, daily_limit) VALUES (?, ?, ?)",
+                (api, day, daily_limit))
+            reserved, = conn.execute(
+                "SELECT reserved FROM api_usage WHERE api = ? AND day = ?", (api, day)).fetchone()
+            grant = max(0, min(self.lease_size, daily_limit - reserved))
+            conn.execute(
+                "UPDATE api_usage SET reserved = reserved + ?, daily_limit = ? WHERE api = ? AND day = ?",
+                (grant, daily_limit, api, day))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return grant
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending_used = self._pending_used, {}
+        if not pending:
+            return
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany("UPDATE api_usage SET used = used + ? WHERE api = ? AND day = ?",
+                             [(count, api, day) for (api, day), count in pending.items()])
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            with self._lock:
+                for key, count in pending.items():
+                    self._pending_used[key] = self._pending_used.get(key, 0) + count
+            raise
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                logger.warning(f"API 使用次數寫回失敗，稍後重試: {e}")
+
+    def close(self):
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        today = self._today()
+        with self._lock:
+            leases, self._leases = self._leases, {}
+        try:
+            self.flush()
+            conn = self._conn()
+            for api, (day, remaining) in leases.items():
+                if day == today and remaining > 0:
+                    conn.execute("UPDATE api_usage SET reserved = reserved - ? WHERE api = ? AND day = ?",
+                                 (remaining, api, day))
+        except sqlite3.Error as e:
+            logger.warning(f"歸還未使用的 API 額度失敗: {e}")
+
+    def snapshot(self) -> dict:
+        today = self._today()
+        rows = self._conn().execute(
+            "SELECT api, reserved, used, daily_limit FROM api_usage WHERE day = ?", (today,)).fetchall()
+        with self._lock:
+            pending = {api: count for (api, day), count in self._pending_used.items() if day == today}
+            leases = {api: remaining for api, (day, remaining) in self._leases.items() if day == today}
+        state = {api: {"used": 0, "reserved": 0, "daily_limit": limit, "remaining": limit}
+                 for api, limit in self._limits.items()}
+        for api, reserved, used, daily_limit in rows:
+            state[api] = {"used": used, "reserved": reserved, "daily_limit": daily_limit,
+                          "remaining": max(0, daily_limit - reserved + leases.get(api, 0))}
+        for api, entry in state.items():
+            entry["used"] += pending.get(api, 0)
+            entry["local_lease"] = leases.get(api, 0)
+        return {"day": today, "apis": state}
@@ -0,0 +1,91 @@
+import base64
+import binascii
+import hashlib
+import logging
+import os
+import threading
+
+from caching import LRUCache
+
+logger = logging.getLogger(__name__)
+
+
+def image_content_key(image_base64: str, model: str, prompt: str) -> str:
+    try:
+        image_bytes = base64.b64decode(image_base64, validate=False)
+    except (binascii.Error, ValueError):
+        image_bytes = image_base64.encode("utf-8")
+    digest = hashlib.sha256(image_bytes)
+    digest.update(f"\0{model}\0{prompt}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+class VisionCache:
+    """以圖片內容雜湊為鍵，快取視覺模型產生的描述；分為記憶體與磁碟兩層。"""
+
+    def __init__(self, directory: str, memory_entries: int = 512, max_disk_bytes: int = 32 * 1024 * 1024):
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = LRUCache(maxsize=memory_entries)
+        self._lock = threading.Lock()
+        self.disk_hits = 0
+        self.disk_evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        self.disk_bytes = sum(entry.stat().st_size for entry in os.scandir(directory)
+                              if entry.name.endswith(".txt"))
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.txt")
+
+    def get(self, key: str) -> str | None:
+        description = self.memory.get(key)
+        if description is not None:
+            return description
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                description = f.read()
+            os.utime(path)
+        except OSError:
+            return None
+        with self._lock:
+            self.disk_hits += 1
+        self.memory.set(key, description)
+        return description
+
+    def set(self, key: str, description: str):
+        self.memory.set(key, description)
+        path = self._path(key)
+        data = description.encode("utf-8")
+        try:
+            previous = os.path.getsize(path) if os.path.exists(path) else 0
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"寫入視覺描述磁碟快取失敗: {e}")
+            return
+        with self._lock:
+            self.disk_bytes += len(data) - previous
+            if self.disk_bytes > self.max_disk_bytes:
+                self._evict_disk()
+
+    def _evict_disk(self):
+        entries = sorted((entry for entry in os.scandir(self.directory) if entry.name.endswith(".txt")),
+                         key=lambda entry: entry.stat().st_mtime)
+        for entry in entries:
+            if self.disk_bytes <= self.max_disk_bytes:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+            except OSError:
+                continue
+            self.disk_bytes -= size
+            self.disk_evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"memory": self.memory.stats(), "disk_hits": self.disk_hits,
+                    "disk_bytes": self.disk_bytes, "disk_evictions": self.disk_evictions}